@@ -42,6 +42,8 @@ import imageProcessor
 import microscopeInterface
 import captureCoordinator
 import compositer
+import captureTrace
+import metricsServer
 import settings
 
 
@@ -71,6 +73,14 @@ class MyWindowClass(QtGui.QMainWindow, form_class):
         self.cc = captureCoordinator.CaptureCoordinator(self)
         self.comp = compositer.Compositer(self)
 
+        self.ctr = None
+        if self.settings.capture_trace_recording:
+            self.ctr = captureTrace.CaptureTraceRecorder(self)
+
+        self.metrics = None
+        if self.settings.metrics_server_enabled:
+            self.metrics = metricsServer.MetricsServer(self)
+
         self.tabWidget.setCurrentIndex(0)
         self.connect_signals_to_slots()
 
@@ -104,36 +114,9 @@ class MyWindowClass(QtGui.QMainWindow, form_class):
         self.comp.composite_image_saved_signal.connect(msg.close)
         msg.exec_()
 
-    def on_copying_plate_to_server_slot(self):
-        msg = QtGui.QProgressDialog()
-        msg.setWindowTitle("Copying To Server")
-        msg.setLabelText("Copying plate images to server. \nPlease wait.")
-        msg.setMinimum(0)
-        msg.setMaximum(0)
-        msg.setModal(True)
-        self.ip.copying_plate_finished_signal.connect(msg.close)
-        msg.exec_()
-
-    def on_cleaning_up_files_slot(self):
-        msg = QtGui.QProgressDialog()
-        msg.setWindowTitle("Cleaning up Local Files")
-        msg.setLabelText("Freeing up space on local drive. \nPlease wait.")
-        msg.setMinimum(0)
-        msg.setMaximum(0)
-        msg.setModal(True)
-        self.ip.local_file_cleanup_finished.connect(msg.close)
-        msg.exec_()
-
-    def on_cannot_connect_to_remote_server_slot(self):
-        msg = QtGui.QMessageBox()
-        msg.setWindowTitle("No Connection To Server!")
-        msg.setText("A connection to the remote server could not be established!\n" +
-                    "\nPlease open windows explorer and verify you can access the server directly." +
-                    "\nOnce you've established connectivity through windows explorer, hit okay to continue.")
-        msg.setDefaultButton(QtGui.QMessageBox.Yes)
-        msg.setModal(True)
-        msg.buttonClicked.connect(self.ip.on_ready_to_try_copying_after_fail_slot)
-        msg.exec_()
+    def on_local_space_low_slot(self, message):
+        # Shown without a dialog, a modal box here would sit on top of the run it's warning about until someone's back
+        self.statusBar().showMessage("Local drive low on space: " + str(message).replace("\n", " "))
 
     def on_microscope_status_changed_slot(self, status):
         if status == "Connected":
@@ -165,15 +148,17 @@ class MyWindowClass(QtGui.QMainWindow, form_class):
         except:
             pass
 
-        try:
-            self.well_preview_image_label.setPixmap(QtGui.QPixmap.fromImage(self.ip.full_well_QImage))
-        except:
-            pass
+    def on_well_preview_ready_slot(self, preview_raw_data):
+        # preview_raw_data is a new array the composite stage made for this, so the QImage can share it
+        height, width = preview_raw_data.shape[:2]
+        well_preview_QImage = QtGui.QImage(preview_raw_data, width, height, QtGui.QImage.Format_RGB888)
+        self.well_preview_image_label.setPixmap(QtGui.QPixmap.fromImage(well_preview_QImage))
 
-        try:
-            self.composite_image_label.setPixmap(QtGui.QPixmap.fromImage(self.ip.composite_QImage))
-        except:
-            pass
+    def on_composite_preview_ready_slot(self, preview_raw_data):
+        # preview_raw_data is a copy the image processor has let go of, so the QImage can share it
+        height, width = preview_raw_data.shape[:2]
+        composite_QImage = QtGui.QImage(preview_raw_data, width, height, QtGui.QImage.Format_RGB888)
+        self.composite_image_label.setPixmap(QtGui.QPixmap.fromImage(composite_QImage))
 
     def on_compositer_image_ready_slot(self):
         try:
@@ -181,13 +166,17 @@ class MyWindowClass(QtGui.QMainWindow, form_class):
         except:
             pass
 
-    def on_compositer_plate_id_changed_slot(self, id):
-        id = str(id)
-        self.plate_path_data_label.setText(id)
+    def on_compositer_progress_slot(self, plates_done, plate_count, plate_id):
+        plate_id = str(plate_id)
+        if plate_id:
+            self.plate_path_data_label.setText(plate_id + " (" + str(plates_done) + " of " + str(plate_count) + ")")
+        else:
+            self.plate_path_data_label.setText("Starting " + str(plate_count) + " plates")
 
     def closeEvent(self, event):
         self.application_exiting_signal.emit()
         self.ip.wait()
+        self.ip.retention_daemon.wait()
         self.mi.wait()
         self.cc.wait()
         event.accept()
@@ -0,0 +1,468 @@
+"""
+    This file contains the batch compositer class
+    This class builds the composites for many plates at once across a pool of processes
+"""
+
+__author__ = "Corwin Perren"
+__copyright__ = "None"
+__credits__ = [""]
+__license__ = "GPL (GNU General Public License)"
+__version__ = "1.0.0"
+__maintainer__ = "Corwin Perren"
+__email__ = "perrenc@onid.oregonstate.edu"
+__status__ = "Development"
+
+# This file is part of Auto Imager.
+#
+# Auto Imager is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Auto Imager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Auto Imager.  If not, see <http://www.gnu.org/licenses/>.
+
+
+#####################################
+# Imports
+#####################################
+# Python native imports
+import os
+import glob
+import time
+import traceback
+import Queue
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+# Custom imports
+import settings
+import wellImageWriter
+import compositeCanvas
+import compositePreview
+import compositeCache
+import tilePyramid
+
+#####################################
+# Global Variables
+#####################################
+batch_canvas_temp_prefix = "composite_batch_"
+composite_image_filename = "composite_image.png"
+
+result_poll_interval = 0.1  # Seconds between checks for cancellation and new previews while waiting on the pool
+
+max_patched_well_fraction = 0.5  # Past this many changed wells, reading the old composite back isn't worth it
+
+worker_preview_queue = None  # Set in each pool process by set_worker_preview_queue when the caller wants previews
+
+
+#####################################
+# Helper Functions
+#####################################
+def well_row_and_column(well_name):
+    # "B7" is row 1, column 6. Returns None for names that aren't wells
+    try:
+        row = ord(well_name[:1].upper()) - 65
+        column = int(well_name[1:]) - 1
+    except ValueError:
+        return None
+    if (row < 0) or (column < 0):
+        return None
+    return row, column
+
+
+def get_well_image_paths(well_images_path):
+    """ Returns (well name, path) for every well image in the folder, in row major order (A1, A2 ... H12).
+
+    Wells overlap on the composite, so a fixed order is what makes the same wells always give the same composite.
+    """
+    well_images = []
+    for file_name in os.listdir(well_images_path):
+        well_name = os.path.splitext(file_name)[0]
+        if wellImageWriter.is_well_image_file(file_name) and well_row_and_column(well_name):
+            well_images.append((well_name, well_images_path + "\\" + file_name))
+    well_images.sort(key=lambda well_image: well_row_and_column(well_image[0]))
+    return well_images
+
+
+def prefetch_well_images(well_images, thread_count, read_ahead, load_function=wellImageWriter.load_well_image):
+    """ Yields (well name, image) for each (well name, path) in order, decoding up to read_ahead wells in advance.
+
+    The loads run on a pool of thread_count threads, so reading and decoding the next wells overlaps with whatever
+    the caller does with the current one, and with each other.
+    """
+    pool = ThreadPool(max(1, thread_count))
+    try:
+        pending_loads = []
+        next_well = 0
+        while next_well < len(well_images) or pending_loads:
+            while next_well < len(well_images) and len(pending_loads) < max(1, read_ahead):
+                well_name, image_path = well_images[next_well]
+                pending_loads.append((well_name, pool.apply_async(load_function, (image_path,))))
+                next_well += 1
+
+            well_name, pending_load = pending_loads.pop(0)
+            yield well_name, pending_load.get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def set_worker_preview_queue(preview_queue):
+    # Pool initializer, queues can only reach pool processes when they are started
+    global worker_preview_queue
+    worker_preview_queue = preview_queue
+    if preview_queue is not None:
+        # Previews nobody read yet aren't worth waiting on, a worker would otherwise hang on exit with the pipe full
+        preview_queue.cancel_join_thread()
+
+
+def composite_outputs_exist(composite_path):
+    program_settings = settings.program_settings
+    if program_settings.composite_output_mode != "tiles":
+        if not os.path.isfile(composite_path + "\\" + composite_image_filename):
+            return False
+    if program_settings.composite_output_mode in ("tiles", "both"):
+        if not os.path.isfile(composite_path + "\\" + program_settings.composite_tiles_folder_name + "\\" +
+                              tilePyramid.pyramid_description_filename):
+            return False
+    return True
+
+
+def get_well_position(well_name):
+    program_settings = settings.program_settings
+    row, column = well_row_and_column(well_name)
+    return column * program_settings.stitch_offset_x, row * program_settings.stitch_offset_y
+
+
+def get_overlap(first_region, second_region):
+    """ Returns the (x, y, x_size, y_size) region two regions share, or None if they don't touch. """
+    x = max(first_region[0], second_region[0])
+    y = max(first_region[1], second_region[1])
+    x_end = min(first_region[0] + first_region[2], second_region[0] + second_region[2])
+    y_end = min(first_region[1] + first_region[3], second_region[1] + second_region[3])
+    if (x_end <= x) or (y_end <= y):
+        return None
+    return x, y, x_end - x, y_end - y
+
+
+def send_preview_if_due(plate_id, preview, last_preview_time):
+    # Returns when a preview was last sent
+    preview_interval = settings.program_settings.compositer_preview_interval_ms / 1000.0
+    if (worker_preview_queue is None) or ((time.time() - last_preview_time) < preview_interval):
+        return last_preview_time
+
+    # Copied because the queue pickles it on a background thread while we keep pasting
+    worker_preview_queue.put((plate_id, preview.preview_raw_data.copy()))
+    return time.time()
+
+
+def paste_all_wells(plate_id, well_images, canvas, preview, tile_pyramid_writer):
+    """ Pastes every well onto a blank canvas. Returns {well name: (width, height)} of what was pasted. """
+    program_settings = settings.program_settings
+
+    well_sizes = {}
+    last_preview_time = 0
+    for well_name, well_image in prefetch_well_images(well_images, program_settings.compositer_decode_thread_count,
+                                                      program_settings.compositer_decode_read_ahead):
+        well_position = get_well_position(well_name)
+        canvas.paste_well(well_image, well_position, is_bgr=True)
+        preview.paste_well(well_image, well_position, is_bgr=True)
+        if tile_pyramid_writer:
+            tile_pyramid_writer.update_region(well_position[0], well_position[1], well_image.shape[1],
+                                              well_image.shape[0])
+
+        well_sizes[well_name] = (well_image.shape[1], well_image.shape[0])
+        last_preview_time = send_preview_if_due(plate_id, preview, last_preview_time)
+
+    return well_sizes
+
+
+def load_previous_composite(composite_path, composite_cache, canvas, preview, tile_pyramid_writer):
+    """ Fills the canvas and preview back in with what was composited last time.
+
+    Returns False if that can't be read back exactly, from the composite PNG or failing that lossless tiles.
+    """
+    previous_preview = composite_cache.load_preview()
+    if (previous_preview is None) or (previous_preview.shape != preview.preview_raw_data.shape):
+        return False
+
+    composite_image_path = composite_path + "\\" + composite_image_filename
+    if os.path.isfile(composite_image_path):
+        is_loaded = canvas.load_png(composite_image_path)
+    elif tile_pyramid_writer:
+        is_loaded = tile_pyramid_writer.read_full_resolution_tiles()
+    else:
+        is_loaded = False
+
+    if is_loaded:
+        preview.preview_raw_data[:] = previous_preview
+    return is_loaded
+
+
+def patch_changed_wells(plate_id, well_images, changed_well_names, composite_cache, canvas, preview,
+                        tile_pyramid_writer):
+    """ Redraws only the parts of a previously built canvas that changed wells cover, now or last time.
+
+    Wells overlap, so every well touching a changed area is pasted again in the usual order, clipped to that area,
+    which leaves the canvas exactly as a full rebuild would. Returns {well name: (width, height)} for every well.
+    """
+    program_settings = settings.program_settings
+
+    well_sizes = {}
+    for well_name, image_path in well_images:
+        if well_name in changed_well_names:
+            well_sizes[well_name] = wellImageWriter.read_well_image_size(image_path)
+        else:
+            well_sizes[well_name] = composite_cache.get_well_size(well_name)
+
+    dirty_regions = set()
+    for well_name in changed_well_names:
+        for well_size in (composite_cache.get_well_size(well_name), well_sizes.get(well_name)):
+            if well_size:
+                dirty_regions.add(get_well_position(well_name) + tuple(well_size))
+
+    for dirty_region in dirty_regions:
+        canvas.clear_region(*dirty_region)
+
+    wells_to_paste = []
+    for well_name, image_path in well_images:
+        well_region = get_well_position(well_name) + tuple(well_sizes[well_name])
+        if any(get_overlap(well_region, dirty_region) for dirty_region in dirty_regions):
+            wells_to_paste.append((well_name, image_path))
+
+    for well_name, well_image in prefetch_well_images(wells_to_paste, program_settings.compositer_decode_thread_count,
+                                                      program_settings.compositer_decode_read_ahead):
+        well_x, well_y = get_well_position(well_name)
+        for dirty_region in dirty_regions:
+            overlap = get_overlap((well_x, well_y, well_image.shape[1], well_image.shape[0]), dirty_region)
+            if overlap:
+                x, y, x_size, y_size = overlap
+                canvas.paste_well(well_image[y - well_y:y - well_y + y_size, x - well_x:x - well_x + x_size], (x, y),
+                                  is_bgr=True)
+
+    for x, y, x_size, y_size in dirty_regions:
+        preview.paste_well(canvas.read_region(x, y, x_size, y_size), (max(0, x), max(0, y)))
+        if tile_pyramid_writer:
+            tile_pyramid_writer.update_region(x, y, x_size, y_size)
+    send_preview_if_due(plate_id, preview, 0)
+
+    return well_sizes
+
+
+def composite_plate(plate_job):
+    """ Builds the composite for one plate folder. Runs in a pool process.
+
+    Returns a dictionary with the plate path and id, whether it succeeded, whether it was skipped as already up to
+    date, a message, the time taken and a preview sized RGB array of the finished composite. While the wells are
+    pasted, (plate id, preview) snapshots are put on the worker preview queue no more often than
+    compositer_preview_interval_ms.
+
+    A plate whose well files all match the composite cache is skipped. One where only some of them changed has just
+    those areas redrawn on top of the previous composite, unless too many changed for that to be worth it.
+    """
+    plate_path, canvas_backend = plate_job
+    program_settings = settings.program_settings
+
+    start_time = time.time()
+    result = {
+        "path": plate_path,
+        "plate_id": plate_path.split("\\")[-1],
+        "succeeded": False,
+        "skipped": False,
+        "message": "",
+        "elapsed": 0.0,
+        "preview": None
+    }
+
+    well_images_path = plate_path + "\\" + program_settings.well_images_folder_name
+    if not os.path.isdir(well_images_path):
+        result["message"] = "No " + program_settings.well_images_folder_name + " folder in " + plate_path
+        return result
+
+    composite_path = plate_path + "\\" + program_settings.composite_image_folder_name
+    well_images = get_well_image_paths(well_images_path)
+    well_fingerprints = compositeCache.get_well_fingerprints(well_images)
+    layout = compositeCache.get_layout(program_settings)
+    composite_cache = compositeCache.CompositeCache(composite_path)
+
+    if composite_cache.is_up_to_date(layout, well_fingerprints) and composite_outputs_exist(composite_path):
+        result["preview"] = composite_cache.load_preview()
+        if result["preview"] is not None:
+            result["succeeded"] = True
+            result["skipped"] = True
+            result["message"] = "up to date"
+            result["elapsed"] = time.time() - start_time
+            return result
+
+    canvas = compositeCanvas.CompositeCanvas(program_settings.stitched_x_size, program_settings.stitched_y_size,
+                                             canvas_backend, batch_canvas_temp_prefix)
+    preview = compositePreview.CompositePreview(program_settings.stitched_x_size, program_settings.stitched_y_size)
+    try:
+        if not os.path.isdir(composite_path):
+            os.makedirs(composite_path)
+
+        changed_well_names = composite_cache.get_changed_well_names(layout, well_fingerprints)
+        composite_cache.invalidate()
+
+        tile_pyramid_writer = None
+        if program_settings.composite_output_mode in ("tiles", "both"):
+            tile_pyramid_writer = tilePyramid.TilePyramidWriter(
+                composite_path + "\\" + program_settings.composite_tiles_folder_name, canvas,
+                program_settings.composite_tile_size, program_settings.composite_tile_extension)
+
+        is_patched = False
+        if (changed_well_names is not None) and composite_outputs_exist(composite_path) and \
+                (len(changed_well_names) <= (max_patched_well_fraction * max(1, len(well_images)))):
+            is_patched = load_previous_composite(composite_path, composite_cache, canvas, preview,
+                                                 tile_pyramid_writer)
+            if not is_patched:
+                # A read that failed part way leaves some of the old composite behind
+                canvas.clear()
+                preview.clear()
+
+        if is_patched:
+            well_sizes = patch_changed_wells(result["plate_id"], well_images, changed_well_names, composite_cache,
+                                             canvas, preview, tile_pyramid_writer)
+            result["message"] = str(len(changed_well_names)) + " of " + str(len(well_images)) + " wells changed"
+        else:
+            well_sizes = paste_all_wells(result["plate_id"], well_images, canvas, preview, tile_pyramid_writer)
+            result["message"] = str(len(well_images)) + " wells"
+
+        if tile_pyramid_writer:
+            tile_pyramid_writer.finish()  # Every tile the wells touched is written once, now they're all pasted
+
+        result["preview"] = preview.preview_raw_data
+
+        if program_settings.composite_output_mode != "tiles":
+            # Written under a temporary name so a cancelled batch never leaves a truncated composite behind
+            full_path_string = composite_path + "\\" + composite_image_filename
+            canvas.save_png(full_path_string + ".tmp", worker_count=1)
+            wellImageWriter.replace_file(full_path_string + ".tmp", full_path_string)
+
+        composite_cache.save_preview(preview.preview_raw_data)
+        composite_cache.save(layout, well_fingerprints, well_sizes)
+
+        result["succeeded"] = True
+    except Exception, e:
+        result["message"] = str(e) + "\n" + traceback.format_exc()
+    finally:
+        canvas.close()
+
+    result["elapsed"] = time.time() - start_time
+    return result
+
+
+#####################################
+# BatchCompositer Class Definition
+#####################################
+class BatchCompositer(object):
+    """ Composites a list of plate folders across a pool of processes, one plate per worker at a time.
+
+    Each worker gets memory_budget_bytes. A plate whose canvas (plus the wells being decoded ahead) fits in it is
+    composited in RAM, otherwise its canvas is memory mapped from composite_canvas_temp_path. run() blocks until the
+    batch is done, calling progress_callback(plates_done, plate_count, result) as each plate finishes, and polls
+    is_cancelled() while waiting so a cancel terminates the workers mid plate.
+
+    With a preview_callback, run() also passes on the in progress previews the workers send, as
+    preview_callback(plate_id, preview). Only one plate is followed at a time, until it finishes, so the preview
+    doesn't flick between plates when several are being composited at once.
+    """
+
+    def __init__(self, worker_count, memory_budget_bytes):
+        self.settings = settings.program_settings
+
+        self.worker_count = max(1, worker_count)
+        self.memory_budget_bytes = memory_budget_bytes
+
+        self.preview_plate_id = None
+
+    def get_canvas_backend(self):
+        canvas_bytes = self.settings.stitched_x_size * self.settings.stitched_y_size * 3
+        well_bytes = 2000 * 2000 * 3
+        decoding_bytes = (self.settings.compositer_decode_read_ahead + 1) * well_bytes
+        if canvas_bytes + decoding_bytes <= self.memory_budget_bytes:
+            return compositeCanvas.canvas_backend_memory
+        return compositeCanvas.canvas_backend_memmap
+
+    def run(self, plate_paths, progress_callback=None, is_cancelled=None, preview_callback=None):
+        """ Returns the list of results for the plates that finished, in the order they finished. """
+        canvas_backend = self.get_canvas_backend()
+        plate_jobs = [(plate_path, canvas_backend) for plate_path in plate_paths]
+
+        results = []
+        finished_plate_ids = set()
+        was_cancelled = False
+
+        preview_queue = multiprocessing.Queue() if preview_callback else None
+        self.preview_plate_id = None
+
+        pool = multiprocessing.Pool(min(self.worker_count, max(1, len(plate_jobs))), set_worker_preview_queue,
+                                    (preview_queue,))
+        try:
+            result_iterator = pool.imap_unordered(composite_plate, plate_jobs)
+            while len(results) < len(plate_jobs):
+                if is_cancelled and is_cancelled():
+                    was_cancelled = True
+                    break
+
+                if preview_queue is not None:
+                    self.forward_latest_preview(preview_queue, preview_callback, finished_plate_ids)
+
+                try:
+                    result = result_iterator.next(result_poll_interval)
+                except multiprocessing.TimeoutError:
+                    continue
+
+                results.append(result)
+                finished_plate_ids.add(result["plate_id"])
+                if progress_callback:
+                    progress_callback(len(results), len(plate_jobs), result)
+        finally:
+            if was_cancelled:
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
+
+        if was_cancelled:
+            self.clean_up_after_cancel(plate_paths)
+
+        return results
+
+    def forward_latest_preview(self, preview_queue, preview_callback, finished_plate_ids):
+        # Workers already limit how often they send, so only the newest preview of the followed plate is passed on
+        latest_previews = {}
+        while True:
+            try:
+                plate_id, preview = preview_queue.get_nowait()
+            except Queue.Empty:
+                break
+
+            # A plate's last previews can arrive after its result, which already carried the finished preview
+            if plate_id not in finished_plate_ids:
+                latest_previews[plate_id] = preview
+                if (self.preview_plate_id is None) or (self.preview_plate_id in finished_plate_ids):
+                    self.preview_plate_id = plate_id
+
+        if self.preview_plate_id in latest_previews:
+            preview_callback(self.preview_plate_id, latest_previews[self.preview_plate_id])
+
+    def clean_up_after_cancel(self, plate_paths):
+        # Terminated workers never got to close their canvases or rename their output
+        for canvas_path in glob.glob(self.settings.composite_canvas_temp_path + "\\" + batch_canvas_temp_prefix + "*"):
+            try:
+                os.remove(canvas_path)
+            except OSError:
+                pass
+
+        for plate_path in plate_paths:
+            partial_composite_path = plate_path + "\\" + self.settings.composite_image_folder_name + "\\" + \
+                composite_image_filename + ".tmp"
+            if os.path.isfile(partial_composite_path):
+                os.remove(partial_composite_path)
@@ -0,0 +1,534 @@
+"""
+    This file contains the camera backend classes
+    These classes hand the image processor its camera, either the real one through Vimba or a simulated one that
+    streams synthetic frames with realistic timing so the capture pipeline can run without the hardware
+"""
+
+
+__author__ = "Corwin Perren"
+__copyright__ = "None"
+__credits__ = [""]
+__license__ = "GPL (GNU General Public License)"
+__version__ = "1.0.0"
+__maintainer__ = "Corwin Perren"
+__email__ = "perrenc@onid.oregonstate.edu"
+__status__ = "Development"
+
+# This file is part of Auto Imager.
+#
+# Auto Imager is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Auto Imager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Auto Imager.  If not, see <http://www.gnu.org/licenses/>.
+
+
+#####################################
+# Imports
+#####################################
+# Python native imports
+import threading
+import collections
+import random
+import time
+import cv2
+import numpy as np
+
+try:
+    import pymba
+except (ImportError, OSError):  # pymba loads the Vimba DLL as it's imported, so a missing driver shows up as OSError
+    pymba = None
+
+# Custom imports
+import settings
+import captureTrace
+
+#####################################
+# Global Variables
+#####################################
+camera_backend_vimba = "vimba"
+camera_backend_simulated = "simulated"
+camera_backend_replay = "replay"
+
+simulated_frame_status_complete = 0  # Same values as VmbFrameStatusComplete and VmbFrameStatusIncomplete
+simulated_frame_status_incomplete = -1
+simulated_timestamp_tick_frequency = 1000000000  # Nanosecond ticks, like the Manta's GigE timestamp clock
+simulated_synthetic_well_count = 4
+
+discovery_delay_seconds = 0.25  # Time GeVDiscoveryAllOnce needs to find cameras on the network before connecting
+
+
+#####################################
+# Helper Functions
+#####################################
+def get_camera_backend(backend_name=None):
+    backend_name = backend_name or settings.program_settings.camera_backend
+    if backend_name == camera_backend_simulated:
+        return SimulatedCameraBackend()
+    if backend_name == camera_backend_replay:
+        return ReplayCameraBackend()
+    if backend_name != camera_backend_vimba:
+        print "Unknown camera backend " + str(backend_name) + ", falling back to vimba"
+    return VimbaCameraBackend()
+
+
+def make_synthetic_well(x_size, y_size, seed):
+    rng = np.random.RandomState(seed)
+    well = np.zeros((y_size, x_size, 3), np.uint8)
+    cv2.circle(well, (x_size / 2, y_size / 2), int(min(x_size, y_size) * 0.45), (160, 180, 200), -1)
+    noise = rng.randint(0, 40, (max(1, y_size / 8), max(1, x_size / 8), 3)).astype(np.uint8)
+    well += cv2.resize(noise, (x_size, y_size))
+    return well
+
+
+#####################################
+# VimbaCameraBackend Class Definition
+#####################################
+class VimbaCameraBackend(object):
+    """ The real camera, found on the network and opened through pymba. """
+
+    camera_error = pymba.VimbaException if pymba else Exception
+
+    def __init__(self):
+        if pymba is None:
+            raise ImportError("The vimba camera backend needs pymba and the Vimba driver installed")
+
+        self.vimba = pymba.Vimba()
+        self.vimba_system = None
+
+    def startup(self):
+        self.vimba.startup()
+        self.vimba_system = self.vimba.getSystem()
+
+    def discover_cameras(self):
+        if self.vimba_system.GeVTLIsPresent:  # If cameras exist
+            self.vimba_system.runFeatureCommand("GeVDiscoveryAllOnce")  # Discover all network cameras
+            time.sleep(discovery_delay_seconds)
+
+    def get_camera(self, camera_id):
+        return self.vimba.getCamera(camera_id)
+
+    def set_view_position_function(self, view_position_function):
+        pass  # The real camera sees whatever is really under it
+
+    def set_current_well(self, well_name):
+        pass
+
+    def shutdown(self):
+        self.vimba.shutdown()
+
+
+#####################################
+# SimulatedCameraError Class Definition
+#####################################
+class SimulatedCameraError(Exception):
+    pass
+
+
+#####################################
+# SimulatedCameraBackend Class Definition
+#####################################
+class SimulatedCameraBackend(object):
+    """ Stands in for Vimba with a single simulated camera that answers to any camera id. """
+
+    camera_error = SimulatedCameraError
+
+    def __init__(self):
+        self.settings = settings.program_settings
+        self.camera = None
+        self.view_position_function = None
+
+    def startup(self):
+        pass
+
+    def discover_cameras(self):
+        pass
+
+    def get_camera(self, camera_id):
+        # Always the same camera, so anything steering its view keeps working across reconnects
+        if self.camera is None:
+            self.camera = SimulatedCamera(camera_id, self.settings.simulated_camera_plate_image_path,
+                                          self.settings.simulated_camera_transfer_jitter,
+                                          self.settings.simulated_camera_dropped_frame_rate)
+            self.camera.view_position_function = self.view_position_function
+        return self.camera
+
+    def set_view_position_function(self, view_position_function):
+        self.view_position_function = view_position_function
+        if self.camera:
+            self.camera.view_position_function = view_position_function
+
+    def set_current_well(self, well_name):
+        pass  # Simulated frames come from the view position rather than the well
+
+    def shutdown(self):
+        if self.camera:
+            self.camera.closeCamera()
+
+
+#####################################
+# ReplayCameraBackend Class Definition
+#####################################
+class ReplayCameraBackend(SimulatedCameraBackend):
+    """ Stands in for Vimba with a ReplayCamera playing back the trace at capture_trace_replay_path. """
+
+    def __init__(self):
+        SimulatedCameraBackend.__init__(self)
+        self.capture_trace = captureTrace.CaptureTrace(self.settings.capture_trace_replay_path)
+        self.current_well_name = None
+
+    def get_camera(self, camera_id):
+        if self.camera is None:
+            self.camera = ReplayCamera(camera_id, self.capture_trace, self.settings.capture_trace_replay_speed)
+            self.camera.set_current_well(self.current_well_name)
+        return self.camera
+
+    def set_current_well(self, well_name):
+        self.current_well_name = well_name
+        if self.camera:
+            self.camera.set_current_well(well_name)
+
+
+#####################################
+# SimulatedFrameInfo Class Definition
+#####################################
+class SimulatedFrameInfo(object):
+    """ Stands in for the VmbFrame structure pymba keeps as frame._frame. """
+
+    def __init__(self):
+        self.receiveStatus = simulated_frame_status_complete
+        self.frameID = 0
+        self.timestamp = 0
+
+
+#####################################
+# SimulatedFrame Class Definition
+#####################################
+
+class SimulatedFrame(object):
+    """ The parts of a pymba frame FrameRing uses, filled in by a SimulatedCamera. """
+
+    def __init__(self, camera):
+        self.camera = camera
+        self._frame = SimulatedFrameInfo()
+
+        self.width = 0
+        self.height = 0
+        self.pixel_bytes = 3
+        self.buffer_data = None
+
+        self.frame_callback = None
+
+    def announceFrame(self):
+        self.width = self.camera.Width
+        self.height = self.camera.Height
+        self.buffer_data = np.zeros(self.camera.PayloadSize, np.uint8)
+
+    def revokeFrame(self):
+        self.buffer_data = None
+
+    def queueFrameCapture(self, frame_callback=None):
+        self.frame_callback = frame_callback
+        self.camera.queue_frame(self)
+
+    def getBufferByteData(self):
+        return self.buffer_data
+
+    def get_image_view(self):
+        return self.buffer_data.reshape(self.height, self.width, self.pixel_bytes)
+
+
+#####################################
+# SimulatedCamera Class Definition
+#####################################
+class SimulatedCamera(object):
+    """ A GigE camera in continuous acquisition, streaming BGR8 frames into whatever frames are queued on it.
+
+    Exposure and transfer time come from the same ExposureTimeAbs and StreamBytesPerSecond features the image
+    processor sets on the real camera. A new exposure starts every max(exposure, transfer) seconds and is delivered
+    exposure + transfer * (1 +/- transfer_jitter) seconds after it started, stamped with its exposure start on the
+    camera's own tick clock. An exposure that finds no frame queued is lost, and dropped_frame_rate of the rest arrive
+    marked incomplete. Frame callbacks run on the acquisition thread, as they do on the Vimba transport thread.
+
+    The pixels are cropped out of the plate image at view_position, or cycle through a few synthetic wells when there
+    is no plate image. If view_position_function is set it is called with each frame's exposure start time and gives
+    the view position instead, which is how a simulated stage moves the view around the plate.
+    """
+
+    def __init__(self, camera_id, plate_image_path="", transfer_jitter=0.0, dropped_frame_rate=0.0, seed=None):
+        self.camera_id = camera_id
+        self.transfer_jitter = transfer_jitter
+        self.dropped_frame_rate = dropped_frame_rate
+        self.rng = random.Random(seed)
+
+        # Features, named as on the camera
+        self.Width = 2000
+        self.Height = 2000
+        self.PixelFormat = "BGR8Packed"
+        self.AcquisitionMode = "Continuous"
+        self.ExposureTimeAbs = 360
+        self.StreamBytesPerSecond = 115000000
+        self.GevTimestampTickFrequency = simulated_timestamp_tick_frequency
+        self.GevTimestampValue = 0
+
+        self.plate_image = None
+        if plate_image_path:
+            self.plate_image = cv2.imread(plate_image_path)
+            if self.plate_image is None:
+                print "Could not read simulated camera plate image " + plate_image_path + ", using synthetic wells"
+        self.view_position = (0, 0)  # Top left corner of the view on the plate image, in pixels
+        self.view_position_function = None
+        self.synthetic_wells = []
+
+        self.clock_start_time = time.time()  # Host time at camera tick zero
+
+        self.is_open = False
+        self.is_capturing = False
+        self.is_acquiring = False
+        self.acquisition_thread = None
+        self.next_exposure_start = 0
+
+        self.frames = []
+        self.queued_frames = collections.deque()
+        self.queue_lock = threading.Lock()
+
+        # Statistics
+        self.next_frame_id = 0
+        self.frames_delivered = 0
+        self.frames_incomplete = 0
+        self.frames_lost = 0
+        self.exposure_start_times = {}  # Host exposure start time of recent frames by frame id, to check against
+
+    @property
+    def PayloadSize(self):
+        return self.Width * self.Height * 3
+
+    def openCamera(self):
+        self.is_open = True
+
+    def closeCamera(self):
+        self.stop_acquisition()
+        self.is_capturing = False
+        self.is_open = False
+
+    def getFrame(self):
+        if not self.is_open:
+            raise SimulatedCameraError("Camera " + self.camera_id + " is not open")
+        frame = SimulatedFrame(self)
+        self.frames.append(frame)
+        return frame
+
+    def revokeAllFrames(self):
+        self.flushCaptureQueue()
+        for frame in self.frames:
+            frame.revokeFrame()
+        self.frames = []
+
+    def startCapture(self):
+        if not self.is_open:
+            raise SimulatedCameraError("Camera " + self.camera_id + " is not open")
+        self.is_capturing = True
+
+    def endCapture(self):
+        self.is_capturing = False
+
+    def flushCaptureQueue(self):
+        with self.queue_lock:
+            self.queued_frames.clear()
+
+    def queue_frame(self, frame):
+        if not self.is_capturing:
+            raise SimulatedCameraError("Camera " + self.camera_id + " is not capturing")
+        with self.queue_lock:
+            self.queued_frames.append(frame)
+
+    def runFeatureCommand(self, feature_name):
+        if feature_name == "AcquisitionStart":
+            self.start_acquisition()
+        elif feature_name == "AcquisitionStop":
+            self.stop_acquisition()
+        elif feature_name == "GevTimestampControlLatch":
+            self.GevTimestampValue = self.get_ticks(time.time())
+        else:
+            raise SimulatedCameraError("Unsupported feature command " + feature_name)
+
+    def set_view_position(self, x, y):
+        self.view_position = (int(x), int(y))
+
+    def get_ticks(self, host_time):
+        return int((host_time - self.clock_start_time) * self.GevTimestampTickFrequency)
+
+    def start_acquisition(self):
+        if self.is_acquiring:
+            return
+        self.is_acquiring = True
+        self.acquisition_thread = threading.Thread(target=self.acquisition_run, name="Simulated camera acquisition")
+        self.acquisition_thread.daemon = True
+        self.acquisition_thread.start()
+
+    def stop_acquisition(self):
+        self.is_acquiring = False
+        if self.acquisition_thread and self.acquisition_thread is not threading.current_thread():
+            self.acquisition_thread.join()
+        self.acquisition_thread = None
+
+    def acquisition_run(self):
+        self.next_exposure_start = time.time()
+
+        while self.is_acquiring:
+            exposure_start, receive_time, is_complete = self.get_next_frame_timing()
+
+            frame_id = self.next_frame_id
+            self.next_frame_id += 1
+
+            if not self.sleep_until(exposure_start):
+                break
+            with self.queue_lock:
+                frame = self.queued_frames.popleft() if self.queued_frames else None
+            if frame is None:
+                self.frames_lost += 1  # No buffer to expose into, the camera skips this one
+                continue
+
+            if not self.sleep_until(receive_time):
+                break
+
+            self.deliver_frame(frame, frame_id, exposure_start, is_complete)
+
+    def get_next_frame_timing(self):
+        """ Returns the exposure start and receive host times of the next frame, and whether it will arrive whole. """
+        exposure_seconds = self.ExposureTimeAbs / 1000000.0
+        transfer_seconds = float(self.PayloadSize) / self.StreamBytesPerSecond
+
+        exposure_start = max(self.next_exposure_start, time.time())
+        jitter = self.rng.uniform(-self.transfer_jitter, self.transfer_jitter)
+        receive_time = exposure_start + exposure_seconds + (transfer_seconds * (1 + jitter))
+        self.next_exposure_start = exposure_start + max(exposure_seconds, transfer_seconds)
+
+        return exposure_start, receive_time, self.rng.random() >= self.dropped_frame_rate
+
+    def sleep_until(self, host_time):
+        # Returns False if acquisition was stopped in the meantime
+        wait_seconds = host_time - time.time()
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+        return self.is_acquiring
+
+    def deliver_frame(self, frame, frame_id, exposure_start, is_complete):
+        frame._frame.frameID = frame_id
+        frame._frame.timestamp = self.get_ticks(exposure_start)
+
+        if not is_complete:
+            frame._frame.receiveStatus = simulated_frame_status_incomplete
+            self.frames_incomplete += 1
+        else:
+            frame._frame.receiveStatus = simulated_frame_status_complete
+            self.render_view(frame.get_image_view(), frame_id, exposure_start)
+            self.frames_delivered += 1
+
+            self.exposure_start_times[frame_id] = exposure_start
+            self.exposure_start_times.pop(frame_id - 1000, None)
+
+        if frame.frame_callback:
+            frame.frame_callback(frame)
+
+    def render_view(self, image_view, frame_id, exposure_start):
+        y_size, x_size = image_view.shape[:2]
+
+        if self.plate_image is None:
+            if not self.synthetic_wells or self.synthetic_wells[0].shape[:2] != (y_size, x_size):
+                self.synthetic_wells = [make_synthetic_well(x_size, y_size, seed)
+                                        for seed in range(simulated_synthetic_well_count)]
+            image_view[:] = self.synthetic_wells[frame_id % len(self.synthetic_wells)]
+            return
+
+        # Crop the view out of the plate image, black wherever it hangs off the edge
+        if self.view_position_function:
+            x, y = [int(position) for position in self.view_position_function(exposure_start)]
+        else:
+            x, y = self.view_position
+        plate_y_size, plate_x_size = self.plate_image.shape[:2]
+        source_x_start, source_y_start = max(0, x), max(0, y)
+        source_x_end, source_y_end = min(x + x_size, plate_x_size), min(y + y_size, plate_y_size)
+
+        if (source_x_end <= source_x_start) or (source_y_end <= source_y_start):
+            image_view[:] = 0
+            return
+
+        if (source_x_end - source_x_start, source_y_end - source_y_start) != (x_size, y_size):
+            image_view[:] = 0
+        image_view[source_y_start - y:source_y_end - y, source_x_start - x:source_x_end - x] = \
+            self.plate_image[source_y_start:source_y_end, source_x_start:source_x_end]
+
+
+#####################################
+# ReplayCamera Class Definition
+#####################################
+class ReplayCamera(SimulatedCamera):
+    """ A SimulatedCamera that streams the frames of a capture trace instead of modelling the timing.
+
+    Frames are exposed and received at the recorded times, divided by speed, and arrive incomplete where the recorded
+    ones did. The pixels are the recorded well image of the well set with set_current_well() when the frame's
+    exposure started, synthetic if the trace has none for it. The recording loops if the replay outlasts it.
+    """
+
+    def __init__(self, camera_id, capture_trace, speed=1.0):
+        SimulatedCamera.__init__(self, camera_id)
+        self.capture_trace = capture_trace
+        self.speed = float(speed)
+
+        self.well_name_changes = collections.deque(maxlen=16)  # (host time, well name), oldest first
+        self.well_image_name = None
+        self.well_image = None
+
+        self.replay_frame_number = 0
+        self.replay_start_time = None
+
+    def start_acquisition(self):
+        self.replay_start_time = None  # Picks up where it left off, from whenever acquisition starts again
+        SimulatedCamera.start_acquisition(self)
+
+    def get_next_frame_timing(self):
+        loop, frame_number = divmod(self.replay_frame_number, len(self.capture_trace.frames))
+        self.replay_frame_number += 1
+
+        frame_id, exposure_start, receive_time, is_complete = self.capture_trace.frames[frame_number]
+        loop_offset = (loop * self.capture_trace.duration) - self.capture_trace.frames[0][1]
+        if self.replay_start_time is None:
+            self.replay_start_time = time.time() - ((exposure_start + loop_offset) / self.speed)
+
+        # Decode the latest well's image now, while waiting for the exposure, so it doesn't hold up the delivery
+        if self.well_name_changes:
+            self.update_well_image(self.well_name_changes[-1][1])
+
+        return (self.replay_start_time + ((exposure_start + loop_offset) / self.speed),
+                self.replay_start_time + ((receive_time + loop_offset) / self.speed), bool(is_complete))
+
+    def set_current_well(self, well_name):
+        self.well_name_changes.append((time.time(), well_name))
+
+    def get_well_name_at(self, host_time):
+        well_name = None
+        for change_time, changed_well_name in list(self.well_name_changes):
+            if change_time > host_time:
+                break
+            well_name = changed_well_name
+        return well_name
+
+    def update_well_image(self, well_name):
+        if well_name != self.well_image_name:
+            self.well_image = self.capture_trace.get_well_image(well_name)
+            self.well_image_name = well_name
+
+    def render_view(self, image_view, frame_id, exposure_start):
+        self.update_well_image(self.get_well_name_at(exposure_start))
+        if (self.well_image is None) or (self.well_image.shape != image_view.shape):
+            SimulatedCamera.render_view(self, image_view, frame_id, exposure_start)
+        else:
+            image_view[:] = self.well_image
@@ -32,9 +32,12 @@ __status__ = "Development"
 #####################################
 # Python native imports
 from PyQt4 import QtCore, QtGui
+import time
 
 # Custom imports
 import settings
+import threadEvents
+import timelineTracer
 
 #####################################
 # Global Variables
@@ -51,7 +54,7 @@ class CaptureCoordinator(QtCore.QThread):
     done_percentage_changed_signal = QtCore.pyqtSignal(int)
 
     request_microscope_move_signal = QtCore.pyqtSignal(int, int)
-    request_camera_image_signal = QtCore.pyqtSignal()
+    request_camera_image_signal = QtCore.pyqtSignal(float)
 
     def __init__(self, parent):
         QtCore.QThread.__init__(self)
@@ -60,12 +63,13 @@ class CaptureCoordinator(QtCore.QThread):
 
         self.settings = settings.program_settings
 
-        self.temp_well_QImage = None
+        # Events used to hand work between threads without polling
+        self.wake_event = threadEvents.ThreadEvent("Capture Coordinator wake")
+        self.move_complete_event = threadEvents.ThreadEvent("Stage move complete")
+        self.image_ready_event = threadEvents.ThreadEvent("Well image ready")
+        self.power_cycle_done_event = threadEvents.ThreadEvent("XY power cycle done")
 
-        # Special flags used to make sure threads don't have race conditions
-        self.is_move_complete = False
-        self.is_image_ready = False
-        self.xy_done_power_cycling = True
+        self.move_complete_time = time.time()
         self.stop_pressed = False
 
 
@@ -91,12 +95,15 @@ class CaptureCoordinator(QtCore.QThread):
         self.coordinated_cycle_stop.connect(self.master.ip.on_coordinated_cycle_stop_slot)
 
         # Microscope connections
-        self.request_microscope_move_signal.connect(self.master.mi.on_well_capture_move_requested_slot)
-        self.master.mi.desired_move_complete.connect(self.on_move_complete_signal_slot)
+        # Direct connections so the handoffs don't have to wait their turn in the gui event loop
+        self.request_microscope_move_signal.connect(self.master.mi.on_well_capture_move_requested_slot,
+                                                    QtCore.Qt.DirectConnection)
+        self.master.mi.desired_move_complete.connect(self.on_move_complete_signal_slot, QtCore.Qt.DirectConnection)
 
         # Camera connections
-        self.request_camera_image_signal.connect(self.master.ip.on_well_image_request_signal_slot)
-        self.master.ip.well_image_ready_signal.connect(self.on_image_ready_signal_slot)
+        self.request_camera_image_signal.connect(self.master.ip.on_well_image_request_signal_slot,
+                                                 QtCore.Qt.DirectConnection)
+        self.master.ip.well_image_ready_signal.connect(self.on_image_ready_signal_slot, QtCore.Qt.DirectConnection)
 
 # TODO: Add checks for whether camera is connected
 # TODO: Add checks for whether microscope is connected
@@ -106,6 +113,8 @@ class CaptureCoordinator(QtCore.QThread):
 # TODO: Add signal / slot combos for getting images during well plate cycle (Use mutex so it isn't changed when copying)
 
     def run(self):
+        timelineTracer.name_current_thread("Capture Coordinator")
+
         while self.not_abort:
             if self.pre_run_check_flag:
                 self.pre_run_check_flag = False
@@ -119,8 +128,11 @@ class CaptureCoordinator(QtCore.QThread):
                 self.well_capture_run()
                 # self.well_capture_run_flag = False
 
-            self.msleep(100)
+            else:
+                self.wake_event.wait()  # Nothing to do until a button press or exit wakes us
 
+        for event in [self.wake_event, self.move_complete_event, self.image_ready_event, self.power_cycle_done_event]:
+            print event.get_statistics_string()
         print "Capture Coordinator Thread Exiting..."
 
     def pre_run_check(self):
@@ -134,62 +146,77 @@ class CaptureCoordinator(QtCore.QThread):
             print "Enter plate ID"
             return
 
+        timelineTracer.timeline.start_plate(str(self.settings.plate_id))
+
+        self.power_cycle_done_event.clear()
+        self.move_complete_event.clear()
         self.coordinated_cycle_start.emit()  # Tell all threads that we're starting
-        self.xy_done_power_cycling = False
-        self.is_move_complete = False
 
-        while not self.xy_done_power_cycling:
-            self.msleep(50)
+        with timelineTracer.timeline.span("Power cycle wait"):
+            self.wait_for_event(self.power_cycle_done_event)
 
-        if self.stop_pressed:
+        if self.stop_pressed or not self.not_abort:
             self.well_capture_run_flag = False
             return
 
-        while not self.is_move_complete:
-            self.msleep(50)
-
-        self.msleep(self.settings.image_stabilization_delay)
+        self.wait_for_event(self.move_complete_event)
 
         self.make_well_image_request()
 
         for i in range(0, 95, 1):
-            if self.stop_pressed:
+            if self.stop_pressed or not self.not_abort:
                 break
             self.make_move_request(0, 0)
             self.make_well_image_request()
             self.done_percentage_changed_signal.emit((i/96.0)*100)
-            self.msleep(self.settings.image_stabilization_delay)
         self.done_percentage_changed_signal.emit(100)
         self.coordinated_cycle_stop.emit()
         self.well_capture_run_flag = False
 
     def make_well_image_request(self):
-        self.is_image_ready = False
-        self.request_camera_image_signal.emit()  # Tell the image processing thread to store a well image
-        while not self.is_image_ready:
-            self.msleep(10)
-        self.temp_well_QImage = self.master.ip.full_well_QImage  # Copy that image here
+        self.image_ready_event.clear()
+        # Tell the image processing thread to store a well image exposed once the stage has stabilized. It answers
+        # as soon as the frame is in, encoding and stitching carry on in the background while we move on.
+        not_before_time = self.move_complete_time + (self.settings.image_stabilization_delay / 1000.0)
+        timelineTracer.timeline.add_span("Settle delay", self.move_complete_time, not_before_time, track="Stage")
+
+        with timelineTracer.timeline.span("Well image request"):
+            self.request_camera_image_signal.emit(not_before_time)
+            self.wait_for_event(self.image_ready_event)
 
     def make_move_request(self, x, y):
-        self.is_move_complete = False
-        self.request_microscope_move_signal.emit(x, y)
-        while not self.is_move_complete:
-            self.msleep(10)
+        with timelineTracer.timeline.span("Move request"):
+            self.move_complete_event.clear()
+            self.request_microscope_move_signal.emit(x, y)
+            self.wait_for_event(self.move_complete_event)
+
+    def wait_for_event(self, event):
+        # The timeout is only there so an application exit can never leave this thread stuck
+        while self.not_abort and not event.wait(500):
+            pass
 
-    def on_move_complete_signal_slot(self):
-        self.is_move_complete = True
+    def on_move_complete_signal_slot(self, move_complete_time):
+        self.move_complete_time = move_complete_time
+        self.move_complete_event.set()
 
     def on_image_ready_signal_slot(self):
-        self.is_image_ready = True
+        self.image_ready_event.set()
 
     def on_capture_button_pressed(self):
         self.pre_run_check_flag = True
+        self.wake_event.set()
 
     def on_application_exiting_slot(self):
         self.not_abort = False
 
+        # Release anything still waiting so the thread can finish
+        self.wake_event.set()
+        self.move_complete_event.set()
+        self.image_ready_event.set()
+        self.power_cycle_done_event.set()
+
     def on_message_box_done_signal_slot(self):
-        self.xy_done_power_cycling = True
+        self.power_cycle_done_event.set()
 
     def on_stop_capture_button_clicked_slot(self):
         self.stop_pressed = True
\ No newline at end of file
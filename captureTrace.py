@@ -0,0 +1,285 @@
+"""
+    This file contains the capture trace classes
+    These classes record a plate run's camera frames, stage moves and well names to a trace file and read it back so
+    the replay camera and stage backends can play the run through the capture pipeline again
+"""
+
+
+__author__ = "Corwin Perren"
+__copyright__ = "None"
+__credits__ = [""]
+__license__ = "GPL (GNU General Public License)"
+__version__ = "1.0.0"
+__maintainer__ = "Corwin Perren"
+__email__ = "perrenc@onid.oregonstate.edu"
+__status__ = "Development"
+
+# This file is part of Auto Imager.
+#
+# Auto Imager is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Auto Imager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Auto Imager.  If not, see <http://www.gnu.org/licenses/>.
+
+
+#####################################
+# Imports
+#####################################
+# Python native imports
+from PyQt4 import QtCore
+import os
+import json
+import struct
+import threading
+import time
+import zlib
+import numpy as np
+
+# Custom imports
+import settings
+import pipelineWorkers
+
+#####################################
+# Global Variables
+#####################################
+trace_signature = "AITRACE1"
+trace_footer_format = ">Q"  # Offset of the index at the very end of the file
+trace_version = 1
+trace_extension = ".trace"
+
+well_frame_compression_level = 1  # Fast enough to keep up with the capture loop, raw frames compress well anyway
+
+
+#####################################
+# CaptureTraceWriter Class Definition
+#####################################
+class CaptureTraceWriter(object):
+    """ Writes a capture trace file.
+
+    The file is the signature, the well frames as zlib compressed raw BGR pixels one after another, then a JSON index
+    of everything else and finally the offset of that index. Frame and move times are in seconds from the start of
+    the trace, so a trace recorded at any time of day replays the same way.
+    """
+
+    def __init__(self, path, plate_id, start_time):
+        self.path = path
+        self.plate_id = plate_id
+        self.start_time = start_time
+
+        self.frames = []  # [frame id, exposure start, receive time, 1 if complete else 0]
+        self.moves = []  # [move requested, move complete, well name]
+        self.well_frames = {}  # Well name: [frame id, offset, length, height, width, channels]
+
+        self.trace_lock = threading.Lock()
+        self.trace_file = open(path, "wb")
+        self.trace_file.write(trace_signature)
+
+    def add_frame(self, frame_id, exposure_start_time, receive_time, is_complete):
+        with self.trace_lock:
+            self.frames.append([frame_id, round(exposure_start_time - self.start_time, 6),
+                                round(receive_time - self.start_time, 6), int(is_complete)])
+
+    def add_move(self, move_requested_time, move_complete_time, well_name):
+        with self.trace_lock:
+            self.moves.append([round(move_requested_time - self.start_time, 6),
+                               round(move_complete_time - self.start_time, 6), well_name])
+
+    def add_well_frame(self, well_name, frame_id, bgr_image):
+        compressed = zlib.compress(np.ascontiguousarray(bgr_image).tostring(), well_frame_compression_level)
+        height, width, channels = bgr_image.shape
+
+        with self.trace_lock:
+            offset = self.trace_file.tell()
+            self.trace_file.write(compressed)
+            self.well_frames[well_name] = [frame_id, offset, len(compressed), height, width, channels]
+
+    def close(self):
+        with self.trace_lock:
+            index = {
+                "version": trace_version,
+                "plate_id": self.plate_id,
+                "frames": self.frames,
+                "moves": self.moves,
+                "well_frames": self.well_frames
+            }
+
+            index_offset = self.trace_file.tell()
+            self.trace_file.write(json.dumps(index, separators=(",", ":")))
+            self.trace_file.write(struct.pack(trace_footer_format, index_offset))
+            self.trace_file.close()
+
+
+#####################################
+# CaptureTrace Class Definition
+#####################################
+class CaptureTrace(object):
+    """ A capture trace read back from disk. Well frames stay on disk until get_well_image() asks for one. """
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, "rb") as trace_file:
+            if trace_file.read(len(trace_signature)) != trace_signature:
+                raise IOError(path + " is not a capture trace")
+
+            footer_size = struct.calcsize(trace_footer_format)
+            trace_file.seek(-footer_size, os.SEEK_END)
+            index_end = trace_file.tell()
+            index_offset = struct.unpack(trace_footer_format, trace_file.read(footer_size))[0]
+
+            trace_file.seek(index_offset)
+            index = json.loads(trace_file.read(index_end - index_offset))
+
+        if index["version"] != trace_version:
+            raise IOError(path + " is capture trace version " + str(index["version"]))
+
+        self.plate_id = index["plate_id"]
+        self.frames = index["frames"]
+        self.moves = index["moves"]
+        self.well_frames = index["well_frames"]
+
+        if not self.frames:
+            raise IOError(path + " has no frames in it")
+
+        # Time from the first exposure until the stream would have started over, one average frame period after the
+        # last exposure, so the frames can be looped for a replay that outlasts the recording
+        first_exposure, last_exposure = self.frames[0][1], self.frames[-1][1]
+        frame_count = len(self.frames)
+        self.frame_period = ((last_exposure - first_exposure) / (frame_count - 1)) if frame_count > 1 else 0.1
+        self.duration = (last_exposure - first_exposure) + self.frame_period
+
+    def get_well_image(self, well_name):
+        """ Returns the recorded BGR frame for well_name, or None if the trace doesn't have one for it. """
+        well_frame = self.well_frames.get(well_name)
+        if well_frame is None:
+            return None
+
+        frame_id, offset, length, height, width, channels = well_frame
+        with open(self.path, "rb") as trace_file:
+            trace_file.seek(offset)
+            pixels = zlib.decompress(trace_file.read(length))
+        return np.frombuffer(pixels, np.uint8).reshape(height, width, channels)
+
+    def get_move_seconds(self, move_number):
+        move_requested_time, move_complete_time, well_name = self.moves[move_number % len(self.moves)]
+        return move_complete_time - move_requested_time
+
+
+#####################################
+# CaptureTraceRecorder Class Definition
+#####################################
+class CaptureTraceRecorder(QtCore.QObject):
+    """ Records every plate run to its own trace file under capture_trace_path.
+
+    Every frame that arrives from the camera goes in with its exposure start and receive times, as do the time each
+    stage move was requested and completed and the well it moved to. The well images themselves are compressed and
+    written by a background stage so recording doesn't slow the capture loop down.
+    """
+
+    def __init__(self, parent):
+        QtCore.QObject.__init__(self)
+
+        self.master = parent
+
+        self.settings = settings.program_settings
+
+        self.trace_writer = None
+        self.move_requested_time = None
+        self.well_name = "A1"
+
+        self.well_frame_stage = pipelineWorkers.PipelineStage("Capture trace writer", self.write_well_frame, 1,
+                                                              self.settings.well_pipeline_queue_size)
+
+        self.connect_signals_to_slots()
+
+    def connect_signals_to_slots(self):
+        self.master.application_exiting_signal.connect(self.on_application_exiting_slot)
+
+        # Direct so every event is stamped on the thread it happened on, as it happened
+        self.master.cc.coordinated_cycle_start.connect(self.on_coordinated_cycle_start_slot, QtCore.Qt.DirectConnection)
+        self.master.cc.coordinated_cycle_stop.connect(self.on_coordinated_cycle_stop_slot, QtCore.Qt.DirectConnection)
+        self.master.cc.request_microscope_move_signal.connect(self.on_move_requested_slot, QtCore.Qt.DirectConnection)
+        self.master.mi.output_name_changed_signal.connect(self.on_well_name_changed_slot, QtCore.Qt.DirectConnection)
+        self.master.mi.desired_move_complete.connect(self.on_move_complete_slot, QtCore.Qt.DirectConnection)
+
+        self.master.ip.add_frame_callback(self.on_frame_received)
+        self.master.ip.add_well_frame_callback(self.on_well_frame_taken)
+
+    def start_trace(self):
+        self.finish_trace()
+
+        if not os.path.isdir(self.settings.capture_trace_path):
+            os.makedirs(self.settings.capture_trace_path)
+
+        plate_id = str(self.settings.plate_id)
+        trace_path = self.settings.capture_trace_path + "\\" + plate_id + "_" + time.strftime("%Y%m%d_%H%M%S") + \
+            trace_extension
+
+        self.move_requested_time = None
+        self.well_name = "A1"
+        try:
+            self.trace_writer = CaptureTraceWriter(trace_path, plate_id, time.time())
+        except IOError, e:
+            print "Could not start capture trace " + trace_path + ": " + str(e)
+
+    def finish_trace(self):
+        trace_writer = self.trace_writer
+        if trace_writer is None:
+            return
+
+        self.well_frame_stage.join()  # Every well frame has to be in the file before the index goes after them
+        self.trace_writer = None
+        try:
+            trace_writer.close()
+            print "Capture trace saved to " + trace_writer.path
+        except IOError, e:
+            print "Could not finish capture trace " + trace_writer.path + ": " + str(e)
+
+    def on_frame_received(self, captured_frame, is_complete):
+        # Runs on the camera's transport thread
+        trace_writer = self.trace_writer
+        if trace_writer:
+            trace_writer.add_frame(captured_frame.frame_id, captured_frame.exposure_start_time,
+                                   captured_frame.receive_time, is_complete)
+
+    def on_well_frame_taken(self, well_name, frame_id, bgr_image):
+        # Runs on the image processor thread, blocks if the writer has fallen behind
+        if self.trace_writer:
+            self.well_frame_stage.submit(self.trace_writer, well_name, frame_id, bgr_image)
+
+    def write_well_frame(self, trace_writer, well_name, frame_id, bgr_image):
+        try:
+            trace_writer.add_well_frame(well_name, frame_id, bgr_image)
+        except (IOError, ValueError), e:
+            print "Could not write " + well_name + " to capture trace " + trace_writer.path + ": " + str(e)
+
+    def on_coordinated_cycle_start_slot(self):
+        self.start_trace()
+
+    def on_coordinated_cycle_stop_slot(self):
+        self.finish_trace()
+
+    def on_move_requested_slot(self, x, y):
+        self.move_requested_time = time.time()
+
+    def on_well_name_changed_slot(self, name):
+        self.well_name = str(name)
+
+    def on_move_complete_slot(self, move_complete_time):
+        # Moves nobody requested, like the return to A1 after the XY power cycle, aren't part of the well path
+        trace_writer = self.trace_writer
+        if trace_writer and (self.move_requested_time is not None):
+            trace_writer.add_move(self.move_requested_time, move_complete_time, self.well_name)
+        self.move_requested_time = None
+
+    def on_application_exiting_slot(self):
+        self.finish_trace()
+        self.well_frame_stage.stop()
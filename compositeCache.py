@@ -0,0 +1,160 @@
+"""
+    This file contains the composite cache class
+    This class remembers which well image files a composite was built from, so unchanged plates can be skipped
+"""
+
+
+__author__ = "Corwin Perren"
+__copyright__ = "None"
+__credits__ = [""]
+__license__ = "GPL (GNU General Public License)"
+__version__ = "1.0.0"
+__maintainer__ = "Corwin Perren"
+__email__ = "perrenc@onid.oregonstate.edu"
+__status__ = "Development"
+
+# This file is part of Auto Imager.
+#
+# Auto Imager is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Auto Imager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Auto Imager.  If not, see <http://www.gnu.org/licenses/>.
+
+
+#####################################
+# Imports
+#####################################
+# Python native imports
+import os
+import json
+import cv2
+
+# Custom imports
+import wellImageWriter
+
+#####################################
+# Global Variables
+#####################################
+composite_cache_filename = "composite_cache.json"
+composite_preview_filename = "composite_preview.png"
+cache_version = 1
+
+
+#####################################
+# Helper Functions
+#####################################
+def get_well_fingerprints(well_images):
+    """ Returns {well name: [size in bytes, modification time]} for a list of (well name, path) pairs. """
+    well_fingerprints = {}
+    for well_name, image_path in well_images:
+        file_stat = os.stat(image_path)
+        well_fingerprints[well_name] = [file_stat.st_size, file_stat.st_mtime]
+    return well_fingerprints
+
+
+def get_layout(program_settings):
+    # Everything that decides where wells land and what gets written, changing any of it means a full rebuild
+    return {
+        "stitched_x_size": program_settings.stitched_x_size,
+        "stitched_y_size": program_settings.stitched_y_size,
+        "stitch_offset_x": program_settings.stitch_offset_x,
+        "stitch_offset_y": program_settings.stitch_offset_y,
+        "output_mode": program_settings.composite_output_mode,
+        "tile_size": program_settings.composite_tile_size,
+        "tile_extension": program_settings.composite_tile_extension
+    }
+
+
+#####################################
+# CompositeCache Class Definition
+#####################################
+class CompositeCache(object):
+    """ What the composite in one composite folder was built from, stored next to it as composite_cache.json.
+
+    Each well is fingerprinted by the size and modification time of its file, and also keeps the size of the image
+    that was pasted so the area it covered is known when it changes or disappears. A copy of the finished preview is
+    kept too, so a skipped plate still has something to show. invalidate() must be called before the composite is
+    touched, so a build that never finishes always leads to a full rebuild.
+    """
+
+    def __init__(self, composite_path):
+        self.cache_path = composite_path + "\\" + composite_cache_filename
+        self.preview_path = composite_path + "\\" + composite_preview_filename
+
+        self.layout = None
+        self.wells = {}  # well name -> {"fingerprint": [bytes, mtime], "width": pixels, "height": pixels}
+
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.cache_path, "r") as cache_file:
+                saved_cache = json.load(cache_file)
+        except (IOError, ValueError):
+            return
+
+        if saved_cache.get("version") != cache_version:
+            return
+
+        self.layout = saved_cache["layout"]
+        self.wells = saved_cache["wells"]
+
+    def invalidate(self):
+        if os.path.isfile(self.cache_path):
+            os.remove(self.cache_path)
+
+    def save(self, layout, well_fingerprints, well_sizes):
+        self.layout = layout
+        self.wells = {}
+        for well_name, fingerprint in well_fingerprints.items():
+            width, height = well_sizes[well_name]
+            self.wells[well_name] = {"fingerprint": fingerprint, "width": width, "height": height}
+
+        temp_path = self.cache_path + ".tmp"
+        with open(temp_path, "w") as cache_file:
+            json.dump({"version": cache_version, "layout": self.layout, "wells": self.wells}, cache_file)
+        wellImageWriter.replace_file(temp_path, self.cache_path)
+
+    def get_changed_well_names(self, layout, well_fingerprints):
+        """ Returns the wells that were added, removed or rewritten since the cache was saved.
+
+        Returns None if there is no cache or it was saved with a different layout, as then nothing can be reused.
+        """
+        if (self.layout is None) or (self.layout != layout):
+            return None
+
+        changed_well_names = set(self.wells.keys()) ^ set(well_fingerprints.keys())
+        for well_name, fingerprint in well_fingerprints.items():
+            if (well_name in self.wells) and (self.wells[well_name]["fingerprint"] != fingerprint):
+                changed_well_names.add(well_name)
+        return changed_well_names
+
+    def is_up_to_date(self, layout, well_fingerprints):
+        return self.get_changed_well_names(layout, well_fingerprints) == set()
+
+    def get_well_size(self, well_name):
+        # (width, height) of the image pasted for this well last time, or None if it wasn't there
+        well = self.wells.get(well_name)
+        if not well:
+            return None
+        return well["width"], well["height"]
+
+    def load_preview(self):
+        try:
+            return cv2.cvtColor(wellImageWriter.load_well_image(self.preview_path), cv2.COLOR_BGR2RGB)
+        except (IOError, ValueError):
+            return None
+
+    def save_preview(self, preview_raw_data):
+        ret, encoded = cv2.imencode(".png", cv2.cvtColor(preview_raw_data, cv2.COLOR_RGB2BGR))
+        with open(self.preview_path + ".tmp", "wb") as preview_file:
+            preview_file.write(encoded.tostring())
+        wellImageWriter.replace_file(self.preview_path + ".tmp", self.preview_path)
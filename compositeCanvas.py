@@ -0,0 +1,142 @@
+"""
+    This file contains the composite canvas class
+    This class holds the full resolution plate composite either in RAM or memory mapped from a file on local disk
+"""
+
+__author__ = "Corwin Perren"
+__copyright__ = "None"
+__credits__ = [""]
+__license__ = "GPL (GNU General Public License)"
+__version__ = "1.0.0"
+__maintainer__ = "Corwin Perren"
+__email__ = "perrenc@onid.oregonstate.edu"
+__status__ = "Development"
+
+# This file is part of Auto Imager.
+#
+# Auto Imager is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Auto Imager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Auto Imager.  If not, see <http://www.gnu.org/licenses/>.
+
+#####################################
+# Imports
+#####################################
+# Python native imports
+import os
+import tempfile
+import numpy as np
+
+# Custom imports
+import settings
+import compositeEncoder
+
+#####################################
+# Global Variables
+#####################################
+canvas_backend_memory = "memory"
+canvas_backend_memmap = "memmap"
+
+clear_band_rows = 512
+
+
+#####################################
+# CompositeCanvas Class Definition
+#####################################
+class CompositeCanvas(object):
+    """ Full resolution RGB composite that wells are pasted into by direct slice assignment.
+
+    With the "memmap" backend the pixels live in a file under composite_canvas_temp_path and the OS pages them in and
+    out as needed, so a plate sized canvas doesn't have to fit in RAM. The "memory" backend is a plain numpy array.
+    """
+
+    def __init__(self, x_size, y_size, backend=None, temp_prefix="composite_"):
+        self.settings = settings.program_settings
+
+        self.x_size = x_size
+        self.y_size = y_size
+
+        self.backend = backend or self.settings.composite_canvas_backend
+        self.temp_prefix = temp_prefix
+        self.memmap_path = None
+
+        self.canvas_raw_data = None
+        self.allocate()
+
+    def allocate(self):
+        if self.backend == canvas_backend_memmap:
+            if not os.path.isdir(self.settings.composite_canvas_temp_path):
+                os.makedirs(self.settings.composite_canvas_temp_path)
+            file_handle, self.memmap_path = tempfile.mkstemp(".canvas", self.temp_prefix,
+                                                             self.settings.composite_canvas_temp_path)
+            os.close(file_handle)
+            # A freshly created map starts out zeroed, which is the black background we want
+            self.canvas_raw_data = np.memmap(self.memmap_path, dtype=np.uint8, mode="w+",
+                                             shape=(self.y_size, self.x_size, 3))
+        else:
+            self.canvas_raw_data = np.zeros((self.y_size, self.x_size, 3), np.uint8)
+
+    def clear(self):
+        if self.backend == canvas_backend_memmap:
+            # Starting a new file is cheaper than writing zeros over the whole old one
+            self.close()
+            self.allocate()
+        else:
+            for band_start in range(0, self.y_size, clear_band_rows):
+                self.canvas_raw_data[band_start:band_start + clear_band_rows] = 0
+
+    def close(self):
+        self.canvas_raw_data = None  # Drops the map so the file can be removed on windows
+        if self.memmap_path:
+            try:
+                os.remove(self.memmap_path)
+            except OSError, e:
+                print "Could not remove composite canvas file " + self.memmap_path + ": " + str(e)
+            self.memmap_path = None
+
+    def clear_region(self, x, y, x_size, y_size):
+        self.read_region(x, y, x_size, y_size)[:] = 0
+
+    def paste_well(self, image, position, is_bgr=False):
+        x, y = position
+        well_y_size, well_x_size = image.shape[:2]
+
+        # Clip anything that hangs off the edge of the canvas
+        x_end = min(x + well_x_size, self.x_size)
+        y_end = min(y + well_y_size, self.y_size)
+        if (x_end <= x) or (y_end <= y):
+            return
+
+        source = image[:y_end - y, :x_end - x, :3]
+        if is_bgr:
+            source = source[:, :, ::-1]  # Reversed view, the assignment below does the only copy
+
+        self.canvas_raw_data[y:y_end, x:x_end] = source
+
+    def read_region(self, x, y, x_size, y_size):
+        """ Returns a view of the canvas region, clipped to the canvas. """
+        return self.canvas_raw_data[max(0, y):min(y + y_size, self.y_size), max(0, x):min(x + x_size, self.x_size)]
+
+    def load_png(self, path):
+        """ Reads a composite written by save_png back in. Returns False if it doesn't fit this canvas. """
+        return compositeEncoder.read_png_into_array(path, self.canvas_raw_data)
+
+    def save_png(self, path, worker_count=None):
+        # Pool processes can't start pools of their own, so callers running in one pass worker_count=1
+        if worker_count is None:
+            worker_count = self.settings.composite_encoder_worker_count
+
+        if worker_count > 1:
+            if self.backend == canvas_backend_memmap:
+                self.canvas_raw_data.flush()  # Workers read the file, make sure they see everything pasted so far
+            compositeEncoder.save_array_as_png_parallel(self.canvas_raw_data, path, worker_count, self.memmap_path)
+        else:
+            compositeEncoder.save_array_as_png(self.canvas_raw_data, path)
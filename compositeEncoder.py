@@ -0,0 +1,255 @@
+"""
+    This file contains the composite encoder functions
+    These write very large composite arrays out as PNG files a band of rows at a time, optionally in parallel, and
+    read them back the same way
+"""
+
+__author__ = "Corwin Perren"
+__copyright__ = "None"
+__credits__ = [""]
+__license__ = "GPL (GNU General Public License)"
+__version__ = "1.0.0"
+__maintainer__ = "Corwin Perren"
+__email__ = "perrenc@onid.oregonstate.edu"
+__status__ = "Development"
+
+# This file is part of Auto Imager.
+#
+# Auto Imager is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Auto Imager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Auto Imager.  If not, see <http://www.gnu.org/licenses/>.
+
+#####################################
+# Imports
+#####################################
+# Python native imports
+import struct
+import zlib
+import multiprocessing
+import numpy as np
+
+#####################################
+# Global Variables
+#####################################
+png_signature = "\x89PNG\r\n\x1a\n"
+png_filter_none = 0
+png_filter_sub = 1
+zlib_stream_header = "\x78\x9c"  # Deflate with a 32K window, no preset dictionary
+adler32_base = 65521
+
+default_band_rows = 256
+default_compression_level = 6
+
+
+#####################################
+# PNG Helper Functions
+#####################################
+def make_png_chunk(chunk_type, chunk_data):
+    crc = zlib.crc32(chunk_type)
+    crc = zlib.crc32(chunk_data, crc) & 0xffffffff
+    return struct.pack(">I", len(chunk_data)) + chunk_type + chunk_data + struct.pack(">I", crc)
+
+
+def make_png_header(x_size, y_size):
+    # 8 bits per channel, color type 2 (RGB), deflate, adaptive filtering, no interlacing
+    return png_signature + make_png_chunk("IHDR", struct.pack(">IIBBBBB", x_size, y_size, 8, 2, 0, 0, 0))
+
+
+def filter_rows(rgb_rows):
+    """ Returns the PNG scanline bytes for a band of RGB rows using the Sub filter.
+
+    Sub only looks at the pixel to the left, so any band can be filtered without knowing about the rows above it.
+    """
+    rows, columns = rgb_rows.shape[:2]
+    row_bytes = rgb_rows.reshape(rows, columns * 3)
+
+    filtered = np.empty((rows, (columns * 3) + 1), np.uint8)
+    filtered[:, 0] = png_filter_sub
+    filtered[:, 1:4] = row_bytes[:, :3]
+    np.subtract(row_bytes[:, 3:], row_bytes[:, :-3], out=filtered[:, 4:])  # Wraps modulo 256 like PNG expects
+    return filtered.tostring()
+
+
+def unfilter_rows(filtered_rows, rgb_rows):
+    """ Undoes filter_rows for a band of PNG scanlines into rgb_rows. Returns False if a row uses another filter. """
+    rows = filtered_rows.shape[0]
+    filter_types = filtered_rows[:, 0]
+    row_bytes = filtered_rows[:, 1:].reshape(rows, -1, 3)
+
+    if np.all(filter_types == png_filter_sub):
+        np.cumsum(row_bytes, axis=1, dtype=np.uint8, out=rgb_rows)  # Wraps modulo 256, undoing the subtraction
+        return True
+
+    for row in range(rows):
+        if filter_types[row] == png_filter_sub:
+            np.cumsum(row_bytes[row], axis=0, dtype=np.uint8, out=rgb_rows[row])
+        elif filter_types[row] == png_filter_none:
+            rgb_rows[row] = row_bytes[row]
+        else:
+            return False
+    return True
+
+
+def combine_adler32(first_adler, second_adler, second_length):
+    """ Port of zlib's adler32_combine, the checksum of two buffers back to back from their separate checksums. """
+    remainder = second_length % adler32_base
+    sum_one = first_adler & 0xffff
+    sum_two = (remainder * sum_one) % adler32_base
+    sum_one += (second_adler & 0xffff) + adler32_base - 1
+    sum_two += ((first_adler >> 16) & 0xffff) + ((second_adler >> 16) & 0xffff) + adler32_base - remainder
+    if sum_one >= adler32_base:
+        sum_one -= adler32_base
+    if sum_one >= adler32_base:
+        sum_one -= adler32_base
+    if sum_two >= (adler32_base << 1):
+        sum_two -= (adler32_base << 1)
+    if sum_two >= adler32_base:
+        sum_two -= adler32_base
+    return sum_one | (sum_two << 16)
+
+
+def compress_png_band(band_job):
+    """ Filters and deflates one band of rows for save_array_as_png_parallel. Runs in a pool process.
+
+    The band is compressed as raw deflate and, unless it is the last one, ends on a full flush so it finishes on a
+    byte boundary without depending on earlier bands. Concatenated in order, the bands form one valid deflate stream.
+    """
+    source, band_start, band_end, compression_level, is_last_band = band_job
+
+    if isinstance(source, tuple):
+        # Memory mapped canvas, open it here rather than shipping the pixels between processes
+        memmap_path, shape = source
+        rgb_rows = np.memmap(memmap_path, dtype=np.uint8, mode="r", shape=shape)[band_start:band_end]
+    else:
+        rgb_rows = source
+
+    filtered = filter_rows(rgb_rows)
+    compressor = zlib.compressobj(compression_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    compressed = compressor.compress(filtered)
+    compressed += compressor.flush(zlib.Z_FINISH if is_last_band else zlib.Z_FULL_FLUSH)
+
+    return compressed, zlib.adler32(filtered) & 0xffffffff, len(filtered)
+
+
+#####################################
+# PNG Writing Functions
+#####################################
+def save_array_as_png(rgb_array, path, band_rows=default_band_rows, compression_level=default_compression_level):
+    """ Writes an RGB uint8 array (in memory or memory mapped) to a PNG a band of rows at a time.
+
+    Only one band of filtered rows is in memory at once, so this works for canvases much larger than RAM.
+    """
+    y_size, x_size = rgb_array.shape[:2]
+    compressor = zlib.compressobj(compression_level)
+
+    with open(path, "wb") as output_file:
+        output_file.write(make_png_header(x_size, y_size))
+
+        for band_start in range(0, y_size, band_rows):
+            compressed = compressor.compress(filter_rows(rgb_array[band_start:band_start + band_rows]))
+            if compressed:
+                output_file.write(make_png_chunk("IDAT", compressed))
+
+        output_file.write(make_png_chunk("IDAT", compressor.flush()))
+        output_file.write(make_png_chunk("IEND", ""))
+
+
+def save_array_as_png_parallel(rgb_array, path, worker_count, memmap_path=None, band_rows=default_band_rows,
+                               compression_level=default_compression_level):
+    """ Same output as save_array_as_png, with the bands filtered and deflated across a pool of processes.
+
+    Pass memmap_path when rgb_array is a memory mapped canvas so workers read their bands straight from the file.
+    Only a couple of bands per worker are in flight at once, and results are written in order as they come back.
+    """
+    y_size, x_size = rgb_array.shape[:2]
+    band_starts = range(0, y_size, band_rows)
+
+    def make_band_job(band_start):
+        band_end = min(band_start + band_rows, y_size)
+        if memmap_path:
+            source = (memmap_path, rgb_array.shape)
+        else:
+            source = np.ascontiguousarray(rgb_array[band_start:band_end])
+        return source, band_start, band_end, compression_level, band_end == y_size
+
+    pool = multiprocessing.Pool(worker_count)
+    try:
+        with open(path, "wb") as output_file:
+            output_file.write(make_png_header(x_size, y_size))
+            output_file.write(make_png_chunk("IDAT", zlib_stream_header))
+
+            stream_adler = 1  # Adler-32 of nothing
+            pending_results = []
+            next_band = 0
+            max_in_flight = worker_count * 2
+
+            while next_band < len(band_starts) or pending_results:
+                while next_band < len(band_starts) and len(pending_results) < max_in_flight:
+                    pending_results.append(pool.apply_async(compress_png_band,
+                                                            (make_band_job(band_starts[next_band]),)))
+                    next_band += 1
+
+                compressed, band_adler, band_length = pending_results.pop(0).get()
+                stream_adler = combine_adler32(stream_adler, band_adler, band_length)
+                output_file.write(make_png_chunk("IDAT", compressed))
+
+            output_file.write(make_png_chunk("IDAT", struct.pack(">I", stream_adler & 0xffffffff)))
+            output_file.write(make_png_chunk("IEND", ""))
+    finally:
+        pool.close()
+        pool.join()
+
+
+#####################################
+# PNG Reading Functions
+#####################################
+def read_png_into_array(path, rgb_array):
+    """ Reads a PNG written by the functions above back into an RGB uint8 array, a chunk at a time.
+
+    Only what they write is understood, 8 bit RGB without interlacing where every row uses the None or Sub filter.
+    Returns False, with rgb_array partly overwritten, for anything else or if the size doesn't match rgb_array.
+    """
+    y_size, x_size = rgb_array.shape[:2]
+    row_length = (x_size * 3) + 1
+
+    decompressor = zlib.decompressobj()
+    unread_data = ""
+    next_row = 0
+
+    with open(path, "rb") as png_file:
+        if png_file.read(len(png_signature)) != png_signature:
+            return False
+
+        while True:
+            chunk_header = png_file.read(8)
+            if len(chunk_header) < 8:
+                return False
+            chunk_length, chunk_type = struct.unpack(">I4s", chunk_header)
+            chunk_data = png_file.read(chunk_length)
+            png_file.read(4)  # CRC, zlib's own checksum already catches a corrupt image stream
+
+            if chunk_type == "IHDR":
+                if struct.unpack(">IIBBBBB", chunk_data) != (x_size, y_size, 8, 2, 0, 0, 0):
+                    return False
+
+            elif chunk_type == "IDAT":
+                unread_data += decompressor.decompress(chunk_data)
+                rows = min(len(unread_data) / row_length, y_size - next_row)
+                if rows:
+                    filtered_rows = np.frombuffer(unread_data[:rows * row_length], np.uint8).reshape(rows, row_length)
+                    if not unfilter_rows(filtered_rows, rgb_array[next_row:next_row + rows]):
+                        return False
+                    unread_data = unread_data[rows * row_length:]
+                    next_row += rows
+
+            elif chunk_type == "IEND":
+                return next_row == y_size
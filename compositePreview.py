@@ -0,0 +1,93 @@
+"""
+    This file contains the composite preview class
+    This class keeps a display resolution copy of a plate composite that is updated one well at a time
+"""
+
+__author__ = "Corwin Perren"
+__copyright__ = "None"
+__credits__ = [""]
+__license__ = "GPL (GNU General Public License)"
+__version__ = "1.0.0"
+__maintainer__ = "Corwin Perren"
+__email__ = "perrenc@onid.oregonstate.edu"
+__status__ = "Development"
+
+# This file is part of Auto Imager.
+#
+# Auto Imager is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Auto Imager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Auto Imager.  If not, see <http://www.gnu.org/licenses/>.
+
+#####################################
+# Imports
+#####################################
+# Python native imports
+import cv2
+import numpy as np
+
+#####################################
+# Global Variables
+#####################################
+preview_x_resolution = 600
+preview_y_resolution = 400
+
+
+#####################################
+# CompositePreview Class Definition
+#####################################
+class CompositePreview(object):
+    """ RGB preview of a composite canvas at display resolution.
+
+    Pasting a well only downsamples that well and writes the part of the preview it covers, so the cost per well
+    stays the same no matter how large the full composite is or how many wells are already on it.
+    """
+
+    def __init__(self, composite_x_size, composite_y_size, x_resolution=preview_x_resolution,
+                 y_resolution=preview_y_resolution):
+        self.composite_x_size = composite_x_size
+        self.composite_y_size = composite_y_size
+
+        self.x_resolution = x_resolution
+        self.y_resolution = y_resolution
+
+        self.x_scale = float(x_resolution) / composite_x_size
+        self.y_scale = float(y_resolution) / composite_y_size
+
+        self.preview_raw_data = np.zeros((y_resolution, x_resolution, 3), np.uint8)
+
+    def clear(self):
+        self.preview_raw_data[:] = 0
+
+    def paste_well(self, image, position, is_bgr=False):
+        """ Pastes a full resolution well image whose top left corner sits at position on the full composite. """
+        well_y_size, well_x_size = image.shape[:2]
+        x, y = position
+
+        x_start = int(round(x * self.x_scale))
+        y_start = int(round(y * self.y_scale))
+        x_end = int(round((x + well_x_size) * self.x_scale))
+        y_end = int(round((y + well_y_size) * self.y_scale))
+
+        if (x_end <= x_start) or (y_end <= y_start):
+            return
+
+        # Subsample to roughly twice the tile size first, area resizing straight down from a full well is slow
+        step = max(1, int(min(float(well_x_size) / (x_end - x_start), float(well_y_size) / (y_end - y_start)) / 2))
+        tile = cv2.resize(image[::step, ::step], (x_end - x_start, y_end - y_start), interpolation=cv2.INTER_AREA)
+        if is_bgr:
+            tile = cv2.cvtColor(tile, cv2.COLOR_BGR2RGB)
+
+        # Clip anything that hangs off the edge of the preview
+        x_clipped_end = min(x_end, self.x_resolution)
+        y_clipped_end = min(y_end, self.y_resolution)
+        self.preview_raw_data[y_start:y_clipped_end, x_start:x_clipped_end] = \
+            tile[:y_clipped_end - y_start, :x_clipped_end - x_start]
@@ -0,0 +1,290 @@
+"""
+    This file contains the disk ledger class
+    This class keeps a persistent record of how much space each plate uses in the local output folder
+"""
+
+__author__ = "Corwin Perren"
+__copyright__ = "None"
+__credits__ = [""]
+__license__ = "GPL (GNU General Public License)"
+__version__ = "1.0.0"
+__maintainer__ = "Corwin Perren"
+__email__ = "perrenc@onid.oregonstate.edu"
+__status__ = "Development"
+
+# This file is part of Auto Imager.
+#
+# Auto Imager is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Auto Imager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Auto Imager.  If not, see <http://www.gnu.org/licenses/>.
+
+
+#####################################
+# Imports
+#####################################
+# Python native imports
+import os
+import json
+import time
+import heapq
+import threading
+
+# Custom imports
+import wellImageWriter
+
+#####################################
+# Global Variables
+#####################################
+ledger_filename = "disk_ledger.json"
+ledger_version = 1
+
+
+#####################################
+# DiskLedger Class Definition
+#####################################
+class DiskLedger(object):
+    """ Per plate size and modification time for everything under the local output folder.
+
+    Entries are updated as files are written (record_file is a WellImageWriter file written callback) and saved to
+    disk_ledger.json in the output folder, so cleanup never has to walk or stat the folder to decide what to delete.
+    The folder is only walked once, to build the ledger the first time it can't be loaded, after that only plates
+    written by something that can't call record_file (the batch compositer's pool processes) are walked again, with
+    rescan_plate. Plates are kept in a min-heap by modification time, stale heap entries are skipped when popped
+    instead of being searched for.
+
+    A plate is marked verified once its upload has been checked against the server, and writing to it again clears
+    that mark. Verified plates are also kept in a heap of their own, so picking the oldest verified plate doesn't
+    have to pass over every unverified one.
+    """
+
+    def __init__(self, root_path):
+        self.root_path = root_path
+        self.ledger_path = root_path + "\\" + ledger_filename
+
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()  # Held across the whole write so two savers don't share the temp file
+
+        self.plates = {}  # plate_id -> {"mtime": seconds, "size": bytes, "verified": bool, "files": {path: bytes}}
+        self.total_size = 0
+        self.age_heap = []  # (mtime, plate_id), may hold outdated entries for plates that changed since
+        self.verified_age_heap = []  # The same for verified plates, outdated once a plate is written to again
+        self.is_dirty = False
+
+        if not self.load():
+            self.rebuild()
+
+    def get_plate_id_and_relative_path(self, path):
+        relative_path = os.path.relpath(path, self.root_path).replace("/", "\\")
+        if relative_path.startswith(".."):
+            return None, None
+        plate_id, _, file_path = relative_path.partition("\\")
+        if not file_path:
+            return None, None  # Loose files in the root aren't part of any plate
+        return plate_id, file_path
+
+    def load(self):
+        try:
+            with open(self.ledger_path, "r") as ledger_file:
+                saved_ledger = json.load(ledger_file)
+        except (IOError, ValueError):
+            return False
+
+        if saved_ledger.get("version") != ledger_version:
+            return False
+
+        self.plates = saved_ledger["plates"]
+        self.total_size = sum(plate["size"] for plate in self.plates.values())
+        self.rebuild_age_heaps()
+        return True
+
+    def rebuild(self):
+        print "Building disk ledger for " + self.root_path + "..."
+        self.plates = {}
+        self.total_size = 0
+
+        if os.path.isdir(self.root_path):
+            for plate_id in os.listdir(self.root_path):
+                plate_path = self.root_path + "\\" + plate_id
+                if not os.path.isdir(plate_path):
+                    continue
+
+                files = self.get_plate_folder_files(plate_path)
+                plate = {"mtime": os.path.getmtime(plate_path), "size": sum(files.values()), "verified": False,
+                         "files": files}
+                self.plates[plate_id] = plate
+                self.total_size += plate["size"]
+
+        self.rebuild_age_heaps()
+        self.is_dirty = True
+        self.save()
+
+    def rebuild_age_heaps(self):
+        self.age_heap = [(plate["mtime"], plate_id) for plate_id, plate in self.plates.items()]
+        heapq.heapify(self.age_heap)
+        self.verified_age_heap = [(plate["mtime"], plate_id) for plate_id, plate in self.plates.items()
+                                  if plate.get("verified")]
+        heapq.heapify(self.verified_age_heap)
+
+    def get_plate_folder_files(self, plate_path):
+        # Paths relative to the plate folder, and their sizes
+        files = {}
+        for dir_path, dir_names, file_names in os.walk(plate_path):
+            for file_name in file_names:
+                full_path = os.path.join(dir_path, file_name)
+                try:
+                    files[os.path.relpath(full_path, plate_path).replace("/", "\\")] = os.path.getsize(full_path)
+                except OSError:
+                    pass  # Removed while we were walking
+        return files
+
+    def save(self):
+        with self.save_lock:
+            with self.lock:
+                if not self.is_dirty:
+                    return
+                saved_ledger = json.dumps({"version": ledger_version, "plates": self.plates})
+                self.is_dirty = False
+
+            if not os.path.isdir(self.root_path):
+                os.makedirs(self.root_path)
+
+            temp_path = self.ledger_path + ".tmp"
+            with open(temp_path, "w") as ledger_file:
+                ledger_file.write(saved_ledger)
+            wellImageWriter.replace_file(temp_path, self.ledger_path)
+
+    def record_file(self, path, size):
+        plate_id, file_path = self.get_plate_id_and_relative_path(path)
+        if not plate_id:
+            return
+
+        with self.lock:
+            plate = self.plates.get(plate_id)
+            if not plate:
+                plate = {"mtime": 0, "size": 0, "verified": False, "files": {}}
+                self.plates[plate_id] = plate
+
+            # Files written again (tiles, re-run plates) replace their old size rather than adding to it
+            size_change = size - plate["files"].get(file_path, 0)
+            plate["files"][file_path] = size
+            plate["size"] += size_change
+            self.total_size += size_change
+
+            plate["mtime"] = time.time()
+            plate["verified"] = False
+            heapq.heappush(self.age_heap, (plate["mtime"], plate_id))
+            self.is_dirty = True
+
+            if len(self.age_heap) > (len(self.plates) * 4) + 64:
+                # Every write pushes a new entry, drop the outdated ones before the heap grows without bound
+                self.rebuild_age_heaps()
+
+    def rescan_plate(self, plate_path):
+        """ Brings a plate's entry back in line with its folder, for plates written to without record_file. """
+        relative_path = os.path.relpath(plate_path, self.root_path).replace("/", "\\")
+        if relative_path.startswith("..") or ("\\" in relative_path) or (relative_path == "."):
+            return  # Not a plate folder in the output path
+
+        files = self.get_plate_folder_files(plate_path) if os.path.isdir(plate_path) else {}
+
+        with self.lock:
+            plate = self.plates.get(relative_path)
+            if not plate:
+                if not files:
+                    return
+                plate = {"mtime": 0, "size": 0, "verified": False, "files": {}}
+                self.plates[relative_path] = plate
+            elif plate["files"] == files:
+                return
+
+            plate_size = sum(files.values())
+            self.total_size += plate_size - plate["size"]
+            plate["files"] = files
+            plate["size"] = plate_size
+
+            plate["mtime"] = time.time()
+            plate["verified"] = False
+            heapq.heappush(self.age_heap, (plate["mtime"], relative_path))
+            self.is_dirty = True
+
+    def mark_plate_verified(self, plate_id):
+        with self.lock:
+            plate = self.plates.get(plate_id)
+            if plate:
+                plate["verified"] = True
+                heapq.heappush(self.verified_age_heap, (plate["mtime"], plate_id))
+                self.is_dirty = True
+
+                if len(self.verified_age_heap) > (len(self.plates) * 2) + 64:
+                    self.rebuild_age_heaps()
+
+    def is_plate_verified(self, plate_id):
+        plate = self.plates.get(plate_id)
+        return bool(plate and plate.get("verified"))
+
+    def remove_plate(self, plate_id):
+        with self.lock:
+            plate = self.plates.pop(plate_id, None)
+            if plate:
+                self.total_size -= plate["size"]
+                self.is_dirty = True
+
+    def get_total_size(self):
+        return self.total_size
+
+    def get_plate_size(self, plate_id):
+        plate = self.plates.get(plate_id)
+        return plate["size"] if plate else 0
+
+    def get_plate_ids(self):
+        with self.lock:
+            return self.plates.keys()
+
+    def get_plate_files(self, plate_id):
+        # Paths are relative to the plate folder
+        with self.lock:
+            plate = self.plates.get(plate_id)
+            return dict(plate["files"]) if plate else {}
+
+    def get_recent_plate_sizes(self, count):
+        with self.lock:
+            newest_plates = heapq.nlargest(count, self.plates.values(), key=lambda plate: plate["mtime"])
+            return [plate["size"] for plate in newest_plates]
+
+    def get_oldest_plate_id(self, skip_plate_ids=(), verified_only=False):
+        """ Returns the least recently modified plate that may be deleted, or None if there isn't one.
+
+        The plate stays in the ledger until remove_plate() is called for it, so a deletion that gets interrupted is
+        picked up again later. Plates in skip_plate_ids, and unverified plates when verified_only is set, are passed
+        over.
+        """
+        with self.lock:
+            age_heap = self.verified_age_heap if verified_only else self.age_heap
+            passed_over_entries = []
+            oldest_plate_id = None
+
+            while age_heap:
+                mtime, plate_id = heapq.heappop(age_heap)
+                plate = self.plates.get(plate_id)
+                if (not plate) or (plate["mtime"] != mtime) or (verified_only and not plate.get("verified")):
+                    continue  # Outdated entry, the plate was deleted or written to again since
+
+                passed_over_entries.append((mtime, plate_id))
+                if plate_id in skip_plate_ids:
+                    continue
+                oldest_plate_id = plate_id
+                break
+
+            for entry in passed_over_entries:
+                heapq.heappush(age_heap, entry)
+
+            return oldest_plate_id
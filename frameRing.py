@@ -0,0 +1,254 @@
+"""
+    This file contains the frame ring class
+    This class keeps several camera frames queued so that frame transfers overlap with image processing
+"""
+
+__author__ = "Corwin Perren"
+__copyright__ = "None"
+__credits__ = [""]
+__license__ = "GPL (GNU General Public License)"
+__version__ = "1.0.0"
+__maintainer__ = "Corwin Perren"
+__email__ = "perrenc@onid.oregonstate.edu"
+__status__ = "Development"
+
+# This file is part of Auto Imager.
+#
+# Auto Imager is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Auto Imager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Auto Imager.  If not, see <http://www.gnu.org/licenses/>.
+
+#####################################
+# Imports
+#####################################
+# Python native imports
+import threading
+import Queue
+import time
+import numpy as np
+
+#####################################
+# Global Variables
+#####################################
+frame_receive_status_complete = 0  # VmbFrameStatusComplete, anything else is an incomplete or dropped frame
+
+
+#####################################
+# Captured Frame Class Definition
+#####################################
+class CapturedFrame(object):
+    """ One announced camera frame plus the information about the last image it received.
+
+    image_data is a view straight onto the camera buffer, so it is only valid until the last holder calls release().
+    Anything that needs the pixels afterwards has to copy them.
+    """
+
+    def __init__(self, ring, vimba_frame):
+        self.ring = ring
+        self.vimba_frame = vimba_frame
+
+        self.frame_id = -1
+        self.timestamp = 0
+        self.receive_time = 0
+        self.exposure_start_time = 0  # Host time.time() at which this frame's exposure started
+
+        self.image_data = None
+
+        self.reference_count = 0
+        self.reference_lock = threading.Lock()
+
+    def acquire(self):
+        with self.reference_lock:
+            self.reference_count += 1
+        return self
+
+    def release(self):
+        with self.reference_lock:
+            self.reference_count -= 1
+            should_recycle = (self.reference_count == 0)
+
+        if should_recycle:
+            self.ring.recycle_frame(self)
+
+
+#####################################
+# Frame Ring Class Definition
+#####################################
+class FrameRing(object):
+    """ Announces a ring of frames on an open pymba camera and runs it in continuous acquisition.
+
+    Vimba fills queued frames on its own thread and calls on_frame_complete_callback for each one. Completed frames
+    wait in a queue until a consumer takes them and are only handed back to the camera once every holder has released
+    them, so the camera can be transferring frame N+1 while frame N is still being processed.
+    """
+
+    def __init__(self, camera, frame_count):
+        self.camera = camera
+        self.frame_count = max(2, int(frame_count))
+
+        self.frames = []
+        self.frames_by_vimba_frame = {}
+        self.completed_frames = Queue.Queue()
+
+        self.is_streaming = False
+
+        self.frame_callbacks = []
+
+        # Mapping from the camera's timestamp clock to host time
+        self.timestamp_tick_frequency = None
+        self.camera_clock_offset = None
+        self.readout_duration = 0
+
+        # Statistics
+        self.frames_received = 0
+        self.frames_dropped = 0
+
+    def start(self):
+        for _ in range(self.frame_count):
+            vimba_frame = self.camera.getFrame()
+            vimba_frame.announceFrame()
+
+            captured_frame = CapturedFrame(self, vimba_frame)
+            self.frames.append(captured_frame)
+            self.frames_by_vimba_frame[id(vimba_frame)] = captured_frame
+
+        self.calibrate_camera_clock()
+
+        self.camera.startCapture()
+        self.is_streaming = True
+
+        for captured_frame in self.frames:
+            self.queue_frame(captured_frame)
+
+        self.camera.runFeatureCommand('AcquisitionStart')
+
+    def stop(self):
+        self.is_streaming = False
+
+        try:
+            self.camera.runFeatureCommand('AcquisitionStop')
+            self.camera.flushCaptureQueue()
+            self.camera.endCapture()
+            self.camera.revokeAllFrames()
+        finally:
+            self.frames = []
+            self.frames_by_vimba_frame = {}
+            self.completed_frames = Queue.Queue()
+
+    def add_frame_callback(self, callback):
+        # Called as callback(captured_frame, is_complete) on the Vimba transport thread for every frame that arrives
+        if callback not in self.frame_callbacks:
+            self.frame_callbacks.append(callback)
+
+    def calibrate_camera_clock(self):
+        # Frame timestamps are latched by the camera when the exposure starts, in camera ticks. Latching the current
+        # tick count right next to a host time.time() call lets us place every frame's exposure on the host clock.
+        # The two clocks drift apart slowly, so this should be re-run at the start of every plate.
+        try:
+            self.readout_duration = (self.camera.ExposureTimeAbs / 1000000.0) + \
+                (float(self.camera.PayloadSize) / self.camera.StreamBytesPerSecond)
+        except Exception, e:
+            self.readout_duration = 0
+
+        try:
+            self.timestamp_tick_frequency = float(self.camera.GevTimestampTickFrequency)
+            host_time_before = time.time()
+            self.camera.runFeatureCommand('GevTimestampControlLatch')
+            host_time_after = time.time()
+            latched_ticks = self.camera.GevTimestampValue
+
+            host_time = (host_time_before + host_time_after) / 2.0
+            self.camera_clock_offset = host_time - (latched_ticks / self.timestamp_tick_frequency)
+        except Exception, e:
+            print "Could not latch camera timestamp, estimating exposure times from arrival: " + str(e)
+            self.timestamp_tick_frequency = None
+            self.camera_clock_offset = None
+
+    def exposure_start_time_for(self, timestamp, receive_time):
+        if self.camera_clock_offset is None:
+            return receive_time - self.readout_duration
+        return (timestamp / self.timestamp_tick_frequency) + self.camera_clock_offset
+
+    def queue_frame(self, captured_frame):
+        captured_frame.image_data = None
+        captured_frame.vimba_frame.queueFrameCapture(self.on_frame_complete_callback)
+
+    def recycle_frame(self, captured_frame):
+        if not self.is_streaming:
+            return
+
+        try:
+            self.queue_frame(captured_frame)
+        except Exception, e:
+            # The ring was torn down between the release and the re-queue, the frame is gone with it
+            if self.is_streaming:
+                print "Error re-queueing camera frame: " + str(e)
+
+    def on_frame_complete_callback(self, vimba_frame):
+        # Runs on the Vimba transport thread, keep this short
+        captured_frame = self.frames_by_vimba_frame.get(id(vimba_frame))
+        if captured_frame is None or not self.is_streaming:
+            return
+
+        captured_frame.frame_id = vimba_frame._frame.frameID
+        captured_frame.timestamp = vimba_frame._frame.timestamp
+        captured_frame.receive_time = time.time()
+        captured_frame.exposure_start_time = self.exposure_start_time_for(captured_frame.timestamp,
+                                                                          captured_frame.receive_time)
+
+        is_complete = (vimba_frame._frame.receiveStatus == frame_receive_status_complete)
+        for callback in self.frame_callbacks:
+            callback(captured_frame, is_complete)
+
+        if not is_complete:
+            self.frames_dropped += 1
+            self.recycle_frame(captured_frame)
+            return
+
+        captured_frame.image_data = np.ndarray(buffer=vimba_frame.getBufferByteData(), dtype=np.uint8,
+                                               shape=(vimba_frame.height, vimba_frame.width, vimba_frame.pixel_bytes))
+        captured_frame.reference_count = 1  # Held by whoever takes it out of the completed queue
+
+        self.frames_received += 1
+        self.completed_frames.put(captured_frame)
+
+    def get_next_frame(self, timeout_ms):
+        """ Returns the oldest completed frame, or None on timeout. The caller must release() it. """
+        try:
+            return self.completed_frames.get(True, timeout_ms / 1000.0)
+        except Queue.Empty:
+            return None
+
+    def get_frame_exposed_after(self, not_before_time, timeout_ms):
+        """ Returns the first frame whose exposure started at or after not_before_time, releasing any older ones.
+
+        Returns None if no such frame shows up within timeout_ms of the last frame that did arrive.
+        """
+        while True:
+            frame = self.get_next_frame(timeout_ms)
+            if frame is None or frame.exposure_start_time >= not_before_time:
+                return frame
+            frame.release()
+
+    def get_newest_frame(self, timeout_ms):
+        """ Returns the most recent completed frame, releasing any older ones, or None on timeout. """
+        newest_frame = self.get_next_frame(timeout_ms)
+
+        while newest_frame is not None:
+            try:
+                next_frame = self.completed_frames.get_nowait()
+            except Queue.Empty:
+                break
+            newest_frame.release()
+            newest_frame = next_frame
+
+        return newest_frame
@@ -32,16 +32,26 @@ __status__ = "Development"
 #####################################
 # Python native imports
 from PyQt4 import QtCore, QtGui
-from pymba import *
 import os
 import cv2
 import numpy as np
-import Image
 import time
-import shutil
 
 # Custom imports
 import settings
+import cameraBackends
+import frameRing
+import threadEvents
+import pipelineWorkers
+import wellImageWriter
+import compositePreview
+import compositeCanvas
+import tilePyramid
+import diskLedger
+import retentionDaemon
+import uploadEngine
+import plateManifest
+import timelineTracer
 
 #####################################
 # Global Variables
@@ -50,6 +60,8 @@ camera_id_string = "DEV_000F3101DE9F"
 capture_x_resolution = 2000  # These values are slightly lower than the possible resolution of the camera
 capture_y_resolution = 2000  # but makes doing the composite image extremely easy later
 
+plate_verify_queue_size = 256  # Plates waiting to be verified, large so an upload worker never waits to hand one over
+
 
 #####################################
 # Image Processor Class Definition
@@ -57,19 +69,14 @@ capture_y_resolution = 2000  # but makes doing the composite image extremely eas
 class ImageProcessor(QtCore.QThread):
 
     images_ready_signal = QtCore.pyqtSignal()
+    composite_preview_ready_signal = QtCore.pyqtSignal(object)
+    well_preview_ready_signal = QtCore.pyqtSignal(object)
     well_image_ready_signal = QtCore.pyqtSignal()
     camera_status_changed_signal = QtCore.pyqtSignal(str)
 
-    local_file_cleanup_started = QtCore.pyqtSignal()
-    local_file_cleanup_finished = QtCore.pyqtSignal()
-
     saving_composite_image_signal = QtCore.pyqtSignal()
     composite_image_saved_signal = QtCore.pyqtSignal()
 
-    no_connection_to_remote_server_signal = QtCore.pyqtSignal()
-    copying_plate_to_server_signal = QtCore.pyqtSignal()
-    copying_plate_finished_signal = QtCore.pyqtSignal()
-
     def __init__(self, parent):
         QtCore.QThread.__init__(self)
 
@@ -86,19 +93,25 @@ class ImageProcessor(QtCore.QThread):
 
         self.output_filename = "A1"
 
-        self.composite_image_PIL = None # Image.new('RGB', (self.composite_x_size, self.composite_y_size))
+        self.composite_canvas = None
+        self.tile_pyramid_writer = None
+        self.composite_preview = compositePreview.CompositePreview(self.composite_x_size, self.composite_y_size)
 
-        self.should_clean_output_folder = False
-        self.should_try_to_copy = False
+        self.state_changed_event = threadEvents.ThreadEvent("Image Processor state changed")
 
         # Flags used to avoid between thread race conditions
         self.grab_well_image = False
+        self.well_frame_not_before_time = 0  # Well images must have started exposing after this host time
 
         # Camera connection containers and instantiations
-        self.vimba = Vimba()
-        self.vimba_system = None
+        self.camera_backend = cameraBackends.get_camera_backend()
         self.camera = None
-        self.frame = None
+        self.frame_ring = None
+        self.camera_reconnect_count = 0  # Quick reconnects after the camera stopped delivering frames
+
+        # Called for every frame the ring receives and every frame taken as a well image, see the add_ methods
+        self.frame_callbacks = []
+        self.well_frame_callbacks = []
 
         # Raw Image Data Containers
         self.raw_image_data = None
@@ -108,14 +121,39 @@ class ImageProcessor(QtCore.QThread):
         self.live_view_raw_data = None
 
         # Display QImage Containers
-        self.composite_QImage = None
-        self.full_well_QImage = None
         self.well_preview_QImage = None
         self.live_view_QImage = None
 
         # Setup for locally used classes ##########
-        self.vimba.startup()
-        self.vimba_system = self.vimba.getSystem()
+        self.camera_backend.startup()
+
+        # Space used by each plate in the output folder, kept up to date as files are written
+        self.disk_ledger = diskLedger.DiskLedger(self.settings.local_output_path)
+
+        # Checksums of every plate file, taken as they're written
+        self.plate_manifests = plateManifest.PlateManifestStore(self.settings.local_output_path)
+        self.plate_resync_counts = {}
+
+        # Re-reads the server copy of each uploaded plate, on its own so it never ties up an upload worker
+        self.plate_verify_stage = pipelineWorkers.PipelineStage("Plate verify", self.verify_uploaded_plate, 1,
+                                                                plate_verify_queue_size)
+
+        # Copies plate files to the server as soon as they're written, and keeps trying until the server has them
+        self.upload_engine = uploadEngine.UploadEngine()
+        self.upload_engine.add_plate_uploaded_callback(self.on_plate_uploaded)
+        self.upload_engine.start()
+
+        # Background stages that finish off a well while the stage is already moving to the next one
+        self.well_image_writer = wellImageWriter.WellImageWriter()
+        self.well_image_writer.add_file_written_callback(self.on_plate_file_written)
+
+        # Keeps the output folder under its size limit without holding up captures
+        self.retention_daemon = retentionDaemon.RetentionDaemon(self.master, self.disk_ledger, self.well_image_writer,
+                                                                self.upload_engine)
+        self.composite_stage = pipelineWorkers.PipelineStage("Composite stitch", self.stitch_well_to_composite,
+                                                             1, self.settings.well_pipeline_queue_size)
+        self.tile_stage = pipelineWorkers.PipelineStage("Composite tiles", self.update_composite_tiles,
+                                                        1, self.settings.well_pipeline_queue_size)
 
         # Thread run flags ##########
         self.not_abort = True
@@ -136,14 +174,17 @@ class ImageProcessor(QtCore.QThread):
         self.master.application_exiting_signal.connect(self.on_application_exiting_slot)
 
         self.images_ready_signal.connect(self.master.on_images_ready_signal_slot)
+        # Emitted from the composite stage worker, queued so the preview only ever becomes a pixmap on the GUI thread
+        self.composite_preview_ready_signal.connect(self.master.on_composite_preview_ready_slot,
+                                                    QtCore.Qt.QueuedConnection)
+        self.well_preview_ready_signal.connect(self.master.on_well_preview_ready_slot, QtCore.Qt.QueuedConnection)
         self.camera_status_changed_signal.connect(self.master.on_camera_status_changed_slot)
 
-        self.local_file_cleanup_started.connect(self.master.on_cleaning_up_files_slot)
         self.saving_composite_image_signal.connect(self.master.on_message_box_saving_composite_slot)
-        self.copying_plate_to_server_signal.connect(self.master.on_copying_plate_to_server_slot)
-        self.no_connection_to_remote_server_signal.connect(self.master.on_cannot_connect_to_remote_server_slot)
 
     def run(self):
+        timelineTracer.name_current_thread("Image Processor")
+
         while self.not_abort:
             if self.connect_to_camera_flag:
                 self.connect_to_camera()
@@ -157,28 +198,44 @@ class ImageProcessor(QtCore.QThread):
 
             elif self.wait_for_run_display_flag:
                 self.wait_for_run_display()
+                continue  # Paced by frames arriving in the ring, no need to sleep
 
             elif self.cycle_run_display_flag:
                 self.cycle_run_display()
+                continue  # Paced by frames arriving in the ring, no need to sleep
             elif self.cycle_stop_flag:
                 self.coordinated_cycle_stop()
 
-            self.msleep(125)  # This shouldn't be less than 125 to avoid overloading the camera when getting frames
-
+            self.state_changed_event.wait(125)  # Only reached while retrying the camera connection or between states
+
+        self.well_image_writer.stop()
+        self.composite_stage.stop()
+        self.tile_stage.stop()
+        self.plate_verify_stage.stop()  # Before the upload engine, a plate that doesn't verify is queued on it again
+        self.upload_engine.stop()
+        self.plate_manifests.stop()
+        self.close_composite_canvas()
+        self.disk_ledger.save()
+
+        print self.state_changed_event.get_statistics_string()
+        print self.well_image_writer.get_statistics_string()
+        print self.composite_stage.get_statistics_string()
+        print self.tile_stage.get_statistics_string()
+        print self.upload_engine.get_statistics_string()
+        print self.plate_verify_stage.get_statistics_string()
+        print self.plate_manifests.get_statistics_string()
 
         print "Image Processing Thread Exiting..."
 
     def connect_to_camera(self):
-        if self.vimba_system.GeVTLIsPresent:  # If cameras exist
-            self.vimba_system.runFeatureCommand("GeVDiscoveryAllOnce")  # Discover all network cameras
-            self.msleep(250)  # Needed so the feature has time to discover any cameras on the network before connecting
+        self.camera_backend.discover_cameras()
 
         # Attempt simple connection to camera
         try:
-            self.camera = self.vimba.getCamera(camera_id_string)  # Attempt to get the desired camera
+            self.camera = self.camera_backend.get_camera(camera_id_string)  # Attempt to get the desired camera
             self.camera.openCamera()  # If we were able to get it, try to open it
             self.camera_connected = True  # Looks like we're good to go, the camera is connected
-        except VimbaException, e:
+        except self.camera_backend.camera_error, e:
             print "Connect to camera error: " + e.message
             return
 
@@ -205,27 +262,24 @@ class ImageProcessor(QtCore.QThread):
             self.camera.Width = 2000
             self.camera.Height = 2000
             self.camera.PixelFormat = 'BGR8Packed'
-            self.camera.AcquisitionMode = 'SingleFrame'
+            self.camera.AcquisitionMode = 'Continuous'
 
             self.msleep(1)  # Wait for all settings to be made on the camera before attempting streaming
 
-        except VimbaException, e:
+        except self.camera_backend.camera_error, e:
             print "Error configuring camera properties: " + e.message
 
         # Settings configured, put camera into capture mode and set up containers
-        try:
-            self.frame = self.camera.getFrame()
-            self.frame.announceFrame()
-            self.camera.startCapture()
-        except VimbaException, e:
-            print "Error setting up camera for capture: " + e.message
+        self.start_frame_ring()
 
     def quick_reconnect_camera(self):
+        self.camera_reconnect_count += 1
+
         # Attempt simple connection to camera
         try:
             self.camera.openCamera()  # If we were able to get it, try to open it
             self.camera_connected = True  # Looks like we're good to go, the camera is connected
-        except VimbaException, e:
+        except self.camera_backend.camera_error, e:
             print "Connect to camera error: " + e.message
             return
 
@@ -244,44 +298,67 @@ class ImageProcessor(QtCore.QThread):
             self.camera.Width = 2000
             self.camera.Height = 2000
             self.camera.PixelFormat = 'BGR8Packed'
-            self.camera.AcquisitionMode = 'SingleFrame'
+            self.camera.AcquisitionMode = 'Continuous'
 
             self.msleep(250)  # Wait for all settings to be made on the camera before attempting streaming
 
-        except VimbaException, e:
+        except self.camera_backend.camera_error, e:
             print "Error configuring camera properties: " + e.message
 
         # Settings configured, put camera into capture mode and set up containers
+        self.start_frame_ring()
+
+    def add_frame_callback(self, callback):
+        # Called as callback(captured_frame, is_complete) on the camera's transport thread, keep it short
+        self.frame_callbacks.append(callback)
+
+        # The camera may have connected before this was added, later rings pick it up in start_frame_ring
+        frame_ring = self.frame_ring
+        if frame_ring:
+            frame_ring.add_frame_callback(callback)
+
+    def add_well_frame_callback(self, callback):
+        # Called as callback(well_name, frame_id, bgr_image) on this thread with the copy taken for the pipeline
+        self.well_frame_callbacks.append(callback)
+
+    def start_frame_ring(self):
         try:
-            self.frame = self.camera.getFrame()
-            self.frame.announceFrame()
-            self.camera.startCapture()
-        except VimbaException, e:
+            self.frame_ring = frameRing.FrameRing(self.camera, self.settings.camera_frame_buffer_count)
+            for callback in self.frame_callbacks:
+                self.frame_ring.add_frame_callback(callback)
+            self.frame_ring.start()
+        except self.camera_backend.camera_error, e:
             print "Error setting up camera for capture: " + e.message
+            self.frame_ring = None
 
-    def get_frame(self):
-        try:
-            self.frame.queueFrameCapture()
-            self.camera.runFeatureCommand('AcquisitionStart')
-            self.camera.runFeatureCommand('AcquisitionStop')
-            self.frame.waitFrameCapture(1000)
-            return 1
-        except VimbaException, e:
-            # print "Get Frame Error: " + e.message
+    def get_frame(self, newest=False):
+        # Returns a frame from the ring that the caller must release(), or None if no frame arrived in time
+        frame = None
+        frame_ring = self.frame_ring  # None until the camera has a ring streaming, reconnect below if so
+        if frame_ring:
+            try:
+                if newest:
+                    frame = frame_ring.get_newest_frame(1000)
+                else:
+                    frame = frame_ring.get_next_frame(1000)
+            except OSError, e:
+                print "Camera frame error: " + str(e)
+                return None
+
+        if frame is None:
+            # print "Get Frame Error: Timed out waiting for frame"
             # print "Reconnecting to camera"
             self.disconnect_from_camera()
             # self.connect_to_camera()
             self.quick_reconnect_camera()
-            return 0
-        except WindowsError, e:
-            print "Windows Error: " + e.message
-            return 0
+
+        return frame
 
     def wait_for_run_display(self):
-        ret = self.get_frame()
-        if ret:
-            self.raw_image_data = np.ndarray(buffer=self.frame.getBufferByteData(), dtype=np.uint8,
-                                             shape=(self.frame.height, self.frame.width, self.frame.pixel_bytes))
+        frame = self.get_frame(newest=True)
+        if frame:
+            self.raw_image_data = frame.image_data.copy()  # The ring reuses the buffer as soon as it's released
+            frame.release()
             self.live_view_raw_data = cv2.resize(self.raw_image_data, (240, 240))
 
             rgb_for_qimage = cv2.cvtColor(self.live_view_raw_data, cv2.COLOR_BGR2RGB)
@@ -295,39 +372,73 @@ class ImageProcessor(QtCore.QThread):
 
             self.images_ready_signal.emit()
 
-    def cycle_run_display(self):
-        if self.grab_well_image:
-            for i in range(0, 4):
-                while (not self.get_frame()) and self.not_abort:
-                    self.msleep(10)
-            self.raw_image_data = np.ndarray(buffer=self.frame.getBufferByteData(), dtype=np.uint8,
-                                             shape=(self.frame.height, self.frame.width, self.frame.pixel_bytes))
-            # WELL PREVIEW PORTION ##########
-            self.full_well_raw_data = self.raw_image_data
-
-            self.save_well_image_to_disk()
+    def get_fresh_frame(self, not_before_time):
+        # Skips anything exposed while the stage was still moving instead of blindly throwing away a few frames
+        frame = None
+        while (not frame) and self.not_abort:
+            frame_ring = self.frame_ring
+            if not frame_ring:
+                # No ring streaming, try to get one going and let the caller come back for the well on its next pass
+                self.quick_reconnect_camera()
+                return None
 
-            rgb_for_qimage = cv2.cvtColor(self.full_well_raw_data, cv2.COLOR_BGR2RGB)
-            rgb_for_qimage = cv2.resize(rgb_for_qimage, (240, 240))
-            height, width = rgb_for_qimage.shape[:2]
-            self.full_well_QImage = QtGui.QImage(rgb_for_qimage,
-                                                 width,
-                                                 height,
-                                                 QtGui.QImage.Format_RGB888)
+            try:
+                frame = frame_ring.get_frame_exposed_after(not_before_time, 1000)
+            except OSError, e:
+                print "Camera frame error: " + str(e)
+                frame = None
+
+            if not frame:
+                self.disconnect_from_camera()
+                self.quick_reconnect_camera()
+                self.msleep(10)
+        return frame
 
-            self.well_image_ready_signal.emit()
+    def cycle_run_display(self):
+        if self.grab_well_image:
+            well_name = self.output_filename
+            with timelineTracer.timeline.span("Frame wait", well_name):
+                frame = self.get_fresh_frame(self.well_frame_not_before_time)
+            if not frame:
+                return
+            timelineTracer.timeline.add_span("Exposure and transfer", frame.exposure_start_time, frame.receive_time,
+                                             well_name, track="Camera", frame_id=frame.frame_id)
+
+            # Copy the well out of the ring so its buffer can go back to the camera while the pipeline works on it
+            with timelineTracer.timeline.span("Copy frame", well_name):
+                well_image = frame.image_data.copy()
+            self.raw_image_data = well_image
+            for callback in self.well_frame_callbacks:
+                callback(well_name, frame.frame_id, well_image)
+
+            # These block if the stages are backed up, which holds the next move until they catch up
+            with timelineTracer.timeline.span("Queue well image", well_name):
+                self.save_well_image_to_disk(str(self.settings.plate_id), well_name, well_image)
+            with timelineTracer.timeline.span("Queue stitch", well_name):
+                self.composite_stage.submit(well_name, well_image)
+
+            # The well preview is made on the composite stage, off the path between this frame and the next move
+            self.full_well_raw_data = well_image
+
+            # Cleared before emitting, the next request can arrive as soon as the coordinator hears about this one
             self.grab_well_image = False
+            self.well_image_ready_signal.emit()
         else:
-            while not self.get_frame():
+            frame = self.get_frame(newest=True)
+            while (not frame) and self.not_abort:
                 self.msleep(10)
-            self.raw_image_data = np.ndarray(buffer=self.frame.getBufferByteData(), dtype=np.uint8,
-                                             shape=(self.frame.height, self.frame.width, self.frame.pixel_bytes))
+                frame = self.get_frame(newest=True)
+            if not frame:
+                return
+            self.raw_image_data = frame.image_data.copy()  # The ring reuses the buffer as soon as it's released
+        frame.release()
 
         # LIVE VIEW PORTION ##########
         # Create a re-sized version of data for live view display
-        rgb_for_qimage = cv2.cvtColor(self.raw_image_data, cv2.COLOR_BGR2RGB)
-        rgb_for_qimage = cv2.resize(rgb_for_qimage, (240, 240))
-        self.live_view_raw_data = cv2.resize(rgb_for_qimage, (240, 240))
+        with timelineTracer.timeline.span("Live view"):
+            rgb_for_qimage = cv2.cvtColor(self.raw_image_data, cv2.COLOR_BGR2RGB)
+            rgb_for_qimage = cv2.resize(rgb_for_qimage, (240, 240))
+            self.live_view_raw_data = cv2.resize(rgb_for_qimage, (240, 240))
 
         # Convert this live view image data to a QImage for display on the gui
         height, width = rgb_for_qimage.shape[:2]
@@ -344,80 +455,60 @@ class ImageProcessor(QtCore.QThread):
 
         self.images_ready_signal.emit()
 
-    @staticmethod
-    def get_folder_size_in_rounded_gb(path):
-        total_size = 0
-        for dir_path, dir_names, file_names in os.walk(path):
-            for f in file_names:
-                fp = os.path.join(dir_path, f)
-                total_size += os.path.getsize(fp)
-        return int(total_size/(1 << 30))
-
-    @staticmethod
-    def delete_oldest_folder_in_path(path):
-        oldest_path = -1
-        oldest_time = -1
-        for sub_dir in os.listdir(path):
-            temp_path = path + "\\" + sub_dir
-
-            if oldest_path == -1 and oldest_time == -1:
-                oldest_path = temp_path
-                oldest_time = os.path.getmtime(temp_path)
-            else:
-                if os.path.getmtime(temp_path) < oldest_time:
-                    oldest_path = temp_path
-                    oldest_time = os.path.getmtime(temp_path)
-
-        print "Removing " + oldest_path + " with date " + time.ctime(oldest_time)
-        shutil.rmtree(oldest_path)
-
-    def perform_folder_cleanup(self, path):
-        if self.get_folder_size_in_rounded_gb(path) > self.settings.local_path_max_size_GB:
-            self.local_file_cleanup_started.emit()
-            while self.get_folder_size_in_rounded_gb(path) > (self.settings.local_path_max_size_GB / 2):
-                self.delete_oldest_folder_in_path(path)
-            self.local_file_cleanup_finished.emit()
-
-    def save_well_image_to_disk(self):
-        if self.should_clean_output_folder:
-            self.perform_folder_cleanup(self.settings.local_output_path)
-            self.should_clean_output_folder = False
-
-        root_path_string = self.settings.local_output_path + "\\" + str(self.settings.plate_id) + "\\" + \
+    def save_well_image_to_disk(self, plate_id, well_name, bgr_image):
+        root_path_string = self.settings.local_output_path + "\\" + plate_id + "\\" + \
             self.settings.well_images_folder_name
 
-        full_path_string = root_path_string + "\\" + self.output_filename + ".png"
-        if not os.path.isdir(root_path_string):
-            os.makedirs(root_path_string)
-
-        # temp_rgb = self.raw_image_data
-        temp_rgb = cv2.cvtColor(self.raw_image_data, cv2.COLOR_BGR2RGB)
-
-        # print full_path_string
-        cv2.imwrite(full_path_string, self.raw_image_data)
-
-        self.stitch_well_to_composite(temp_rgb)
-
-    def stitch_well_to_composite(self, rgb_cv_image):
-        rgb_cv_image = cv2.cvtColor(rgb_cv_image, cv2.COLOR_RGB2RGBA)
-        temp_image = Image.fromarray(rgb_cv_image)
-
-        self.composite_image_PIL.paste(temp_image, self.coordinates_from_name())
-
-        scaled = self.composite_image_PIL.resize((600, 400))
-
-        temp_cv = np.array(scaled)
-        temp_cv = cv2.cvtColor(temp_cv, cv2.COLOR_RGBA2RGB)
-
-        height, width = temp_cv.shape[:2]
-        self.composite_QImage = QtGui.QImage(temp_cv,
-                                             width,
-                                             height,
-                                             QtGui.QImage.Format_RGB888)
-
-    def coordinates_from_name(self):
-        y = ord(self.output_filename[:1])-65  # Values 1-12 turn into 0-11
-        x = int(self.output_filename[1:])-1  # Values A-H turn into 0-8
+        # Encoding and writing happen on the writer pool
+        self.well_image_writer.write(root_path_string, well_name, bgr_image)
+
+    def stitch_well_to_composite(self, well_name, bgr_image):
+        # Runs on the composite stage worker
+        # WELL PREVIEW PORTION ##########
+        with timelineTracer.timeline.span("Well preview", well_name):
+            # Shrunk before the color conversion so only the preview's pixels are converted
+            well_preview_raw_data = cv2.cvtColor(cv2.resize(bgr_image, (240, 240)), cv2.COLOR_BGR2RGB)
+        self.well_preview_ready_signal.emit(well_preview_raw_data)
+
+        well_position = self.coordinates_from_name(well_name)
+        with timelineTracer.timeline.span("Stitch", well_name):
+            self.composite_canvas.paste_well(bgr_image, well_position, is_bgr=True)
+
+        if self.tile_pyramid_writer:
+            well_y_size, well_x_size = bgr_image.shape[:2]
+            self.tile_stage.submit(well_position[0], well_position[1], well_x_size, well_y_size)
+
+        # Only the part of the preview this well covers gets redrawn
+        with timelineTracer.timeline.span("Preview", well_name):
+            self.composite_preview.paste_well(bgr_image, well_position, is_bgr=True)
+            # Handed to the GUI thread, which builds its pixmap from it, so it must not share the buffer we paint into
+            self.composite_raw_data = self.composite_preview.preview_raw_data.copy()
+
+        self.composite_preview_ready_signal.emit(self.composite_raw_data)
+
+    def on_plate_file_written(self, path, size):
+        # Called from the writer and tile workers for every file that lands in a plate folder
+        self.disk_ledger.record_file(path, size)
+        self.plate_manifests.add_file(path)
+        self.upload_engine.enqueue(path)
+
+    def update_composite_tiles(self, x, y, x_size, y_size):
+        # Runs on the tile stage worker
+        with timelineTracer.timeline.span("Tiles", ""):
+            self.tile_pyramid_writer.update_region(x, y, x_size, y_size)
+
+    def get_well_regions(self):
+        # Every well of the plate, so tiles are written once the last well overlapping them is in
+        well_regions = []
+        for row_letter in "ABCDEFGH":
+            for column in range(1, 13):
+                well_position = self.coordinates_from_name(row_letter + str(column))
+                well_regions.append(well_position + (capture_x_resolution, capture_y_resolution))
+        return well_regions
+
+    def coordinates_from_name(self, well_name):
+        y = ord(well_name[:1])-65  # Values 1-12 turn into 0-11
+        x = int(well_name[1:])-1  # Values A-H turn into 0-8
         # print str(x) + " : " + str(y)
 
         x_value = x * self.settings.stitch_offset_x
@@ -430,35 +521,56 @@ class ImageProcessor(QtCore.QThread):
         # print "crd flag: " + str(self.cycle_run_display_flag)
         if self.camera_connected and (self.wait_for_run_display_flag or self.cycle_run_display_flag) and self.not_abort:
             try:
-                self.camera.endCapture()
-                self.camera.revokeAllFrames()
+                if self.frame_ring:
+                    self.frame_ring.stop()
                 self.camera.closeCamera()
                 # print "Camera connection closed..."
-            except VimbaException, e:
+            except self.camera_backend.camera_error, e:
                 pass
                 # print "Disconnect from camera error: " + e.message
         elif (not self.not_abort) and self.camera_connected:
             try:
+                if self.frame_ring:
+                    self.frame_ring.stop()
                 self.camera.closeCamera()
-                self.vimba.shutdown()
-            except VimbaException, e:
+                self.camera_backend.shutdown()
+            except self.camera_backend.camera_error, e:
                 pass
                 # print "Disconnect from camera error: " + e.message
         else:
             pass
             # print "Nothing Happened"
 
+    def close_composite_canvas(self):
+        self.tile_pyramid_writer = None
+        if self.composite_canvas:
+            self.composite_canvas.close()
+            self.composite_canvas = None
+
     def on_coordinated_cycle_signal_slot(self):
-        self.composite_image_PIL = None
-        self.composite_image_PIL = Image.new('RGB', (self.composite_x_size, self.composite_y_size))
-        self.composite_image_PIL.paste((0, 0, 0), (0, 0, self.composite_x_size, self.composite_y_size))
+        self.close_composite_canvas()
+        self.composite_canvas = compositeCanvas.CompositeCanvas(self.composite_x_size, self.composite_y_size)
+
+        self.tile_pyramid_writer = None
+        if self.settings.composite_output_mode in ("tiles", "both"):
+            tiles_path_string = self.settings.local_output_path + "\\" + str(self.settings.plate_id) + "\\" + \
+                self.settings.composite_image_folder_name + "\\" + self.settings.composite_tiles_folder_name
+            self.tile_pyramid_writer = tilePyramid.TilePyramidWriter(tiles_path_string, self.composite_canvas,
+                                                                     self.settings.composite_tile_size,
+                                                                     self.settings.composite_tile_extension,
+                                                                     self.on_plate_file_written,
+                                                                     self.get_well_regions())
 
         self.composite_raw_data = np.zeros((400, 600, 3), np.uint8)
+        self.composite_preview.clear()
 
-        self.should_clean_output_folder = True
-        self.should_try_to_copy = False
+        self.retention_daemon.request_pre_run_check(str(self.settings.plate_id))
 
         self.output_filename = "A1"
+        self.camera_backend.set_current_well(self.output_filename)
+
+        if self.frame_ring:
+            self.frame_ring.calibrate_camera_clock()
 
         self.wait_for_run_display_flag = False
         self.cycle_run_display_flag = True
@@ -472,59 +584,121 @@ class ImageProcessor(QtCore.QThread):
             os.makedirs(root_path_string)
         print "Saving composite image..."
         self.saving_composite_image_signal.emit()
-        start_time = time.clock()
-        self.composite_image_PIL.save(full_path_string)
-        end_time = time.clock()
-        print "Composite image saved in " + str(end_time-start_time) + " seconds..."
+        with timelineTracer.timeline.span("Save composite", "") as save_span:
+            self.composite_canvas.save_png(full_path_string)
+            self.on_plate_file_written(full_path_string, os.path.getsize(full_path_string))
+        print "Composite image saved in " + str(time.time() - save_span.start_time) + " seconds..."
         self.composite_image_saved_signal.emit()
 
-    def copy_plate_to_server(self):
-        root_path_string = self.settings.local_output_path + "\\" + str(self.settings.plate_id)
-        remote_path_string = self.settings.remote_output_path + "\\" + str(self.settings.plate_id)
-
-        if not os.path.isdir(self.settings.remote_output_path[:3]):
-            self.no_connection_to_remote_server_signal.emit()
-            while not self.should_try_to_copy:
-                self.msleep(300)
+    def save_timeline(self):
+        # Goes up with the plate, so it only covers uploads that finished while the plate was being captured
+        timeline_path_string = self.settings.local_output_path + "\\" + str(self.settings.plate_id) + "\\" + \
+            self.settings.logs_folder_name + "\\" + timelineTracer.timeline_filename
+        try:
+            timeline_size = timelineTracer.timeline.finish_plate(timeline_path_string)
+        except (IOError, OSError), e:
+            print "Could not save plate timeline " + timeline_path_string + ": " + str(e)
+            return
 
-        self.copying_plate_to_server_signal.emit()
+        if timeline_size is not None:
+            print timelineTracer.timeline.get_statistics_string()
+            self.on_plate_file_written(timeline_path_string, timeline_size)
 
+    def copy_plate_to_server(self):
+        plate_id = str(self.settings.plate_id)
+
+        # The manifest goes up with the plate, so it has to cover every file before the plate is sealed
+        self.plate_manifests.add_missing_files(plate_id, self.disk_ledger.get_plate_files(plate_id).keys())
+        manifest_path, manifest_size = self.plate_manifests.save_manifest(plate_id)
+        self.on_plate_file_written(manifest_path, manifest_size)
+
+        # Files have been uploading since they were written. Sealing the plate has the upload engine call
+        # on_plate_uploaded once the last of them is up, however long the server takes to come back if it's down.
+        if not self.upload_engine.is_server_reachable():
+            print "Remote server unreachable, plate " + plate_id + " will upload once it's back"
+        self.plate_resync_counts.pop(plate_id, None)
+        self.upload_engine.seal_plate(plate_id)
+
+    def on_plate_uploaded(self, plate_id):
+        # Runs on an upload worker, which the full read of the server copy would hold for minutes
+        self.upload_engine.hold_plate(plate_id)  # Retention keeps its hands off the plate until it's verified
+        self.plate_verify_stage.submit(plate_id)
+
+    def verify_uploaded_plate(self, plate_id):
+        # Runs on the plate verify stage
         try:
-            if os.path.isdir(remote_path_string):
-                shutil.rmtree(remote_path_string)
+            self.check_uploaded_plate(plate_id)
+        finally:
+            self.upload_engine.release_plate(plate_id)
+
+    def check_uploaded_plate(self, plate_id):
+        root_path_string = self.settings.local_output_path + "\\" + plate_id
+        remote_path_string = self.settings.remote_output_path + "\\" + plate_id
+
+        differing_files = self.plate_manifests.get_differing_files(plate_id, remote_path_string,
+                                                                   self.upload_engine.bandwidth_limiter)
+        if not differing_files:
+            print "Plate " + plate_id + " uploaded and verified against its manifest"
+            self.disk_ledger.mark_plate_verified(plate_id)
+            self.disk_ledger.save()
+            self.plate_manifests.forget_plate(plate_id)
+            self.plate_resync_counts.pop(plate_id, None)
+            return
+
+        resync_count = self.plate_resync_counts.get(plate_id, 0) + 1
+        self.plate_resync_counts[plate_id] = resync_count
 
-            shutil.copytree(root_path_string, remote_path_string)
-        except:
-            print "Failed to copy files to remote server!!!!"
+        # Only the files that don't match go up again
+        local_files = [file_path for file_path in differing_files
+                       if os.path.isfile(root_path_string + "\\" + file_path)]
+        if (len(local_files) < len(differing_files)) or (resync_count > self.settings.max_plate_resync_attempts):
+            print "Plate " + plate_id + " could not be verified on the server, " + str(len(differing_files)) + \
+                " files differ from its manifest"
+            return
 
-        self.copying_plate_finished_signal.emit()
+        print "Plate " + plate_id + " has " + str(len(differing_files)) + " files that differ on the server, " + \
+            "re-uploading them"
+        for file_path in local_files:
+            self.upload_engine.enqueue(root_path_string + "\\" + file_path)
+        self.upload_engine.seal_plate(plate_id)
 
     def coordinated_cycle_stop(self):
+        # Let the background stages finish the last wells before anything touches the plate folder
+        self.well_image_writer.flush()
+        self.composite_stage.join()
+        self.tile_stage.join()
+        if self.tile_pyramid_writer:
+            with timelineTracer.timeline.span("Tiles", ""):
+                self.tile_pyramid_writer.finish()  # Tiles of wells a stopped plate never reached
+        self.disk_ledger.save()
+
         # self.save_composite_image()
+        self.save_timeline()
         self.copy_plate_to_server()
 
-        self.composite_image_PIL = None
+        self.close_composite_canvas()
 
         self.cycle_stop_flag = False
         self.wait_for_run_display_flag = True
 
-    def on_well_image_request_signal_slot(self):
+    def on_well_image_request_signal_slot(self, not_before_time):
+        self.well_frame_not_before_time = not_before_time
         self.grab_well_image = True
 
     def on_application_exiting_slot(self):
         self.not_abort = False
+        self.state_changed_event.set()
         self.msleep(350)  # Needed to avoid windows access violation when camera has closed but thread is still running
-        self.composite_image_PIL = None
         self.disconnect_from_camera()
 
     def on_output_filename_changed_signal_slot(self, name):
         self.output_filename = str(name)
+        self.camera_backend.set_current_well(self.output_filename)
 
     def on_coordinated_cycle_stop_slot(self):
         self.cycle_run_display_flag = False
         self.cycle_stop_flag = True
+        self.state_changed_event.set()
 
-    def on_ready_to_try_copying_after_fail_slot(self):
-        self.should_try_to_copy = True
 
 
@@ -0,0 +1,297 @@
+"""
+    This file contains the metrics server class
+    This class serves the instrument's throughput, stage latencies, camera health, queue depths and disk headroom on
+    localhost in the Prometheus text format
+"""
+
+__author__ = "Corwin Perren"
+__copyright__ = "None"
+__credits__ = [""]
+__license__ = "GPL (GNU General Public License)"
+__version__ = "1.0.0"
+__maintainer__ = "Corwin Perren"
+__email__ = "perrenc@onid.oregonstate.edu"
+__status__ = "Development"
+
+# This file is part of Auto Imager.
+#
+# Auto Imager is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Auto Imager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Auto Imager.  If not, see <http://www.gnu.org/licenses/>.
+
+#####################################
+# Imports
+#####################################
+# Python native imports
+from PyQt4 import QtCore
+import BaseHTTPServer
+import collections
+import socket
+import threading
+import time
+
+# Custom imports
+import settings
+import retentionDaemon
+import timelineTracer
+
+#####################################
+# Global Variables
+#####################################
+metrics_path = "/metrics"
+metrics_content_type = "text/plain; version=0.0.4; charset=utf-8"
+metrics_prefix = "autoimager_"
+
+# Upper bounds of the latency histogram buckets in seconds, from a single frame copy up to a full composite save
+latency_buckets_s = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 120.0)
+
+
+#####################################
+# Helper Functions
+#####################################
+def format_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace("\"", "\\\"")
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+#####################################
+# LatencyHistogram Class Definition
+#####################################
+class LatencyHistogram(object):
+    """ Cumulative Prometheus style histogram of span durations. Guarded by the metrics server's lock. """
+
+    def __init__(self):
+        self.bucket_counts = [0] * len(latency_buckets_s)
+        self.count = 0
+        self.total_seconds = 0.0
+
+    def observe(self, seconds):
+        for bucket_index, upper_bound in enumerate(latency_buckets_s):
+            if seconds <= upper_bound:
+                self.bucket_counts[bucket_index] += 1
+                break
+        self.count += 1
+        self.total_seconds += seconds
+
+    def get_lines(self, name, labels):
+        lines = []
+        cumulative_count = 0
+        for upper_bound, bucket_count in zip(latency_buckets_s, self.bucket_counts):
+            cumulative_count += bucket_count
+            lines.append(name + "_bucket{" + labels + ",le=\"" + format_value(upper_bound) + "\"} " +
+                         str(cumulative_count))
+        lines.append(name + "_bucket{" + labels + ",le=\"+Inf\"} " + str(self.count))
+        lines.append(name + "_sum{" + labels + "} " + format_value(self.total_seconds))
+        lines.append(name + "_count{" + labels + "} " + str(self.count))
+        return lines
+
+
+#####################################
+# MetricsRequestHandler Class Definition
+#####################################
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != metrics_path:
+            self.send_error(404)
+            return
+
+        body = self.server.metrics_server.get_metrics_text()
+        self.send_response(200)
+        self.send_header("Content-Type", metrics_content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scraped every few seconds, logging each one would bury everything else on the console
+
+
+#####################################
+# MetricsServer Class Definition
+#####################################
+class MetricsServer(QtCore.QObject):
+    """ Serves http://127.0.0.1:<metrics_server_port>/metrics for a Prometheus scraper on the imaging PC.
+
+    Counts that happen as events, like wells captured, frames arriving and timeline spans finishing, are collected
+    through callbacks as they happen. Queue depths, camera reconnects and disk headroom are read from the image
+    processor at scrape time. The server only listens on localhost, scraping other imagers goes through whatever
+    runs on each of them.
+    """
+
+    def __init__(self, parent):
+        QtCore.QObject.__init__(self)
+
+        self.master = parent
+
+        self.settings = settings.program_settings
+
+        self.metrics_lock = threading.Lock()
+        self.start_time = time.time()
+
+        self.wells_captured = 0
+        self.well_capture_times = collections.deque()
+        self.frames_received = 0
+        self.frames_incomplete = 0
+        self.frames_lost = 0
+        self.last_frame_id = None
+        self.latency_histograms = {}  # Span name: LatencyHistogram
+        self.plate_done_percentage = 0
+
+        self.http_server = None
+        self.server_thread = None
+        self.start_server()
+
+        self.connect_signals_to_slots()
+
+    def connect_signals_to_slots(self):
+        self.master.application_exiting_signal.connect(self.on_application_exiting_slot)
+
+        self.master.cc.done_percentage_changed_signal.connect(self.on_done_percentage_changed_slot,
+                                                              QtCore.Qt.DirectConnection)
+
+        self.master.ip.add_frame_callback(self.on_frame_received)
+        self.master.ip.add_well_frame_callback(self.on_well_frame_taken)
+        timelineTracer.timeline.add_span_callback(self.on_span_finished)
+
+    def start_server(self):
+        try:
+            self.http_server = BaseHTTPServer.HTTPServer(("127.0.0.1", self.settings.metrics_server_port),
+                                                         MetricsRequestHandler)
+        except socket.error, e:
+            print "Could not start metrics server on port " + str(self.settings.metrics_server_port) + ": " + str(e)
+            return
+
+        self.http_server.metrics_server = self
+        self.server_thread = threading.Thread(target=self.http_server.serve_forever, name="Metrics server")
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+    def stop_server(self):
+        if self.http_server:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+            self.http_server = None
+
+    def on_frame_received(self, captured_frame, is_complete):
+        with self.metrics_lock:
+            self.frames_received += 1
+            if not is_complete:
+                self.frames_incomplete += 1
+
+            # The camera numbers every frame it exposes, so a gap in the IDs is frames that never made it to the
+            # ring, like exposures with no free buffer. The IDs start over when the camera is restarted.
+            frame_id = captured_frame.frame_id
+            if (self.last_frame_id is not None) and (frame_id > self.last_frame_id):
+                self.frames_lost += frame_id - self.last_frame_id - 1
+            self.last_frame_id = frame_id
+
+    def on_well_frame_taken(self, well_name, frame_id, bgr_image):
+        with self.metrics_lock:
+            self.wells_captured += 1
+            self.well_capture_times.append(time.time())
+
+    def on_span_finished(self, name, seconds):
+        with self.metrics_lock:
+            latency_histogram = self.latency_histograms.get(name)
+            if latency_histogram is None:
+                latency_histogram = self.latency_histograms[name] = LatencyHistogram()
+            latency_histogram.observe(seconds)
+
+    def get_wells_per_minute(self):
+        # Called with the metrics lock held. Spacing of the recent wells, so it reads zero between plates
+        window_start = time.time() - self.settings.metrics_well_rate_window_s
+        while self.well_capture_times and (self.well_capture_times[0] < window_start):
+            self.well_capture_times.popleft()
+
+        if len(self.well_capture_times) < 2:
+            return 0.0
+        elapsed = self.well_capture_times[-1] - self.well_capture_times[0]
+        return ((len(self.well_capture_times) - 1) * 60.0 / elapsed) if elapsed > 0 else 0.0
+
+    def get_metrics_text(self):
+        ip = self.master.ip
+
+        lines = []
+
+        def add_metric(name, metric_type, help_text, samples):
+            # samples is a list of (label string, value), the label string without braces or "" for none
+            lines.append("# HELP " + metrics_prefix + name + " " + help_text)
+            lines.append("# TYPE " + metrics_prefix + name + " " + metric_type)
+            for labels, value in samples:
+                lines.append(metrics_prefix + name + ("{" + labels + "}" if labels else "") + " " +
+                             format_value(value))
+
+        with self.metrics_lock:
+            add_metric("wells_captured_total", "counter", "Well images taken since the program started.",
+                       [("", self.wells_captured)])
+            add_metric("wells_per_minute", "gauge", "Wells captured per minute over the recent rate window.",
+                       [("", self.get_wells_per_minute())])
+            add_metric("plate_done_percent", "gauge", "Progress through the current plate.",
+                       [("", self.plate_done_percentage)])
+            add_metric("camera_frames_received_total", "counter", "Frames that arrived from the camera.",
+                       [("", self.frames_received)])
+            add_metric("camera_frames_incomplete_total", "counter", "Frames that arrived from the camera incomplete.",
+                       [("", self.frames_incomplete)])
+            add_metric("camera_frames_lost_total", "counter",
+                       "Frames the camera exposed that never arrived, from gaps in the frame IDs.",
+                       [("", self.frames_lost)])
+
+            latency_lines = ["# HELP " + metrics_prefix + "stage_latency_seconds Time taken by each timed step of a "
+                             "well, by timeline span name.",
+                             "# TYPE " + metrics_prefix + "stage_latency_seconds histogram"]
+            for name in sorted(self.latency_histograms):
+                latency_lines.extend(self.latency_histograms[name].get_lines(
+                    metrics_prefix + "stage_latency_seconds", "stage=\"" + format_label_value(name) + "\""))
+
+        lines.extend(latency_lines)
+
+        add_metric("camera_reconnects_total", "counter",
+                   "Quick reconnects after the camera stopped delivering frames.", [("", ip.camera_reconnect_count)])
+        add_metric("camera_connected", "gauge", "1 while the camera is connected.", [("", int(ip.camera_connected))])
+
+        add_metric("queue_depth", "gauge", "Items waiting in or being worked on by each background stage.",
+                   [("queue=\"well_writer\"", ip.well_image_writer.get_pending_count()),
+                    ("queue=\"composite_stitch\"", ip.composite_stage.get_pending_count()),
+                    ("queue=\"composite_tiles\"", ip.tile_stage.get_pending_count()),
+                    ("queue=\"upload\"", ip.upload_engine.get_pending_count())])
+        add_metric("upload_files_waiting", "gauge", "Plate files written locally and not uploaded to the server yet.",
+                   [("", ip.upload_engine.get_queued_count())])
+
+        size_limit = self.settings.local_path_max_size_GB << 30
+        used_size = ip.disk_ledger.get_total_size()
+        add_metric("local_disk_used_bytes", "gauge", "Space used by plates in the local output path.",
+                   [("", used_size)])
+        add_metric("local_disk_limit_bytes", "gauge", "local_path_max_size_GB in bytes.", [("", size_limit)])
+        add_metric("local_disk_headroom_bytes", "gauge", "Space left under local_path_max_size_GB.",
+                   [("", size_limit - used_size)])
+        try:
+            free_space = retentionDaemon.get_free_disk_space(self.settings.local_output_path)
+        except OSError:
+            free_space = None
+        if free_space is not None:
+            add_metric("local_disk_free_bytes", "gauge", "Free space on the local output drive.", [("", free_space)])
+
+        add_metric("uptime_seconds", "gauge", "Time since the program started.",
+                   [("", round(time.time() - self.start_time, 3))])
+
+        return "\n".join(lines) + "\n"
+
+    def on_done_percentage_changed_slot(self, percentage):
+        self.plate_done_percentage = percentage
+
+    def on_application_exiting_slot(self):
+        self.stop_server()
@@ -39,11 +39,14 @@ __status__ = "Development"
 #####################################
 # Python native imports
 from PyQt4 import QtCore
-import pythoncom
-import win32com.client
-import os
 import time
 
+# Custom imports
+import settings
+import stageBackends
+import threadEvents
+import timelineTracer
+
 #####################################
 # Global Variables
 #####################################
@@ -60,6 +63,9 @@ nose_piece_4x_objective = 3
 
 # Scope Pieces Name Definitions
 
+# Stage distance between neighbouring wells, in micrometers
+well_spacing = 9000
+
 
 #####################################
 # Microscope Interface Class Definition
@@ -69,7 +75,7 @@ class MicroscopeInterface(QtCore.QThread):
     power_cycle_message_box_signal = QtCore.pyqtSignal()
 
     microscope_status_changed_signal = QtCore.pyqtSignal(str)
-    desired_move_complete = QtCore.pyqtSignal()
+    desired_move_complete = QtCore.pyqtSignal(float)  # Carries the host time.time() the stage stopped at
 
     output_name_changed_signal = QtCore.pyqtSignal(str)
 
@@ -78,8 +84,10 @@ class MicroscopeInterface(QtCore.QThread):
 
         self.master = parent
 
-        os.popen("taskkill /im NikonTiS.exe /F")
-        time.sleep(1)
+        self.settings = settings.program_settings
+
+        self.stage_backend = stageBackends.get_stage_backend()
+        self.stage_backend.startup()
 
         self.interface = None
 
@@ -100,8 +108,9 @@ class MicroscopeInterface(QtCore.QThread):
         self.requested_light_intensity = None
         self.requested_objective = None
 
-        # Flags to keep threads synced
-        self.xy_done_power_cycling = False
+        # Events to keep threads synced
+        self.wake_event = threadEvents.ThreadEvent("Microscope Interface wake")
+        self.power_cycle_done_event = threadEvents.ThreadEvent("Microscope XY power cycle done")
 
         self.x_position = None
         self.y_position = None
@@ -139,11 +148,15 @@ class MicroscopeInterface(QtCore.QThread):
 
         self.microscope_status_changed_signal.connect(self.master.on_microscope_status_changed_slot)
 
-        self.output_name_changed_signal.connect(self.master.ip.on_output_filename_changed_signal_slot)
+        # Direct so the image processor has the new well name before desired_move_complete goes out
+        self.output_name_changed_signal.connect(self.master.ip.on_output_filename_changed_signal_slot,
+                                                QtCore.Qt.DirectConnection)
 
         self.master.application_exiting_signal.connect(self.on_application_exiting_slot)
 
     def run(self):
+        timelineTracer.name_current_thread("Microscope Interface")
+
         while self.not_abort:
             # Connects the microscope to the application ##########
             if self.connect_to_microscope_flag:
@@ -154,6 +167,7 @@ class MicroscopeInterface(QtCore.QThread):
                 if not self.scope_connected_successfully:
                     self.microscope_status_changed_signal.emit("Disconnected")
                     self.show_scope_connection_error_dialog()
+                    self.wake_event.wait(1000)  # Retry connecting once a second
                 else:
                     self.connect_to_microscope_flag = False
                     self.initialize_microscope_flag = True
@@ -181,20 +195,22 @@ class MicroscopeInterface(QtCore.QThread):
                     self.deinitialize_microscope()
                 self.not_abort = False
             else:
-                pass  # Thread is running with nothing to do yet
-
-            self.msleep(10)
+                self.wake_event.wait()  # Thread is running with nothing to do yet, sleep until a slot wakes us
 
+        print self.wake_event.get_statistics_string()
+        print self.power_cycle_done_event.get_statistics_string()
         print "Microscope Interface Thread Exiting..."
 
     def connect_to_microscope(self):
         if not self.interface_connected:
-            pythoncom.CoInitialize()
-            self.interface = win32com.client.Dispatch("Nikon.TiScope.NikonTi")
-            self.interface.Device = self.interface.Devices(1)
-            self.interface.YDrive.Speed = win32com.client.constants.Speed6 # FIXME:SPEED5
-            self.interface.XDrive.Speed = win32com.client.constants.Speed1
+            self.interface = self.stage_backend.connect()
+            self.interface.YDrive.Speed = self.stage_backend.constants.Speed6 # FIXME:SPEED5
+            self.interface.XDrive.Speed = self.stage_backend.constants.Speed1
             self.msleep(350)
+
+            if self.stage_backend.is_simulated:
+                # Let a simulated camera show whatever part of the plate the simulated stage has under it
+                self.master.ip.camera_backend.set_view_position_function(self.get_view_position_at)
         # TODO: New check to make sure all parts are connected
         self.scope_connected_successfully = True
 
@@ -238,15 +254,19 @@ class MicroscopeInterface(QtCore.QThread):
 
     def user_xy_power_message(self):
 
-        self.move_to_position(self.a1_x, self.a1_y)
+        with timelineTracer.timeline.span("Move to A1"):
+            self.move_to_position(self.a1_x, self.a1_y)
+        self.power_cycle_done_event.clear()
         self.power_cycle_message_box_signal.emit()
 
-        while not self.xy_done_power_cycling:
-            self.msleep(50)
+        while not self.kill_thread and not self.power_cycle_done_event.wait(500):
+            pass
 
-        self.move_to_position(self.a1_x, self.a1_y)
-        self.desired_move_complete.emit()
+        with timelineTracer.timeline.span("Move to A1"):
+            self.move_to_position(self.a1_x, self.a1_y)
+        timelineTracer.timeline.set_current_well("A1")
         self.user_xy_power_message_flag = False
+        self.desired_move_complete.emit(time.time())
 
     def show_scope_connection_error_dialog(self):
         pass
@@ -255,7 +275,7 @@ class MicroscopeInterface(QtCore.QThread):
         x_position = int(int(self.interface.XDrive.Position) / 10)
         while abs(x_position - x) > 10:
             try:
-                self.interface.XDrive.Speed = win32com.client.constants.Speed1
+                self.interface.XDrive.Speed = self.stage_backend.constants.Speed1
                 self.interface.XDrive.Position = int(x)*10
             except Exception, e:
                 print "Exception moving X."
@@ -264,7 +284,7 @@ class MicroscopeInterface(QtCore.QThread):
         y_position = int(int(self.interface.YDrive.Position) / 10)
         while abs(y_position - y) > 10:
             try:
-                self.interface.YDrive.Speed = win32com.client.constants.Speed6
+                self.interface.YDrive.Speed = self.stage_backend.constants.Speed6
                 self.interface.YDrive.Position = int(y)*10
             except Exception, e:
                 print "Exception moving Y."
@@ -316,10 +336,8 @@ class MicroscopeInterface(QtCore.QThread):
 
         if x != 0:
             try:
-                start = time.clock()
-                self.interface.XDrive.MoveRelative(int(x)*10)
-                stop = time.clock()
-                print "Moved x in " + str(stop-start) + " seconds."
+                with timelineTracer.timeline.span("Move X", distance=x):
+                    self.interface.XDrive.MoveRelative(int(x)*10)
                 # self.wait_for_microscope()
             except Exception, e:
                 print "Trouble moving x to " + str(x)
@@ -327,10 +345,8 @@ class MicroscopeInterface(QtCore.QThread):
 
         if y != 0:
             try:
-                start = time.clock()
-                self.interface.YDrive.MoveRelative(int(y)*10)
-                stop = time.clock()
-                print "Moved y in " + str(stop-start) + " seconds."
+                with timelineTracer.timeline.span("Move Y", distance=y):
+                    self.interface.YDrive.MoveRelative(int(y)*10)
                 # self.wait_for_microscope()
             except Exception, e:
                 print "Trouble moving y to " + str(x)
@@ -339,39 +355,53 @@ class MicroscopeInterface(QtCore.QThread):
     def get_position(self):
         pass
 
+    def get_view_position_at(self, host_time):
+        # Where the simulated stage had the camera looking at host_time, in composite pixels with well A1 at 0, 0
+        x, y = self.interface.get_xy_position_at(host_time)
+        return (((x - self.a1_x) * self.settings.stitch_offset_x) / well_spacing,
+                ((self.a1_y - y) * self.settings.stitch_offset_y) / well_spacing)
+
     def move_sequence_test(self):
         self.test_movement_flag = False
 
     def well_capture_move_requested_follow_through(self):
 
+        # Work out the next well first so everything timed on the way there is put down to the well we're going to
         if (self.curr_x == 0) and (self.curr_y == 0):
-            self.move_to_relative_position(9000, 0)
+            move = (well_spacing, 0)
             self.curr_x += 1
         elif (self.curr_x == 11) and (self.x_dir == 1):
-            self.move_to_relative_position(0, -9000)
+            move = (0, -well_spacing)
             self.curr_y += 1
             self.x_dir = 0
         elif (self.curr_x == 0) and (self.x_dir == 0):
-            self.move_to_relative_position(0, -9000)
+            move = (0, -well_spacing)
             self.curr_y += 1
             self.x_dir = 1
         elif self.x_dir:
-            self.move_to_relative_position(9000, 0)
+            move = (well_spacing, 0)
             self.curr_x += 1
-        elif not self.x_dir:
-            self.move_to_relative_position(-9000, 0)
+        else:
+            move = (-well_spacing, 0)
             self.curr_x -= 1
 
-        self.output_name_changed_signal.emit(chr(self.curr_y+65) + str(self.curr_x+1))
-        self.desired_move_complete.emit()
+        well_name = chr(self.curr_y+65) + str(self.curr_x+1)
+        timelineTracer.timeline.set_current_well(well_name)
+        self.move_to_relative_position(*move)
+
+        # Clear the request before announcing completion, the next request can arrive as soon as we emit
         self.well_capture_move_requested_flag = False
+        self.output_name_changed_signal.emit(well_name)
+        self.desired_move_complete.emit(time.time())
 
     def on_well_capture_move_requested_slot(self, x, y):
         self.well_capture_move_requested_flag = True
+        self.wake_event.set()
 
     def on_coordinated_cycle_signal_slot(self):
         self.setup_for_well_captures_flag = True
         self.user_xy_power_message_flag = True
+        self.wake_event.set()
 
     def setup_for_well_captures(self):
         self.curr_x = 0
@@ -381,12 +411,15 @@ class MicroscopeInterface(QtCore.QThread):
 
     def on_application_exiting_slot(self):
         self.kill_thread = True
+        self.wake_event.set()
+        self.power_cycle_done_event.set()
 
     def on_capture_wells_pressed(self):
         self.test_movement_flag = True
+        self.wake_event.set()
 
     def on_message_box_done_signal_slot(self):
-        self.xy_done_power_cycling = True
+        self.power_cycle_done_event.set()
 
     def move_to_z_position(self, z):
         try:
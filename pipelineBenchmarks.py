@@ -0,0 +1,644 @@
+#!/usr/bin/env python
+
+"""
+    This file contains benchmarks for the capture and compositing pipeline
+    Run it directly with the names of the benchmarks to run, or with no arguments to run all of them
+"""
+
+__author__ = "Corwin Perren"
+__copyright__ = "None"
+__credits__ = [""]
+__license__ = "GPL (GNU General Public License)"
+__version__ = "1.0.0"
+__maintainer__ = "Corwin Perren"
+__email__ = "perrenc@onid.oregonstate.edu"
+__status__ = "Development"
+
+# This file is part of Auto Imager.
+#
+# Auto Imager is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Auto Imager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Auto Imager.  If not, see <http://www.gnu.org/licenses/>.
+
+#####################################
+# Imports
+#####################################
+# Python native imports
+import sys
+import os
+import random
+import time
+import tempfile
+import shutil
+import multiprocessing
+import cv2
+import numpy as np
+import Image
+
+# Custom imports
+import settings
+import cameraBackends
+import captureTrace
+import frameRing
+import stageBackends
+import microscopeInterface
+import compositeCanvas
+import compositePreview
+import compositeEncoder
+import batchCompositer
+import wellImageWriter
+
+#####################################
+# Global Variables
+#####################################
+wells_per_plate = 96
+
+# Camera timing defaults, matching what ImageProcessor configures
+frame_bytes = 2000 * 2000 * 3
+stream_bytes_per_second = 115000000
+exposure_seconds = 360 / 1000000.0
+
+# Plate layout defaults, matching settings
+well_size = 2000
+stitch_offset_x = 1605
+stitch_offset_y = 1600
+
+
+#####################################
+# Helper Functions
+#####################################
+def get_well_positions(scale=1.0):
+    positions = []
+    for row in range(8):
+        for column in range(12):
+            positions.append((int(column * stitch_offset_x * scale), int(row * stitch_offset_y * scale)))
+    return positions
+
+
+def get_composite_size(scale=1.0):
+    return int(((11 * stitch_offset_x) + well_size) * scale), int(((7 * stitch_offset_y) + well_size) * scale)
+
+
+def make_synthetic_plate(scale=1.0):
+    composite_x_size, composite_y_size = get_composite_size(scale)
+    plate = np.zeros((composite_y_size, composite_x_size, 3), np.uint8)
+    scaled_well_size = int(well_size * scale)
+    for well_number, (x, y) in enumerate(get_well_positions(scale)):
+        plate[y:y + scaled_well_size, x:x + scaled_well_size] = make_synthetic_well(scaled_well_size, well_number)
+    return plate
+
+
+def make_synthetic_well(size=well_size, seed=0):
+    rng = np.random.RandomState(seed)
+    well = np.zeros((size, size, 3), np.uint8)
+    cv2.circle(well, (size / 2, size / 2), int(size * 0.45), (200, 180, 160), -1)
+    noise = rng.randint(0, 40, (size / 8, size / 8, 3)).astype(np.uint8)
+    well += cv2.resize(noise, (size, size))
+    return well
+
+
+#####################################
+# Well Frame Freshness Benchmark
+#####################################
+def benchmark_well_frame_freshness(wells=24, move_seconds=0.4, seed=1):
+    """ Time from the stage settling to having the well frame, for the old four-frame discard and for
+    FrameRing.get_frame_exposed_after, both on a FrameRing streaming from the simulated camera.
+
+    Between wells the consumer stops taking frames for around move_seconds like the capture loop does while the stage
+    moves, so the ring is holding frames exposed mid-move when the well frame is asked for. A well frame is stale if
+    the simulated camera started exposing it before the stage settled.
+    """
+    program_settings = settings.program_settings
+    results = []
+
+    for name, use_exposure_filter in (("Four frame discard", False), ("First fresh frame", True)):
+        rng = random.Random(seed)  # Same moves for both
+        camera = cameraBackends.SimulatedCamera("Benchmark", "", program_settings.simulated_camera_transfer_jitter,
+                                                0, seed)
+        camera.openCamera()
+        camera.ExposureTimeAbs = exposure_seconds * 1000000
+        camera.StreamBytesPerSecond = stream_bytes_per_second
+
+        ring = frameRing.FrameRing(camera, program_settings.camera_frame_buffer_count)
+        ring.start()
+
+        waits = []
+        stale_frames = 0
+        missed_frames = 0
+        try:
+            for _ in range(wells):
+                time.sleep(rng.uniform(0.5, 1.5) * move_seconds)
+                settled_time = time.time()
+
+                if use_exposure_filter:
+                    frame = ring.get_frame_exposed_after(settled_time, 1000)
+                else:
+                    # The fourth frame after the move, like the old cycle_run_display's four get_frame() calls
+                    frame = ring.get_next_frame(1000)
+                    for _ in range(3):
+                        if frame is None:
+                            break
+                        frame.release()
+                        frame = ring.get_next_frame(1000)
+                waits.append(time.time() - settled_time)
+
+                if frame is None:
+                    missed_frames += 1
+                    continue
+                if camera.exposure_start_times.get(frame.frame_id, frame.exposure_start_time) < settled_time:
+                    stale_frames += 1
+                frame.release()
+        finally:
+            ring.stop()
+            camera.closeCamera()
+
+        results.append((name, np.mean(waits), stale_frames, missed_frames))
+
+    print "Well frame freshness (" + str(wells) + " wells, simulated camera)"
+    for name, mean_wait, stale_frames, missed_frames in results:
+        print "  %-20s %6.1f ms per well, %.1f s per plate, %d stale, %d missed" % \
+            (name + ":", mean_wait * 1000, mean_wait * wells_per_plate, stale_frames, missed_frames)
+    return results
+
+
+#####################################
+# Composite Preview Benchmark
+#####################################
+def benchmark_composite_preview(wells=12, scale=0.5):
+    """ Per-well cost of resizing the whole composite for the preview against updating only the touched tile.
+
+    scale shrinks the plate (wells and offsets) so the old path fits in memory on smaller machines, the old cost
+    grows with the canvas area while the new one doesn't, so scale=1.0 only widens the gap.
+    """
+    composite_x_size, composite_y_size = get_composite_size(scale)
+    well = make_synthetic_well(int(well_size * scale))
+    positions = get_well_positions(scale)[:wells]
+
+    # Only the preview step is timed, both paths paste the well into the full composite the same way
+    composite_image_PIL = Image.new('RGB', (composite_x_size, composite_y_size))
+    full_resize_time = 0
+    for position in positions:
+        composite_image_PIL.paste(Image.fromarray(well), position)
+        start_time = time.time()
+        np.array(composite_image_PIL.resize((600, 400)))
+        full_resize_time += time.time() - start_time
+    full_resize_time /= wells
+
+    preview = compositePreview.CompositePreview(composite_x_size, composite_y_size)
+    incremental_time = 0
+    for position in positions:
+        start_time = time.time()
+        preview.paste_well(well, position, is_bgr=True)
+        preview.preview_raw_data.copy()
+        incremental_time += time.time() - start_time
+    incremental_time /= wells
+
+    print "Composite preview (" + str(composite_x_size) + "x" + str(composite_y_size) + " canvas, " + \
+        str(wells) + " wells)"
+    print "  Full canvas resize:  %.2f ms per well" % (full_resize_time * 1000)
+    print "  Touched tile update: %.2f ms per well" % (incremental_time * 1000)
+    return full_resize_time, incremental_time
+
+
+#####################################
+# Composite Encoding Benchmark
+#####################################
+def benchmark_composite_encoding(scale=0.5, worker_count=None):
+    """ Time to write a synthetic plate composite as PNG with PIL, the band writer, and the parallel band writer. """
+    worker_count = worker_count or max(1, multiprocessing.cpu_count() - 1)
+    plate = make_synthetic_plate(scale)
+    output_path = tempfile.mktemp(".png")
+
+    results = []
+    try:
+        start_time = time.time()
+        Image.fromarray(plate).save(output_path)
+        results.append(("PIL save()", time.time() - start_time, os.path.getsize(output_path)))
+
+        start_time = time.time()
+        compositeEncoder.save_array_as_png(plate, output_path)
+        results.append(("Band writer", time.time() - start_time, os.path.getsize(output_path)))
+
+        start_time = time.time()
+        compositeEncoder.save_array_as_png_parallel(plate, output_path, worker_count)
+        results.append(("Parallel, " + str(worker_count) + " workers", time.time() - start_time,
+                        os.path.getsize(output_path)))
+    finally:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+
+    print "Composite encoding (" + str(plate.shape[1]) + "x" + str(plate.shape[0]) + " synthetic plate)"
+    baseline_time = results[0][1]
+    for name, elapsed, size in results:
+        print "  %-22s %6.2f s  %6.1f MB  %.2fx" % (name + ":", elapsed, size / 1000000.0, baseline_time / elapsed)
+    return results
+
+
+#####################################
+# Well Decoding Benchmark
+#####################################
+def benchmark_well_decoding(wells=24, thread_count=4, read_ahead=8, slow_disk_latency_ms=40,
+                            slow_disk_bytes_per_second=20000000):
+    """ Time per plate to read and decode well images one at a time with PIL against the prefetching decoder.
+
+    The slow disk case stands in for a plate on the network share by sleeping before each read for a fixed latency
+    plus the file size over the given bandwidth. Times are measured over wells and scaled up to a full plate.
+    """
+    well_images_path = tempfile.mkdtemp()
+    try:
+        well_images = []
+        for well_number in range(wells):
+            well_name = chr(65 + (well_number / 12)) + str((well_number % 12) + 1)
+            image_path = os.path.join(well_images_path, well_name + ".png")
+            cv2.imwrite(image_path, make_synthetic_well(seed=well_number), [cv2.IMWRITE_PNG_COMPRESSION, 3])
+            well_images.append((well_name, image_path))
+
+        def load_with_pil(image_path):
+            return np.asarray(Image.open(image_path).convert("RGB"))
+
+        def make_slow(load_function):
+            def load_from_slow_disk(image_path):
+                time.sleep((slow_disk_latency_ms / 1000.0) +
+                           (os.path.getsize(image_path) / float(slow_disk_bytes_per_second)))
+                return load_function(image_path)
+            return load_from_slow_disk
+
+        def time_sequential(load_function):
+            start_time = time.time()
+            for well_name, image_path in well_images:
+                load_function(image_path)
+            return (time.time() - start_time) * wells_per_plate / wells
+
+        def time_prefetched(load_function):
+            start_time = time.time()
+            for well_name, well_image in batchCompositer.prefetch_well_images(well_images, thread_count, read_ahead,
+                                                                              load_function):
+                pass
+            return (time.time() - start_time) * wells_per_plate / wells
+
+        results = [
+            ("Local, PIL one by one", time_sequential(load_with_pil)),
+            ("Local, prefetched", time_prefetched(wellImageWriter.load_well_image)),
+            ("Slow disk, PIL one by one", time_sequential(make_slow(load_with_pil))),
+            ("Slow disk, prefetched", time_prefetched(make_slow(wellImageWriter.load_well_image)))
+        ]
+    finally:
+        shutil.rmtree(well_images_path, ignore_errors=True)
+
+    print "Well decoding (" + str(thread_count) + " threads, " + str(read_ahead) + " read ahead, " + \
+        str(multiprocessing.cpu_count()) + " cores)"
+    for name, plate_time in results:
+        print "  %-27s %6.2f s per plate" % (name + ":", plate_time)
+    return results
+
+
+#####################################
+# Composite Cache Benchmark
+#####################################
+def benchmark_composite_cache(scale=0.25, changed_wells=4):
+    """ Time to composite a plate from scratch, again with nothing changed, and again with a few wells rewritten.
+
+    The plate is written to a temporary folder and composited with batchCompositer.composite_plate directly, with
+    the layout settings swapped for ones scaled like the other benchmarks while it runs.
+    """
+    if os.sep != "\\":
+        # composite_plate joins paths with backslashes like the rest of the program, elsewhere they don't resolve
+        print "Composite cache: skipped, composite_plate only finds its well images on Windows"
+        return []
+
+    program_settings = settings.program_settings
+    saved_settings = dict((name, getattr(program_settings, name)) for name in (
+        "stitch_offset_x", "stitch_offset_y", "stitched_x_size", "stitched_y_size", "composite_output_mode"))
+
+    scaled_well_size = int(well_size * scale)
+    scaled_offset_x = int(stitch_offset_x * scale)
+    scaled_offset_y = int(stitch_offset_y * scale)
+    composite_x_size = (11 * scaled_offset_x) + scaled_well_size
+    composite_y_size = (7 * scaled_offset_y) + scaled_well_size
+
+    temp_root_path = tempfile.mkdtemp()
+    plate_path = os.path.join(temp_root_path, "benchmark_plate")  # Only the plate folder itself, as browsing gives it
+    try:
+        program_settings.stitch_offset_x = scaled_offset_x
+        program_settings.stitch_offset_y = scaled_offset_y
+        program_settings.stitched_x_size = composite_x_size
+        program_settings.stitched_y_size = composite_y_size
+        program_settings.composite_output_mode = "png"
+
+        # Inside the plate folder paths are built the way composite_plate builds them
+        well_images_path = plate_path + "\\" + program_settings.well_images_folder_name
+        os.makedirs(well_images_path)
+
+        def write_well(well_number, seed):
+            well_name = chr(65 + (well_number / 12)) + str((well_number % 12) + 1)
+            cv2.imwrite(well_images_path + "\\" + well_name + ".png", make_synthetic_well(scaled_well_size, seed))
+
+        def time_composite():
+            start_time = time.time()
+            result = batchCompositer.composite_plate((plate_path, compositeCanvas.canvas_backend_memory))
+            if not result["succeeded"]:
+                raise RuntimeError(result["message"])
+            if result["message"] == "0 wells":
+                raise RuntimeError("No well images found in " + well_images_path)
+            return time.time() - start_time, result["message"]
+
+        for well_number in range(wells_per_plate):
+            write_well(well_number, well_number)
+
+        results = [("From scratch",) + time_composite(), ("Nothing changed",) + time_composite()]
+
+        for well_number in range(changed_wells):
+            write_well(well_number * 13, wells_per_plate + well_number)  # Spread over the plate, one per row
+        results.append((str(changed_wells) + " wells rewritten",) + time_composite())
+    finally:
+        for name, value in saved_settings.items():
+            setattr(program_settings, name, value)
+        shutil.rmtree(temp_root_path, ignore_errors=True)
+
+    print "Composite cache (" + str(composite_x_size) + "x" + str(composite_y_size) + " synthetic plate)"
+    for name, elapsed, message in results:
+        print "  %-20s %6.2f s  (%s)" % (name + ":", elapsed, message)
+    return results
+
+
+#####################################
+# Simulated Camera Stream Benchmark
+#####################################
+def benchmark_simulated_camera_stream(duration_seconds=5.0, buffer_counts=(2, 4), mean_processing_ms=80, seed=1):
+    """ Frame rate, lost frames and exposure time error of a FrameRing streaming from the simulated camera.
+
+    The consumer copies each frame out and then holds it for a random 0 to 2x mean_processing_ms, like the capture
+    loop does on a busy plate, so the runs show how many buffers the ring needs to keep the camera from losing frames.
+    """
+    program_settings = settings.program_settings
+    rng = random.Random(seed)
+    results = []
+
+    for buffer_count in buffer_counts:
+        camera = cameraBackends.SimulatedCamera("Benchmark", "", program_settings.simulated_camera_transfer_jitter,
+                                                program_settings.simulated_camera_dropped_frame_rate, seed)
+        camera.openCamera()
+        camera.ExposureTimeAbs = exposure_seconds * 1000000
+        camera.StreamBytesPerSecond = stream_bytes_per_second
+
+        ring = frameRing.FrameRing(camera, buffer_count)
+        ring.start()
+
+        frames = 0
+        exposure_errors = []
+        latencies = []
+        start_time = time.time()
+        try:
+            while (time.time() - start_time) < duration_seconds:
+                frame = ring.get_next_frame(1000)
+                if frame is None:
+                    continue
+                np.copy(frame.image_data)
+                frames += 1
+                latencies.append(frame.receive_time - frame.exposure_start_time)
+                if frame.frame_id in camera.exposure_start_times:
+                    exposure_errors.append(abs(frame.exposure_start_time - camera.exposure_start_times[frame.frame_id]))
+                time.sleep(rng.uniform(0, 2 * mean_processing_ms) / 1000.0)
+                frame.release()
+            elapsed = time.time() - start_time
+        finally:
+            ring.stop()
+            camera.closeCamera()
+
+        results.append((buffer_count, frames / elapsed, camera.frames_lost, ring.frames_dropped,
+                        np.mean(latencies) if latencies else 0, max(exposure_errors) if exposure_errors else 0))
+
+    print "Simulated camera stream (%.0f s per run, %d ms mean processing)" % (duration_seconds, mean_processing_ms)
+    for buffer_count, frame_rate, lost, dropped, latency, exposure_error in results:
+        print "  %d buffers: %5.2f fps, %3d lost, %2d incomplete, %5.1f ms exposure to receive, %.2f ms worst " \
+              "exposure start error" % (buffer_count, frame_rate, lost, dropped, latency * 1000, exposure_error * 1000)
+    return results
+
+
+#####################################
+# Simulated Stage Plate Benchmark
+#####################################
+def benchmark_simulated_stage_plate(x_speeds=(1, 5, 6), y_speed=6, timed_moves=2):
+    """ Stage time per plate for the serpentine well path at several X speed settings, from the simulated stage model.
+
+    Plate times add up the model's move times rather than sleeping through 96 moves. A few real blocking moves are
+    timed as well to check the simulated drive takes as long as its model says.
+    """
+    program_settings = settings.program_settings
+    scope = stageBackends.SimulatedNikonTi(program_settings.simulated_stage_xy_acceleration_um_per_s2,
+                                           program_settings.simulated_stage_z_speed_um_per_s,
+                                           program_settings.simulated_stage_z_acceleration_um_per_s2,
+                                           program_settings.simulated_stage_settle_ms / 1000.0,
+                                           program_settings.simulated_stage_poll_latency_ms / 1000.0)
+    scope.YDrive.Speed = y_speed
+    row_move_seconds = scope.YDrive.get_move_seconds(microscopeInterface.well_spacing)
+
+    results = []
+    for x_speed in x_speeds:
+        scope.XDrive.Speed = x_speed
+        column_move_seconds = scope.XDrive.get_move_seconds(microscopeInterface.well_spacing)
+        plate_seconds = (88 * column_move_seconds) + (7 * row_move_seconds)  # 11 column moves per row, 7 row moves
+
+        start_time = time.time()
+        for move in range(timed_moves):
+            scope.XDrive.MoveRelative(microscopeInterface.well_spacing * stageBackends.xy_units_per_um)
+        measured_seconds = (time.time() - start_time) / timed_moves
+
+        results.append((x_speed, column_move_seconds, measured_seconds, plate_seconds))
+
+    print "Simulated stage plate (Y at Speed%d, %.0f ms per row move)" % (y_speed, row_move_seconds * 1000)
+    for x_speed, column_move_seconds, measured_seconds, plate_seconds in results:
+        print "  X at Speed%d: %5.0f ms per column move (%5.0f ms measured), %5.1f s of stage moves per plate" % (
+            x_speed, column_move_seconds * 1000, measured_seconds * 1000, plate_seconds)
+    return results
+
+
+#####################################
+# Capture Trace Replay Benchmark
+#####################################
+def benchmark_capture_trace_replay(wells=8, move_seconds=0.8, speeds=(1.0, 4.0), seed=1):
+    """ Plays a synthetic capture trace back through the replay camera and stage at several speeds.
+
+    The trace is written with CaptureTraceWriter the way the recorder would, with the camera streaming the whole time
+    and a well frame taken after each move. The replay runs the capture loop's move, then wait for a fresh frame,
+    sequence against a FrameRing and checks every well frame it gets is the recorded one.
+    """
+    rng = random.Random(seed)
+    frame_period = float(frame_bytes) / stream_bytes_per_second
+    trace_path = tempfile.mktemp(captureTrace.trace_extension)
+
+    try:
+        trace_writer = captureTrace.CaptureTraceWriter(trace_path, "Benchmark", 0)
+        trace_seconds = wells * (move_seconds + (2 * frame_period))
+        for frame_id in range(int(trace_seconds / frame_period)):
+            exposure_start = frame_id * frame_period
+            trace_writer.add_frame(frame_id, exposure_start, exposure_start + exposure_seconds + frame_period, True)
+        well_images = {}
+        for well_number in range(wells):
+            well_name = chr(65 + (well_number / 12)) + str((well_number % 12) + 1)
+            well_images[well_name] = make_synthetic_well(well_size, well_number)
+            trace_writer.add_well_frame(well_name, well_number, well_images[well_name])
+            move_start = well_number * (move_seconds + (2 * frame_period))
+            trace_writer.add_move(move_start, move_start + rng.uniform(0.8, 1.2) * move_seconds, well_name)
+        trace_writer.close()
+        trace_size = os.path.getsize(trace_path)
+
+        capture_trace = captureTrace.CaptureTrace(trace_path)
+        results = []
+        for speed in speeds:
+            camera = cameraBackends.ReplayCamera("Benchmark", capture_trace, speed)
+            scope = stageBackends.ReplayNikonTi(capture_trace, speed)
+            camera.openCamera()
+            ring = frameRing.FrameRing(camera, 4)
+            ring.start()
+
+            mismatched_wells = 0
+            start_time = time.time()
+            try:
+                for well_name in sorted(well_images.keys(), key=lambda name: (name[0], int(name[1:]))):
+                    scope.XDrive.MoveRelative(microscopeInterface.well_spacing * stageBackends.xy_units_per_um)
+                    camera.set_current_well(well_name)
+                    frame = ring.get_frame_exposed_after(time.time(), 1000)
+                    if frame is None or not np.array_equal(frame.image_data, well_images[well_name]):
+                        mismatched_wells += 1
+                    if frame:
+                        frame.release()
+                elapsed = time.time() - start_time
+            finally:
+                ring.stop()
+                camera.closeCamera()
+
+            results.append((speed, elapsed, mismatched_wells))
+    finally:
+        if os.path.exists(trace_path):
+            os.remove(trace_path)
+
+    print "Capture trace replay (%d wells, %.1f MB trace, %.2f s of recorded moves)" % (
+        wells, trace_size / 1000000.0, sum(capture_trace.get_move_seconds(move) for move in range(wells)))
+    for speed, elapsed, mismatched_wells in results:
+        print "  %.1fx: %5.2f s per plate, %d wells not matching the recording" % (speed, elapsed, mismatched_wells)
+    return results
+
+
+#####################################
+# Plate Browser Benchmark
+#####################################
+def benchmark_plate_browser(plate_count=10000, old_sample_step=20):
+    """ Listing time and data()/flags() calls per second for the plate browser with plate_count plate folders.
+
+    The listing is timed to the first rows and to the complete sorted list, along with the longest the GUI thread
+    spent on any one pass of its event loop meanwhile. The old lookups, a linear scan of the folder name list and a
+    checked list, are timed on every old_sample_step'th row as a baseline since running them over every row takes
+    minutes. Half the plates are checked.
+    """
+    # Imported here so the benchmarks that don't need a QApplication run headless
+    from PyQt4 import QtCore, QtGui
+    import plateBrowser
+
+    class BenchmarkWindow(QtCore.QObject):
+        # Stands in for the main window the plate browser worker takes its exit signal from
+        application_exiting_signal = QtCore.pyqtSignal()
+
+    application = QtCore.QCoreApplication.instance() or QtGui.QApplication(sys.argv)
+    window = BenchmarkWindow()
+
+    root_path = tempfile.mkdtemp()
+    try:
+        for plate_number in range(plate_count):
+            os.makedirs(os.path.join(root_path, "plate_%05d" % plate_number))
+
+        model = plateBrowser.PlateBrowserModel(window)
+
+        start_time = time.time()
+        first_rows_time = None
+        longest_event_loop_pass = 0
+        model.set_root_path(root_path)
+        while (model.rowCount() < plate_count) or (model.unseen_paths is not None):
+            if time.time() - start_time > 120:
+                raise RuntimeError("Listing didn't finish, " + str(model.rowCount()) + " rows so far")
+
+            pass_start_time = time.time()
+            application.processEvents()
+            longest_event_loop_pass = max(longest_event_loop_pass, time.time() - pass_start_time)
+
+            if (first_rows_time is None) and model.rowCount():
+                first_rows_time = time.time() - start_time
+            time.sleep(0.001)
+        listing_time = time.time() - start_time
+
+        indexes = [model.index(row_number, plateBrowser.column_plate) for row_number in range(model.rowCount())]
+        for index in indexes[::2]:
+            model.setData(index, QtCore.Qt.Checked, QtCore.Qt.CheckStateRole)
+
+        folder_names = [row["path"] for row in model.rows]
+        checked_paths = model.get_checked_paths()
+
+        def old_data_and_flags(index):
+            path = folder_names[index.row()]
+            if path in checked_paths:
+                return
+            for name in folder_names:
+                if name == path:
+                    break
+
+        def new_data_and_flags(index):
+            model.data(index, QtCore.Qt.CheckStateRole)
+            model.flags(index)
+
+        start_time = time.time()
+        for index in indexes[::old_sample_step]:
+            old_data_and_flags(index)
+            old_data_and_flags(index)  # flags() did the same scan again
+        old_rate = len(indexes[::old_sample_step]) / (time.time() - start_time)
+
+        start_time = time.time()
+        for index in indexes:
+            new_data_and_flags(index)
+        new_rate = len(indexes) / (time.time() - start_time)
+
+        window.application_exiting_signal.emit()
+        model.worker.wait()
+    finally:
+        shutil.rmtree(root_path, ignore_errors=True)
+
+    print "Plate browser (" + str(len(indexes)) + " plate folders)"
+    print "  First rows shown:        %8.3f s" % first_rows_time
+    print "  Full sorted listing:     %8.3f s" % listing_time
+    print "  Longest GUI thread pass: %8.3f s" % longest_event_loop_pass
+    print "  Linear scan lookups:     %8.0f rows per second" % old_rate
+    print "  Hashed lookups:          %8.0f rows per second" % new_rate
+    return first_rows_time, listing_time, longest_event_loop_pass, old_rate, new_rate
+
+
+#####################################
+# Benchmark Runner
+#####################################
+benchmarks = {
+    "well_frame_freshness": benchmark_well_frame_freshness,
+    "composite_preview": benchmark_composite_preview,
+    "composite_encoding": benchmark_composite_encoding,
+    "well_decoding": benchmark_well_decoding,
+    "composite_cache": benchmark_composite_cache,
+    "plate_browser": benchmark_plate_browser,
+    "simulated_camera_stream": benchmark_simulated_camera_stream,
+    "simulated_stage_plate": benchmark_simulated_stage_plate,
+    "capture_trace_replay": benchmark_capture_trace_replay,
+}
+
+if __name__ == "__main__":
+    names_to_run = sys.argv[1:] or sorted(benchmarks.keys())
+    for name in names_to_run:
+        if name not in benchmarks:
+            print "Unknown benchmark: " + name + ". Choices are: " + ", ".join(sorted(benchmarks.keys()))
+            continue
+        benchmarks[name]()
+        print
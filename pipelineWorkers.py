@@ -0,0 +1,130 @@
+"""
+    This file contains the pipeline stage class
+    This class runs one step of the well processing pipeline on background workers fed from a bounded queue
+"""
+
+__author__ = "Corwin Perren"
+__copyright__ = "None"
+__credits__ = [""]
+__license__ = "GPL (GNU General Public License)"
+__version__ = "1.0.0"
+__maintainer__ = "Corwin Perren"
+__email__ = "perrenc@onid.oregonstate.edu"
+__status__ = "Development"
+
+# This file is part of Auto Imager.
+#
+# Auto Imager is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Auto Imager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Auto Imager.  If not, see <http://www.gnu.org/licenses/>.
+
+#####################################
+# Imports
+#####################################
+# Python native imports
+import threading
+import traceback
+import Queue
+import time
+
+#####################################
+# Global Variables
+#####################################
+
+
+#####################################
+# PipelineStage Class Definition
+#####################################
+class PipelineStage(object):
+    """ Calls handler(*job) for every submitted job on worker_count background threads.
+
+    The queue in front of the workers holds at most queue_size jobs, and submit() blocks while it is full, so a slow
+    stage pushes back on whatever is feeding it instead of letting jobs (and their images) pile up in memory.
+    """
+
+    def __init__(self, name, handler, worker_count=1, queue_size=2):
+        self.name = name
+        self.handler = handler
+
+        self.job_queue = Queue.Queue(max(1, int(queue_size)))
+
+        # Statistics
+        self.statistics_lock = threading.Lock()
+        self.jobs_processed = 0
+        self.busy_time = 0.0
+        self.submit_blocked_time = 0.0
+
+        self.workers = []
+        for worker_number in range(max(1, int(worker_count))):
+            worker = threading.Thread(target=self.worker_run, name=name + " " + str(worker_number))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, *job):
+        start_time = time.time()
+        self.job_queue.put(job)  # Blocks while the stage is full
+        with self.statistics_lock:
+            self.submit_blocked_time += time.time() - start_time
+
+    def try_submit(self, *job):
+        """ Like submit() but returns False instead of blocking when the stage is full. """
+        try:
+            self.job_queue.put_nowait(job)
+        except Queue.Full:
+            return False
+        return True
+
+    def is_worker_thread(self):
+        return threading.current_thread() in self.workers
+
+    def join(self):
+        """ Blocks until every job submitted so far has been processed. """
+        self.job_queue.join()
+
+    def stop(self):
+        for _ in self.workers:
+            self.job_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def get_queue_depth(self):
+        return self.job_queue.qsize()
+
+    def get_pending_count(self):
+        # Jobs waiting plus jobs a worker is in the middle of
+        return self.job_queue.unfinished_tasks
+
+    def worker_run(self):
+        while True:
+            job = self.job_queue.get()
+            if job is None:
+                self.job_queue.task_done()
+                break
+
+            start_time = time.time()
+            try:
+                self.handler(*job)
+            except Exception, e:
+                print "Error in " + self.name + " stage: " + str(e)
+                traceback.print_exc()
+            finally:
+                with self.statistics_lock:
+                    self.jobs_processed += 1
+                    self.busy_time += time.time() - start_time
+                self.job_queue.task_done()
+
+    def get_statistics_string(self):
+        with self.statistics_lock:
+            return "%s: %d jobs, %.2f s busy, %.2f s blocked on submit" % \
+                   (self.name, self.jobs_processed, self.busy_time, self.submit_blocked_time)
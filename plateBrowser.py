@@ -0,0 +1,435 @@
+"""
+    This file contains the plate browser model and worker classes
+    These list the plate folders for the compositer on a background thread and show them as they arrive
+"""
+
+
+__author__ = "Corwin Perren"
+__copyright__ = "None"
+__credits__ = [""]
+__license__ = "GPL (GNU General Public License)"
+__version__ = "1.0.0"
+__maintainer__ = "Corwin Perren"
+__email__ = "perrenc@onid.oregonstate.edu"
+__status__ = "Development"
+
+# This file is part of Auto Imager.
+#
+# Auto Imager is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Auto Imager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Auto Imager.  If not, see <http://www.gnu.org/licenses/>.
+
+
+#####################################
+# Imports
+#####################################
+# Python native imports
+from PyQt4 import QtCore
+import os
+import time
+import threading
+import collections
+
+# Custom imports
+import settings
+import threadEvents
+import wellImageWriter
+import batchCompositer
+
+#####################################
+# Global Variables
+#####################################
+listing_batch_size = 200  # Rows per batch sent to the model while a root is being listed
+listing_batch_interval = 0.1  # Seconds, a batch goes out after this long even if it isn't full
+
+column_plate = 0
+column_wells = 1
+column_composite = 2
+column_size = 3
+column_names = ["Plate", "Wells", "Composite", "Size"]
+
+metadata_loading_text = "..."
+
+
+#####################################
+# Helper Functions
+#####################################
+def normalize_path(path):
+    # Windows paths don't care about case or which way the slashes go, so neither do the model's lookups
+    return str(path).replace("\\", "/").rstrip("/").lower()
+
+
+def get_plate_metadata(plate_path):
+    """ Returns the well count, whether the composite is there, and the total size in bytes of a plate folder. """
+    program_settings = settings.program_settings
+
+    well_count = 0
+    well_images_path = plate_path + "\\" + program_settings.well_images_folder_name
+    if os.path.isdir(well_images_path):
+        well_count = len([file_name for file_name in os.listdir(well_images_path)
+                          if wellImageWriter.is_well_image_file(file_name)])
+
+    has_composite = batchCompositer.composite_outputs_exist(
+        plate_path + "\\" + program_settings.composite_image_folder_name)
+
+    size = 0
+    for dir_path, dir_names, file_names in os.walk(plate_path):
+        for file_name in file_names:
+            try:
+                size += os.path.getsize(os.path.join(dir_path, file_name))
+            except OSError:
+                pass  # Removed while we were walking
+
+    return {"well_count": well_count, "has_composite": has_composite, "size": size}
+
+
+def format_size(size):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024:
+            return "%.0f %s" % (size, unit) if unit == "B" else "%.1f %s" % (size, unit)
+        size /= 1024.0
+    return "%.1f TB" % size
+
+
+#####################################
+# PlateBrowserWorker Class Definition
+#####################################
+class PlateBrowserWorker(QtCore.QThread):
+    """ Background thread that does all the filesystem work for the plate browser.
+
+    A listing request stats the root first and, if its modification time matches the one the model already has,
+    reports it unchanged without listing anything. Otherwise the plate folders are sent back in batches as they are
+    found. Only the newest listing request matters, an older one still running is abandoned. Metadata requests are
+    served newest first between listings, so the rows the user just scrolled to fill in before ones scrolled past.
+    """
+
+    listing_batch_ready_signal = QtCore.pyqtSignal(str, object, bool, float)  # Root, [(name, mtime)], done, mtime
+    plate_metadata_ready_signal = QtCore.pyqtSignal(str, object)  # Plate path, metadata dictionary
+
+    def __init__(self, parent):
+        QtCore.QThread.__init__(self)
+        self.master = parent
+
+        self.request_lock = threading.Lock()
+        self.listing_request = None  # (root path, known root mtime or None)
+        self.metadata_requests = collections.deque()  # (plate path, plate mtime, generation), newest on the left
+
+        self.wake_event = threadEvents.ThreadEvent("Plate browser wake")
+
+        # Thread run flags
+        self.not_abort = True
+
+        self.connect_signals_to_slots()
+        self.start(QtCore.QThread.LowPriority)
+
+    def connect_signals_to_slots(self):
+        self.master.application_exiting_signal.connect(self.on_application_exiting_slot)
+
+    def run(self):
+        while self.not_abort:
+            with self.request_lock:
+                listing_request = self.listing_request
+                self.listing_request = None
+                metadata_request = None
+                if not listing_request and self.metadata_requests:
+                    metadata_request = self.metadata_requests.popleft()
+
+            if listing_request:
+                self.list_plates(*listing_request)
+            elif metadata_request:
+                self.load_plate_metadata(*metadata_request)
+            else:
+                self.wake_event.wait()
+
+        print self.wake_event.get_statistics_string()
+        print "Plate Browser Thread Exiting..."
+
+    def request_listing(self, root_path, known_root_mtime=None):
+        with self.request_lock:
+            self.listing_request = (root_path, known_root_mtime)
+        self.wake_event.set()
+
+    def request_metadata(self, plate_path, plate_mtime, generation):
+        with self.request_lock:
+            self.metadata_requests.appendleft((plate_path, plate_mtime, generation))
+        self.wake_event.set()
+
+    def has_newer_listing_request(self):
+        return (self.listing_request is not None) or not self.not_abort
+
+    def list_plates(self, root_path, known_root_mtime):
+        try:
+            root_mtime = os.path.getmtime(root_path)
+            if root_mtime == known_root_mtime:
+                self.listing_batch_ready_signal.emit(root_path, None, True, root_mtime)
+                return
+            folder_names = os.listdir(root_path)
+        except OSError, e:
+            # Keep showing what we had, the share may just be unreachable for now
+            print "Could not list plates in " + root_path + ": " + str(e)
+            self.listing_batch_ready_signal.emit(root_path, None, True, known_root_mtime or 0.0)
+            return
+
+        rows = []
+        last_batch_time = time.time()
+        for folder_name in folder_names:
+            if self.has_newer_listing_request():
+                return
+
+            plate_path = root_path + "\\" + folder_name
+            try:
+                if os.path.isdir(plate_path):
+                    rows.append((folder_name, os.path.getmtime(plate_path)))
+            except OSError:
+                continue  # Removed while we were listing
+
+            if (len(rows) >= listing_batch_size) or ((time.time() - last_batch_time) >= listing_batch_interval):
+                self.listing_batch_ready_signal.emit(root_path, rows, False, root_mtime)
+                rows = []
+                last_batch_time = time.time()
+
+        self.listing_batch_ready_signal.emit(root_path, rows, True, root_mtime)
+
+    def load_plate_metadata(self, plate_path, plate_mtime, generation):
+        try:
+            metadata = get_plate_metadata(plate_path)
+        except OSError, e:
+            print "Could not read plate folder " + plate_path + ": " + str(e)
+            metadata = {"well_count": 0, "has_composite": False, "size": 0}
+        metadata["mtime"] = plate_mtime
+        metadata["generation"] = generation
+        self.plate_metadata_ready_signal.emit(plate_path, metadata)
+
+    def on_application_exiting_slot(self):
+        self.not_abort = False
+        self.wake_event.set()
+
+
+#####################################
+# PlateBrowserModel Class Definition
+#####################################
+class PlateBrowserModel(QtCore.QAbstractTableModel):
+    """ Checkable list of the plate folders under one root, with their well count, composite and size columns.
+
+    Everything that touches the disk is asked of a PlateBrowserWorker, so the GUI thread never waits on it. Switching
+    to a root shows its last listing straight away and has the worker check it in the background, and the shown root
+    is checked again every plate_browser_refresh_interval_ms. A fresh listing streams rows in as they are found and
+    is sorted newest first once complete. The metadata columns are only loaded for rows a view actually asks about,
+    and are kept until the plate folder's modification time changes or refresh() is called.
+    """
+
+    def __init__(self, parent):
+        QtCore.QAbstractTableModel.__init__(self)
+        self.settings = settings.program_settings
+
+        self.worker = PlateBrowserWorker(parent)
+
+        self.root_path = None
+        self.rows = []  # {"name", "path", "mtime"}
+        self.row_numbers = {}  # Normalised path -> index into rows
+        self.unseen_paths = None  # Normalised paths not yet seen by the listing in progress, None between listings
+
+        self.listing_cache = {}  # Normalised root path -> (root mtime, rows)
+        self.metadata_cache = {}  # Normalised plate path -> metadata dictionary
+        self.pending_metadata_paths = set()
+        self.metadata_generation = 0  # Bumped by refresh() so metadata read before it is thrown away
+
+        self.checked = collections.OrderedDict()  # Normalised path -> path as shown, in the order they were checked
+
+        self.refresh_timer = QtCore.QTimer()
+        self.refresh_timer.setInterval(self.settings.plate_browser_refresh_interval_ms)
+
+        self.connect_signals_to_slots()
+        self.refresh_timer.start()
+
+    def connect_signals_to_slots(self):
+        self.worker.listing_batch_ready_signal.connect(self.on_listing_batch_ready_slot)
+        self.worker.plate_metadata_ready_signal.connect(self.on_plate_metadata_ready_slot)
+
+        self.refresh_timer.timeout.connect(self.on_refresh_timer_slot)
+
+    def set_root_path(self, root_path):
+        self.beginResetModel()
+        self.root_path = root_path
+        root_mtime, self.rows = self.listing_cache.get(normalize_path(root_path), (None, []))
+        self.rows = list(self.rows)
+        self.update_row_numbers()
+        self.unseen_paths = None
+        self.endResetModel()
+
+        self.worker.request_listing(root_path, root_mtime)
+
+    def refresh(self):
+        """ Lists the root again and reloads the metadata of every plate, for after the plates have been changed. """
+        self.metadata_generation += 1
+        self.metadata_cache = {}
+        self.pending_metadata_paths = set()
+        if self.rows:
+            self.dataChanged.emit(self.index(0, column_wells), self.index(len(self.rows) - 1, column_size))
+
+        if self.root_path:
+            self.worker.request_listing(self.root_path)
+
+    def update_row_numbers(self):
+        self.row_numbers = dict((normalize_path(row["path"]), row_number) for row_number, row in enumerate(self.rows))
+
+    def get_checked_paths(self):
+        return self.checked.values()
+
+    def clear_checked(self):
+        self.checked.clear()
+        if self.rows:
+            self.dataChanged.emit(self.index(0, column_plate), self.index(len(self.rows) - 1, column_plate))
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.rows)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(column_names)
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if (orientation == QtCore.Qt.Horizontal) and (role == QtCore.Qt.DisplayRole):
+            return column_names[section]
+        return None
+
+    def data(self, self_index, role=QtCore.Qt.DisplayRole):
+        if not self_index.isValid():
+            return None
+
+        row = self.rows[self_index.row()]
+        column = self_index.column()
+
+        if role == QtCore.Qt.DisplayRole:
+            if column == column_plate:
+                return row["name"]
+            return self.get_metadata_text(row, column)
+        elif (role == QtCore.Qt.CheckStateRole) and (column == column_plate):
+            if normalize_path(row["path"]) in self.checked:
+                return QtCore.Qt.Checked
+            return QtCore.Qt.Unchecked
+        elif (role == QtCore.Qt.ToolTipRole) and (column == column_plate):
+            return row["path"]
+        return None
+
+    def get_metadata_text(self, row, column):
+        path = normalize_path(row["path"])
+        metadata = self.metadata_cache.get(path)
+        if (not metadata) or (metadata["mtime"] != row["mtime"]):
+            # Asked for because a view is showing this row, which is the only time it's worth the disk access
+            if path not in self.pending_metadata_paths:
+                self.pending_metadata_paths.add(path)
+                self.worker.request_metadata(row["path"], row["mtime"], self.metadata_generation)
+            return metadata_loading_text
+
+        if column == column_wells:
+            return str(metadata["well_count"])
+        elif column == column_composite:
+            return "Yes" if metadata["has_composite"] else "No"
+        return format_size(metadata["size"])
+
+    def flags(self, self_index):
+        if self_index.isValid() and (self_index.column() == column_plate):
+            return QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable | QtCore.Qt.ItemIsUserCheckable
+        return QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable
+
+    def setData(self, self_index, value, role=QtCore.Qt.EditRole):
+        if self_index.isValid() and (self_index.column() == column_plate) and role == QtCore.Qt.CheckStateRole:
+            # store checked paths, remove unchecked paths
+            path = self.rows[self_index.row()]["path"]
+            if value == QtCore.Qt.Checked:
+                self.checked[normalize_path(path)] = path
+            else:
+                self.checked.pop(normalize_path(path), None)
+            self.dataChanged.emit(self_index, self_index)
+            return True
+        return False
+
+    def sort_rows(self):
+        # Newest first, like the old directory model, keeping any selection on the same plates
+        self.layoutAboutToBeChanged.emit()
+        persistent_paths = [(persistent_index, self.rows[persistent_index.row()]["path"])
+                            for persistent_index in self.persistentIndexList()]
+
+        self.rows.sort(key=lambda row: row["mtime"], reverse=True)
+        self.update_row_numbers()
+
+        for persistent_index, path in persistent_paths:
+            self.changePersistentIndex(persistent_index,
+                                       self.index(self.row_numbers[normalize_path(path)], persistent_index.column()))
+        self.layoutChanged.emit()
+
+    def remove_unseen_rows(self):
+        for row_number in sorted((self.row_numbers[path] for path in self.unseen_paths), reverse=True):
+            self.beginRemoveRows(QtCore.QModelIndex(), row_number, row_number)
+            del self.rows[row_number]
+            self.endRemoveRows()
+        self.update_row_numbers()
+
+    def on_listing_batch_ready_slot(self, root_path, listed_rows, is_complete, root_mtime):
+        root_path = str(root_path)
+        if (not self.root_path) or (normalize_path(root_path) != normalize_path(self.root_path)):
+            return  # Left over from a root that is no longer shown
+
+        if listed_rows is None:
+            # Nothing changed, or the root couldn't be read and what we have is the best there is
+            self.unseen_paths = None
+            return
+
+        if self.unseen_paths is None:
+            self.unseen_paths = set(self.row_numbers.keys())
+
+        new_rows = []
+        for folder_name, plate_mtime in listed_rows:
+            plate_path = root_path + "\\" + folder_name
+            path = normalize_path(plate_path)
+            self.unseen_paths.discard(path)
+
+            row_number = self.row_numbers.get(path)
+            if row_number is None:
+                new_rows.append({"name": folder_name, "path": plate_path, "mtime": plate_mtime})
+            elif self.rows[row_number]["mtime"] != plate_mtime:
+                self.rows[row_number]["mtime"] = plate_mtime  # Its metadata is reloaded the next time it's shown
+                self.dataChanged.emit(self.index(row_number, column_plate), self.index(row_number, column_size))
+
+        if new_rows:
+            self.beginInsertRows(QtCore.QModelIndex(), len(self.rows), len(self.rows) + len(new_rows) - 1)
+            for row in new_rows:
+                self.row_numbers[normalize_path(row["path"])] = len(self.rows)
+                self.rows.append(row)
+            self.endInsertRows()
+
+        if is_complete:
+            self.remove_unseen_rows()
+            self.unseen_paths = None
+            self.sort_rows()
+            self.listing_cache[normalize_path(root_path)] = (root_mtime, list(self.rows))
+
+    def on_plate_metadata_ready_slot(self, plate_path, metadata):
+        if metadata["generation"] != self.metadata_generation:
+            return
+
+        path = normalize_path(plate_path)
+        self.pending_metadata_paths.discard(path)
+        self.metadata_cache[path] = metadata
+
+        row_number = self.row_numbers.get(path)
+        if row_number is not None:
+            self.dataChanged.emit(self.index(row_number, column_wells), self.index(row_number, column_size))
+
+    def on_refresh_timer_slot(self):
+        if self.root_path and (self.unseen_paths is None):
+            root_mtime = self.listing_cache.get(normalize_path(self.root_path), (None, []))[0]
+            self.worker.request_listing(self.root_path, root_mtime)
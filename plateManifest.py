@@ -0,0 +1,224 @@
+"""
+    This file contains the plate manifest store class
+    This class keeps a checksummed manifest of every file in a plate and verifies copies of the plate against it
+"""
+
+__author__ = "Corwin Perren"
+__copyright__ = "None"
+__credits__ = [""]
+__license__ = "GPL (GNU General Public License)"
+__version__ = "1.0.0"
+__maintainer__ = "Corwin Perren"
+__email__ = "perrenc@onid.oregonstate.edu"
+__status__ = "Development"
+
+# This file is part of Auto Imager.
+#
+# Auto Imager is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Auto Imager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Auto Imager.  If not, see <http://www.gnu.org/licenses/>.
+
+
+#####################################
+# Imports
+#####################################
+# Python native imports
+import os
+import json
+import time
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
+
+# Custom imports
+import settings
+import pipelineWorkers
+import wellImageWriter
+
+#####################################
+# Global Variables
+#####################################
+manifest_filename = "manifest.json"
+manifest_version = 1
+
+hash_chunk_size = 1 << 20
+hash_queue_size = 4096  # Large enough that queueing a file never holds up the writer that finished it
+
+
+#####################################
+# Helper Functions
+#####################################
+def hash_file(path, bandwidth_limiter=None):
+    file_hash = hashlib.sha1()
+    with open(path, "rb") as hashed_file:
+        while True:
+            chunk = hashed_file.read(hash_chunk_size)
+            if not chunk:
+                break
+            if bandwidth_limiter:
+                bandwidth_limiter.consume(len(chunk))
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+#####################################
+# PlateManifestStore Class Definition
+#####################################
+class PlateManifestStore(object):
+    """ Per plate manifests of file, size, SHA-1 and capture time for everything under the local output folder.
+
+    add_file() is called as each file is written and a pool of workers hashes it while it is still in the OS cache,
+    so a manifest is ready as soon as its plate is. save_manifest() writes it as manifest.json in the plate folder,
+    which travels to the server with the rest of the plate. get_differing_files() re-hashes a copy of the plate in
+    parallel and returns only the files that don't match, so a plate can be re-synced by copying just those.
+    """
+
+    def __init__(self, root_path):
+        self.settings = settings.program_settings
+
+        self.root_path = root_path
+
+        self.lock = threading.Lock()
+        self.manifests = {}  # plate_id -> {relative path: {"size": bytes, "sha1": hex, "capture_time": string, ...}}
+
+        # Statistics
+        self.files_hashed = 0
+        self.bytes_hashed = 0
+        self.hash_time = 0.0
+
+        self.hash_stage = pipelineWorkers.PipelineStage("Manifest hash", self.hash_local_file,
+                                                        self.settings.manifest_worker_count, hash_queue_size)
+
+    def get_plate_id_and_relative_path(self, path):
+        relative_path = os.path.relpath(path, self.root_path).replace("/", "\\")
+        plate_id, _, file_path = relative_path.partition("\\")
+        return plate_id, file_path
+
+    def get_plate_path(self, plate_id):
+        return self.root_path + "\\" + plate_id
+
+    def add_file(self, path):
+        plate_id, file_path = self.get_plate_id_and_relative_path(path)
+        if (not file_path) or (file_path == manifest_filename):
+            return
+        self.hash_stage.submit(path)
+
+    def flush(self):
+        self.hash_stage.join()
+
+    def stop(self):
+        self.hash_stage.stop()
+
+    def hash_local_file(self, path):
+        plate_id, file_path = self.get_plate_id_and_relative_path(path)
+
+        start_time = time.time()
+        try:
+            size = os.path.getsize(path)
+            mtime = os.path.getmtime(path)
+            sha1 = hash_file(path)
+        except (IOError, OSError), e:
+            print "Could not hash " + path + " for the plate manifest: " + str(e)
+            return
+
+        entry = {
+            "size": size,
+            "sha1": sha1,
+            "capture_time": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(mtime)),
+            "mtime": mtime
+        }
+
+        with self.lock:
+            manifest = self.get_manifest_locked(plate_id)
+            previous_entry = manifest.get(file_path)
+            if (not previous_entry) or (previous_entry["mtime"] <= mtime):  # Rewritten files can finish out of order
+                manifest[file_path] = entry
+
+            self.files_hashed += 1
+            self.bytes_hashed += size
+            self.hash_time += time.time() - start_time
+
+    def get_manifest_locked(self, plate_id):
+        # Loads the saved manifest the first time a plate is touched this session
+        manifest = self.manifests.get(plate_id)
+        if manifest is None:
+            manifest = {}
+            try:
+                with open(self.get_plate_path(plate_id) + "\\" + manifest_filename, "r") as manifest_file:
+                    saved_manifest = json.load(manifest_file)
+                if saved_manifest.get("version") == manifest_version:
+                    manifest = saved_manifest["files"]
+            except (IOError, ValueError):
+                pass
+            self.manifests[plate_id] = manifest
+        return manifest
+
+    def get_manifest(self, plate_id):
+        with self.lock:
+            return dict(self.get_manifest_locked(plate_id))
+
+    def add_missing_files(self, plate_id, file_paths):
+        """ Hashes any of the plate's files that aren't in its manifest yet, e.g. ones written before it existed. """
+        manifest = self.get_manifest(plate_id)
+        for file_path in file_paths:
+            if (file_path not in manifest) and (file_path != manifest_filename):
+                self.add_file(self.get_plate_path(plate_id) + "\\" + file_path)
+        self.flush()
+
+    def save_manifest(self, plate_id):
+        # Returns the path written, and its size
+        with self.lock:
+            saved_manifest = json.dumps({"version": manifest_version, "plate_id": plate_id,
+                                         "files": self.get_manifest_locked(plate_id)}, indent=4, sort_keys=True)
+
+        manifest_path = self.get_plate_path(plate_id) + "\\" + manifest_filename
+        with open(manifest_path + ".tmp", "w") as manifest_file:
+            manifest_file.write(saved_manifest)
+        wellImageWriter.replace_file(manifest_path + ".tmp", manifest_path)
+        return manifest_path, len(saved_manifest)
+
+    def get_differing_files(self, plate_id, copy_path, bandwidth_limiter=None):
+        """ Re-hashes the copy of a plate at copy_path in parallel and returns the files that are missing or differ.
+
+        Sizes are compared first so obviously incomplete files are never read.
+        """
+        manifest = self.get_manifest(plate_id)
+
+        def check_file(manifest_item):
+            file_path, entry = manifest_item
+            copy_file_path = copy_path + "\\" + file_path
+            try:
+                if os.path.getsize(copy_file_path) != entry["size"]:
+                    return file_path
+                if hash_file(copy_file_path, bandwidth_limiter) != entry["sha1"]:
+                    return file_path
+            except (IOError, OSError):
+                return file_path  # Missing or unreadable
+            return None
+
+        pool = ThreadPool(self.settings.manifest_verify_worker_count)
+        try:
+            results = pool.map(check_file, manifest.items())
+        finally:
+            pool.close()
+            pool.join()
+
+        return [file_path for file_path in results if file_path]
+
+    def forget_plate(self, plate_id):
+        with self.lock:
+            self.manifests.pop(plate_id, None)
+
+    def get_statistics_string(self):
+        with self.lock:
+            return "Manifest: %d files, %.1f MB hashed in %.2f s" % \
+                   (self.files_hashed, self.bytes_hashed / 1000000.0, self.hash_time)
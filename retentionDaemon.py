@@ -0,0 +1,249 @@
+"""
+    This file contains the retention daemon class
+    This class frees up space in the local output folder in the background by deleting old plates
+"""
+
+__author__ = "Corwin Perren"
+__copyright__ = "None"
+__credits__ = [""]
+__license__ = "GPL (GNU General Public License)"
+__version__ = "1.0.0"
+__maintainer__ = "Corwin Perren"
+__email__ = "perrenc@onid.oregonstate.edu"
+__status__ = "Development"
+
+# This file is part of Auto Imager.
+#
+# Auto Imager is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Auto Imager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Auto Imager.  If not, see <http://www.gnu.org/licenses/>.
+
+
+#####################################
+# Imports
+#####################################
+# Python native imports
+from PyQt4 import QtCore
+import os
+import sys
+import ctypes
+import shutil
+import traceback
+
+# Custom imports
+import settings
+import threadEvents
+
+#####################################
+# Global Variables
+#####################################
+retention_policy_oldest = "oldest"
+retention_policy_verified = "verified"
+
+recent_plates_for_prediction = 5
+writer_busy_backoff_ms = 100
+
+
+#####################################
+# Helper Functions
+#####################################
+def get_free_disk_space(path):
+    if sys.platform == "win32":
+        drive_path = os.path.splitdrive(path)[0] + "\\"  # The folder itself may not exist yet
+        free_bytes = ctypes.c_ulonglong(0)
+        ctypes.windll.kernel32.GetDiskFreeSpaceExW(ctypes.c_wchar_p(drive_path), None, None, ctypes.pointer(free_bytes))
+        return free_bytes.value
+    else:
+        existing_path = os.path.abspath(path)
+        while not os.path.exists(existing_path):  # Same drive as the folder will be on once it's made
+            parent_path = os.path.dirname(existing_path)
+            if parent_path == existing_path:
+                break
+            existing_path = parent_path
+        file_system_stats = os.statvfs(existing_path)
+        return file_system_stats.f_bavail * file_system_stats.f_frsize
+
+
+#####################################
+# RetentionDaemon Class Definition
+#####################################
+class RetentionDaemon(QtCore.QThread):
+    """ Low priority thread that keeps the local output folder under local_path_max_size_GB.
+
+    Before a run starts, request_pre_run_check() makes room for a plate of the predicted size without holding up the
+    capture. Between runs the size limit is checked every retention_check_interval_ms. Sizes all come from the disk
+    ledger. Plates are deleted oldest first, and with the "verified" policy only once they are verified on the
+    server. Under either policy a plate the upload engine still has work for is passed over for the next oldest, so
+    nothing is deleted before it's on the server. Between runs deleting goes one file at a time at a limited rate and
+    waits whenever the well writer has work, so it doesn't compete with a run for the disk. The pre-run check deletes
+    flat out, as the run it's making room for has already started writing.
+
+    Running out of room is printed and sent out on local_space_low_signal, nothing here waits for it to be seen.
+    """
+
+    local_space_low_signal = QtCore.pyqtSignal(str)
+
+    def __init__(self, parent, disk_ledger, well_image_writer, upload_engine):
+        QtCore.QThread.__init__(self)
+
+        self.master = parent
+
+        self.settings = settings.program_settings
+
+        self.disk_ledger = disk_ledger
+        self.well_image_writer = well_image_writer
+        self.upload_engine = upload_engine
+
+        self.protected_plate_id = None  # The plate being captured is never deleted
+        self.plates_deleted = 0
+        self.files_deleted = 0
+
+        self.wake_event = threadEvents.ThreadEvent("Retention daemon wake")
+
+        # Thread run flags
+        self.not_abort = True
+
+        self.pre_run_check_flag = False
+
+        self.connect_signals_to_slots()
+        self.start(QtCore.QThread.LowestPriority)
+
+    def connect_signals_to_slots(self):
+        self.master.application_exiting_signal.connect(self.on_application_exiting_slot)
+
+        self.local_space_low_signal.connect(self.master.on_local_space_low_slot)
+
+    def run(self):
+        while self.not_abort:
+            # One failed check must not end cleanup for the rest of the session, the next one may go through
+            try:
+                if self.pre_run_check_flag:
+                    self.pre_run_check_flag = False
+                    self.pre_run_check()
+                else:
+                    self.size_limit_check()
+            except Exception, e:
+                print "Error in retention check: " + str(e)
+                traceback.print_exc()
+
+            self.wake_event.wait(self.settings.retention_check_interval_ms)
+
+        print self.wake_event.get_statistics_string()
+        print "Retention daemon: %d plates, %d files deleted" % (self.plates_deleted, self.files_deleted)
+        print "Retention Daemon Thread Exiting..."
+
+    def get_size_limit(self):
+        return self.settings.local_path_max_size_GB << 30
+
+    def get_predicted_plate_size(self):
+        recent_plate_sizes = self.disk_ledger.get_recent_plate_sizes(recent_plates_for_prediction)
+        if recent_plate_sizes:
+            return max(recent_plate_sizes)
+        return self.settings.predicted_plate_size_GB << 30
+
+    def pre_run_check(self):
+        predicted_plate_size = self.get_predicted_plate_size()
+        size_limit = self.get_size_limit()
+
+        # Same hysteresis as between runs, once over the limit go down to half of it so cleanup doesn't run every plate
+        bytes_over_limit = 0
+        if self.disk_ledger.get_total_size() + predicted_plate_size > size_limit:
+            target_size = min(size_limit / 2, size_limit - predicted_plate_size)
+            bytes_over_limit = self.disk_ledger.get_total_size() - target_size
+
+        try:
+            bytes_short_on_disk = predicted_plate_size - get_free_disk_space(self.settings.local_output_path)
+        except OSError, e:
+            # Still keep to the size limit, only the check against the space actually left on the drive is lost
+            print "Could not read free space for " + self.settings.local_output_path + ": " + str(e)
+            bytes_short_on_disk = 0
+
+        bytes_to_free = max(bytes_over_limit, bytes_short_on_disk)
+        if bytes_to_free > 0:
+            if self.free_space(bytes_to_free, is_throttled=False) < bytes_to_free:
+                self.report_space_low(predicted_plate_size)
+
+    def size_limit_check(self):
+        size_limit = self.get_size_limit()
+        if self.disk_ledger.get_total_size() > size_limit:
+            self.free_space(self.disk_ledger.get_total_size() - (size_limit / 2))
+
+    def free_space(self, bytes_to_free, is_throttled=True):
+        # Returns the number of bytes actually freed
+        bytes_freed = 0
+        verified_only = self.settings.local_retention_policy == retention_policy_verified
+
+        while self.not_abort and (bytes_freed < bytes_to_free):
+            # Asked for again every plate, as uploads can start on an old plate at any time (re-syncs, restarts)
+            skip_plate_ids = self.upload_engine.get_busy_plate_ids()
+            skip_plate_ids.add(self.protected_plate_id)
+
+            plate_id = self.disk_ledger.get_oldest_plate_id(skip_plate_ids=skip_plate_ids,
+                                                            verified_only=verified_only)
+            if not plate_id:
+                break
+
+            plate_size = self.disk_ledger.get_plate_size(plate_id)
+            if self.delete_plate(plate_id, is_throttled):
+                bytes_freed += plate_size
+
+        self.disk_ledger.save()
+        return bytes_freed
+
+    def delete_plate(self, plate_id, is_throttled=True):
+        # Returns False if interrupted, the plate stays in the ledger so the rest of it is deleted next time
+        plate_path = self.settings.local_output_path + "\\" + plate_id
+        print "Removing " + plate_path
+
+        delete_interval_ms = int(1000 / max(1, self.settings.retention_max_deletes_per_second))
+        for file_path in self.disk_ledger.get_plate_files(plate_id):
+            if is_throttled:
+                self.wait_for_idle_writer()
+            if not self.not_abort:
+                return False
+
+            try:
+                os.remove(plate_path + "\\" + file_path)
+                self.files_deleted += 1
+            except OSError:
+                pass  # Already gone
+
+            if is_throttled:
+                self.msleep(delete_interval_ms)
+
+        shutil.rmtree(plate_path, ignore_errors=True)  # Empty folders and anything the ledger didn't know about
+        self.disk_ledger.remove_plate(plate_id)
+        self.plates_deleted += 1
+        return True
+
+    def wait_for_idle_writer(self):
+        while self.not_abort and self.well_image_writer.get_pending_count():
+            self.msleep(writer_busy_backoff_ms)
+
+    def report_space_low(self, predicted_plate_size):
+        message = "Could not free up enough space for the next plate on the local drive.\n" + \
+                  "The next plate is expected to need about %.1f GB" % (predicted_plate_size / float(1 << 30))
+        if self.settings.local_retention_policy == retention_policy_verified:
+            message += ", and only plates verified on the server may be deleted."
+        else:
+            message += "."
+        print message
+        self.local_space_low_signal.emit(message)
+
+    def request_pre_run_check(self, plate_id):
+        self.protected_plate_id = plate_id
+        self.pre_run_check_flag = True
+        self.wake_event.set()
+
+    def on_application_exiting_slot(self):
+        self.not_abort = False
+        self.wake_event.set()
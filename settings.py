@@ -32,6 +32,7 @@ __status__ = "Development"
 #####################################
 # Python native imports
 from PyQt4 import QtCore, QtGui
+import multiprocessing
 
 #####################################
 # Global Variables
@@ -51,7 +52,7 @@ class Settings(QtCore.QObject):
         self.plate_local_path_full = None
         self.plate_remote_path_full = None
 
-        self.image_stabilization_delay = 500
+        self.image_stabilization_delay = 500  # Time after a stage move before a well image's exposure may start
 
         # Settings tab settings
         # - General
@@ -66,13 +67,38 @@ class Settings(QtCore.QObject):
         self.logs_folder_name = "logs"
         # ---- Temp
         self.temp_folder_name = "temp"
+        # --- Save a timeline of each plate run to its logs folder, viewable in chrome://tracing or ui.perfetto.dev
+        self.timeline_tracing = True
         # --- Folder Names
         # ---- Local Root File Path
         self.local_output_path = "E:\\AutoImagerPlates"
         # ---- Remote Root File Path
         self.remote_output_path = "Z:\\HRIC_DATA"
+        # --- Number of workers uploading plate files to the remote path while the plate is captured
+        self.upload_worker_count = 3
+        # --- Upload bandwidth cap shared by all upload workers, 0 for no cap. Kept well under what the camera streams
+        self.upload_max_bytes_per_second = 40000000
+        # --- Failed uploads are retried after this delay, doubling each time up to the max
+        self.upload_retry_initial_delay_ms = 2000
+        self.upload_retry_max_delay_ms = 300000
+        # --- Workers hashing plate files for the plate manifest as they're written
+        self.manifest_worker_count = 2
+        # --- Workers re-hashing the server copy of a plate to verify it against the manifest
+        self.manifest_verify_worker_count = 4
+        # --- Times a plate that doesn't verify has its differing files re-uploaded before giving up
+        self.max_plate_resync_attempts = 3
 
         # - Microscope
+        # -- Stage backend, "nikon" for the real Ti, "simulated" for a timing model of its stage or "replay" for the
+        # moves of a capture trace
+        self.stage_backend = "nikon"
+        # -- Simulated stage acceleration, XY top speeds come from the Speed1 to Speed9 settings
+        self.simulated_stage_xy_acceleration_um_per_s2 = 100000
+        self.simulated_stage_z_acceleration_um_per_s2 = 20000
+        self.simulated_stage_z_speed_um_per_s = 2000
+        # -- Simulated stage time to stop vibrating after a move, and for one position poll of the controller
+        self.simulated_stage_settle_ms = 60
+        self.simulated_stage_poll_latency_ms = 15
         # -- Z Stage Focus Value
         self.z_focus_value = 2750  # This is in micrometers
         # -- Default Objective
@@ -82,16 +108,92 @@ class Settings(QtCore.QObject):
         # -- Default Lamp Intensity
         self.default_lamp_intensity = 100
 
+        # - Camera
+        # -- Number of frames announced to the camera so transfers can overlap with processing
+        self.camera_frame_buffer_count = 4
+        # -- Camera backend, "vimba" for the real camera, "simulated" for synthetic frames with realistic timing or
+        # "replay" for the frames of a capture trace
+        self.camera_backend = "vimba"
+        # -- Plate image the simulated camera crops its frames out of, synthetic wells if empty
+        self.simulated_camera_plate_image_path = ""
+        # -- Simulated frame transfers take up to this fraction longer or shorter than the stream bandwidth allows
+        self.simulated_camera_transfer_jitter = 0.05
+        # -- Fraction of simulated frames that arrive incomplete
+        self.simulated_camera_dropped_frame_rate = 0.001
+
+        # - Capture Traces
+        # -- Record every plate run's frames, stage moves and well images to a trace file in the trace path
+        self.capture_trace_recording = False
+        self.capture_trace_path = "E:\\AutoImagerTraces"
+        # -- Trace the "replay" camera and stage backends play back, and how many times faster than it was recorded
+        self.capture_trace_replay_path = ""
+        self.capture_trace_replay_speed = 1.0
+
+        # - Metrics
+        # -- Serve instrument throughput, latencies and queue depths in Prometheus text format on
+        # http://127.0.0.1:<port>/metrics
+        self.metrics_server_enabled = False
+        self.metrics_server_port = 9480
+        # -- Wells per minute is averaged over the wells captured in this many seconds
+        self.metrics_well_rate_window_s = 120
+
+        # - Well Pipeline
+        # -- Number of workers writing well images to disk
+        self.well_writer_worker_count = 2
+        # -- Well image codec, one of "png", "tiff" or "npy"
+        self.well_image_codec = "png"
+        # -- PNG compression level from 0 (fastest, largest) to 9 (slowest, smallest)
+        self.well_image_png_compression = 3
+        # -- Force each well image all the way to disk before it counts as written
+        self.well_image_fsync = True
+        # -- Wells each pipeline stage may have waiting before capture has to wait for it
+        self.well_pipeline_queue_size = 2
+
         # Maximum size for data dir
         self.local_path_max_size_GB = 50
+        # Which plates may be deleted to stay under it, "oldest" for any plate oldest first, "verified" for only plates
+        # already verified on the server
+        self.local_retention_policy = "oldest"
+        # Space to make for a plate before a run, until there are plates in the disk ledger to predict it from
+        self.predicted_plate_size_GB = 2
+        # Files deleted per second while freeing up space, kept low so deleting doesn't compete with the well writer
+        self.retention_max_deletes_per_second = 50
+        # Time between background checks of the local output size
+        self.retention_check_interval_ms = 60000
 
         # Temp directory for compositer
         self.compositer_temp_path = "E:\\CompositerTemp"
 
+        # Processes compositing plates in parallel, and the memory each may use. Plates whose canvas doesn't fit in the
+        # budget are composited on a memory mapped canvas instead. Keep workers * budget within the machine's RAM
+        self.compositer_worker_count = max(1, multiprocessing.cpu_count() - 1)
+        self.compositer_worker_memory_budget_MB = 1024
+        # Threads each compositer worker reads and decodes well images on, and how many wells they may get ahead
+        self.compositer_decode_thread_count = 4
+        self.compositer_decode_read_ahead = 8
+        # Shortest time between preview updates while a plate is being composited
+        self.compositer_preview_interval_ms = 500
+        # How often the plate browser checks whether the folder it shows has changed
+        self.plate_browser_refresh_interval_ms = 10000
+
         # Compositer and preview stitch offsets
         self.stitch_offset_x = 1605
         self.stitch_offset_y = 1600
 
+        # Composite canvas backend, "memory" keeps the canvas in RAM while "memmap" keeps it in a file in the temp path
+        self.composite_canvas_backend = "memory"
+        self.composite_canvas_temp_path = "E:\\AutoImagerCanvasTemp"
+
+        # Processes used to compress the composite png, 1 compresses it on the calling thread
+        self.composite_encoder_worker_count = max(1, multiprocessing.cpu_count() - 1)
+
+        # Composite output, "png" for one composite_image.png, "tiles" for a tile pyramid written as wells arrive,
+        # or "both"
+        self.composite_output_mode = "png"
+        self.composite_tiles_folder_name = "composite_tiles"
+        self.composite_tile_size = 256
+        self.composite_tile_extension = ".png"
+
         # Composite Image Size
         self.stitched_x_size = (11*self.stitch_offset_x)+2000
         self.stitched_y_size = (7*self.stitch_offset_y)+2000
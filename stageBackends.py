@@ -0,0 +1,352 @@
+"""
+    This file contains the stage backend classes
+    These classes hand the microscope interface its Nikon Ti, either the real one over COM or a simulated one with a
+    timing model of the stage so moves and whole plate runs can be exercised without the microscope
+"""
+
+
+__author__ = "Corwin Perren"
+__copyright__ = "None"
+__credits__ = [""]
+__license__ = "GPL (GNU General Public License)"
+__version__ = "1.0.0"
+__maintainer__ = "Corwin Perren"
+__email__ = "perrenc@onid.oregonstate.edu"
+__status__ = "Development"
+
+# This file is part of Auto Imager.
+#
+# Auto Imager is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Auto Imager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Auto Imager.  If not, see <http://www.gnu.org/licenses/>.
+
+
+#####################################
+# Imports
+#####################################
+# Python native imports
+import os
+import math
+import time
+
+try:
+    import pythoncom
+    import win32com.client
+except ImportError:
+    win32com = None
+
+# Custom imports
+import settings
+import captureTrace
+
+#####################################
+# Global Variables
+#####################################
+stage_backend_nikon = "nikon"
+stage_backend_simulated = "simulated"
+stage_backend_replay = "replay"
+
+nikon_ti_program_id = "Nikon.TiScope.NikonTi"
+
+# Drive position units, the same the Ti reports over COM
+xy_units_per_um = 10
+z_units_per_um = 40
+
+# Top speed of the XY drives for each of the Ti's speed settings, in um per second. Rough figures, tune them against
+# move times measured on the real stage
+simulated_xy_speeds_um_per_second = {
+    1: 2500,
+    2: 5000,
+    3: 7500,
+    4: 10000,
+    5: 12500,
+    6: 15000,
+    7: 17500,
+    8: 20000,
+    9: 25000
+}
+
+
+#####################################
+# Helper Functions
+#####################################
+def get_stage_backend(backend_name=None):
+    backend_name = backend_name or settings.program_settings.stage_backend
+    if backend_name == stage_backend_simulated:
+        return SimulatedStageBackend()
+    if backend_name == stage_backend_replay:
+        return ReplayStageBackend()
+    if backend_name != stage_backend_nikon:
+        print "Unknown stage backend " + str(backend_name) + ", falling back to nikon"
+    return NikonTiStageBackend()
+
+
+#####################################
+# NikonTiStageBackend Class Definition
+#####################################
+class NikonTiStageBackend(object):
+    """ The real microscope, driven through the Nikon Ti COM server. """
+
+    is_simulated = False
+
+    def __init__(self):
+        if win32com is None:
+            raise ImportError("The nikon stage backend needs pywin32 and the Nikon Ti SDK installed")
+
+    @property
+    def constants(self):
+        return win32com.client.constants
+
+    def startup(self):
+        # Anything else holding the scope keeps us from connecting to it
+        os.popen("taskkill /im NikonTiS.exe /F")
+        time.sleep(1)
+
+    def connect(self):
+        pythoncom.CoInitialize()
+        interface = win32com.client.Dispatch(nikon_ti_program_id)
+        interface.Device = interface.Devices(1)
+        return interface
+
+
+#####################################
+# SimulatedStageBackend Class Definition
+#####################################
+class SimulatedStageBackend(object):
+    """ Stands in for the Ti COM server with a SimulatedNikonTi. """
+
+    is_simulated = True
+
+    def __init__(self):
+        self.settings = settings.program_settings
+        self.constants = SimulatedSpeedConstants()
+        self.interface = None
+
+    def startup(self):
+        pass
+
+    def connect(self):
+        # Always the same scope, so the stage stays where it was across reconnects
+        if self.interface is None:
+            self.interface = SimulatedNikonTi(self.settings.simulated_stage_xy_acceleration_um_per_s2,
+                                              self.settings.simulated_stage_z_speed_um_per_s,
+                                              self.settings.simulated_stage_z_acceleration_um_per_s2,
+                                              self.settings.simulated_stage_settle_ms / 1000.0,
+                                              self.settings.simulated_stage_poll_latency_ms / 1000.0)
+        return self.interface
+
+
+#####################################
+# ReplayStageBackend Class Definition
+#####################################
+class ReplayStageBackend(SimulatedStageBackend):
+    """ Stands in for the Ti COM server with a ReplayNikonTi playing back the trace at capture_trace_replay_path. """
+
+    def connect(self):
+        if self.interface is None:
+            self.interface = ReplayNikonTi(captureTrace.CaptureTrace(self.settings.capture_trace_replay_path),
+                                           self.settings.capture_trace_replay_speed)
+        return self.interface
+
+
+#####################################
+# SimulatedSpeedConstants Class Definition
+#####################################
+class SimulatedSpeedConstants(object):
+    """ The Speed1 to Speed9 values win32com.client.constants has for the Ti. """
+
+    def __init__(self):
+        for speed in simulated_xy_speeds_um_per_second:
+            setattr(self, "Speed" + str(speed), speed)
+
+
+#####################################
+# SimulatedDrive Class Definition
+#####################################
+class SimulatedDrive(object):
+    """ One stage axis that moves with a trapezoidal velocity profile.
+
+    Like the Ti, setting Position or calling MoveRelative blocks until the move is done: the drive accelerates to its
+    top speed for the current Speed setting (or as close as a short move gets), cruises, decelerates, waits out the
+    settle time, and then one position poll has to pass before the controller reports it in position. Reading
+    Position takes a poll as well. get_position_at() gives where the axis was at any host time, moves included.
+    """
+
+    def __init__(self, units_per_um, speeds_um_per_second, acceleration, settle_seconds, poll_latency_seconds,
+                 speed=1):
+        self.units_per_um = units_per_um
+        self.speeds_um_per_second = speeds_um_per_second
+        self.acceleration = float(acceleration)
+        self.settle_seconds = settle_seconds
+        self.poll_latency_seconds = poll_latency_seconds
+        self.Speed = speed
+
+        # Last move as (start time, start um, target um, peak speed, ramp seconds, move seconds)
+        self.motion = (0, 0.0, 0.0, 0.0, 0.0, 0.0)
+
+        # Statistics
+        self.moves = 0
+        self.move_seconds = 0
+
+    @property
+    def Position(self):
+        time.sleep(self.poll_latency_seconds)
+        return int(round(self.get_position_at(time.time()) * self.units_per_um))
+
+    @Position.setter
+    def Position(self, position_units):
+        self.move_to(float(position_units) / self.units_per_um)
+
+    def MoveRelative(self, distance_units):
+        self.move_to(self.get_position_at(time.time()) + (float(distance_units) / self.units_per_um))
+
+    def get_move_seconds(self, distance_um):
+        """ Time from starting a move of distance_um to the controller reporting it done. """
+        peak_speed, ramp_seconds, move_seconds = self.get_profile(abs(distance_um))
+        return move_seconds + self.settle_seconds + self.poll_latency_seconds
+
+    def get_profile(self, distance_um):
+        max_speed = self.speeds_um_per_second[self.Speed]
+        peak_speed = min(max_speed, math.sqrt(distance_um * self.acceleration))
+        ramp_seconds = peak_speed / self.acceleration
+        if peak_speed:
+            move_seconds = (2 * ramp_seconds) + ((distance_um - (peak_speed * ramp_seconds)) / peak_speed)
+        else:
+            move_seconds = 0.0
+        return peak_speed, ramp_seconds, move_seconds
+
+    def move_to(self, target_um):
+        start_time = time.time()
+        start_um = self.get_position_at(start_time)
+        peak_speed, ramp_seconds, move_seconds = self.get_profile(abs(target_um - start_um))
+        self.motion = (start_time, start_um, target_um, peak_speed, ramp_seconds, move_seconds)
+
+        done_time = start_time + move_seconds + self.settle_seconds + self.poll_latency_seconds
+        time.sleep(max(0, done_time - time.time()))
+
+        self.moves += 1
+        self.move_seconds += time.time() - start_time
+
+    def get_position_at(self, host_time):
+        start_time, start_um, target_um, peak_speed, ramp_seconds, move_seconds = self.motion
+        elapsed = host_time - start_time
+        if elapsed >= move_seconds:
+            return target_um
+        if elapsed <= 0:
+            return start_um
+
+        if elapsed < ramp_seconds:
+            travelled = 0.5 * self.acceleration * (elapsed ** 2)
+        elif elapsed < (move_seconds - ramp_seconds):
+            travelled = (0.5 * peak_speed * ramp_seconds) + (peak_speed * (elapsed - ramp_seconds))
+        else:
+            travelled = abs(target_um - start_um) - (0.5 * self.acceleration * ((move_seconds - elapsed) ** 2))
+
+        return start_um + math.copysign(travelled, target_um - start_um)
+
+
+#####################################
+# SimulatedScopePart Class Definition
+#####################################
+class SimulatedScopePart(object):
+    """ Nosepiece, light path, lamp and device, only as much of them as the microscope interface uses. """
+
+    def __init__(self):
+        self.Position = 1
+        self.Value = 0
+        self.is_on = False
+
+    def IsControlled(self):
+        return True
+
+    def On(self):
+        self.is_on = True
+
+    def WaitForDevice(self, timeout_ms):
+        return 0
+
+
+#####################################
+# SimulatedNikonTi Class Definition
+#####################################
+class SimulatedNikonTi(object):
+    """ The parts of the Ti COM interface the microscope interface uses, with simulated XY and Z drives. """
+
+    def __init__(self, xy_acceleration, z_speed, z_acceleration, settle_seconds, poll_latency_seconds):
+        self.XDrive = SimulatedDrive(xy_units_per_um, simulated_xy_speeds_um_per_second, xy_acceleration,
+                                     settle_seconds, poll_latency_seconds)
+        self.YDrive = SimulatedDrive(xy_units_per_um, simulated_xy_speeds_um_per_second, xy_acceleration,
+                                     settle_seconds, poll_latency_seconds)
+        self.ZDrive = SimulatedDrive(z_units_per_um, {1: z_speed}, z_acceleration, settle_seconds,
+                                     poll_latency_seconds)
+
+        self.Nosepiece = SimulatedScopePart()
+        self.LightPathDrive = SimulatedScopePart()
+        self.DiaLamp = SimulatedScopePart()
+        self.Device = None
+
+    def Devices(self, device_number):
+        return SimulatedScopePart()
+
+    def get_xy_position_at(self, host_time):
+        return self.XDrive.get_position_at(host_time), self.YDrive.get_position_at(host_time)
+
+
+#####################################
+# ReplayDrive Class Definition
+#####################################
+class ReplayDrive(SimulatedDrive):
+    """ A stage axis whose relative moves take as long as the next recorded well move, and anything else no time. """
+
+    def __init__(self, units_per_um, move_seconds_function):
+        SimulatedDrive.__init__(self, units_per_um, simulated_xy_speeds_um_per_second, 1, 0, 0)
+        self.move_seconds_function = move_seconds_function
+
+    def move_to(self, target_um):
+        self.motion = (time.time(), target_um, target_um, 0.0, 0.0, 0.0)
+
+    def MoveRelative(self, distance_units):
+        move_seconds = self.move_seconds_function()
+        SimulatedDrive.MoveRelative(self, distance_units)
+        time.sleep(move_seconds)
+
+        self.moves += 1
+        self.move_seconds += move_seconds
+
+
+#####################################
+# ReplayNikonTi Class Definition
+#####################################
+class ReplayNikonTi(SimulatedNikonTi):
+    """ A SimulatedNikonTi whose well to well moves take the recorded times from a capture trace, divided by speed.
+
+    The recorded move time runs from the capture coordinator asking for the move to the microscope interface saying
+    it's done. Every well move is a single relative move on one axis, so each one takes the next recorded time, and
+    the recording loops if the replay outlasts it.
+    """
+
+    def __init__(self, capture_trace, speed=1.0):
+        SimulatedNikonTi.__init__(self, 1, 1, 1, 0, 0)
+        self.capture_trace = capture_trace
+        self.speed = float(speed)
+        self.move_number = 0
+
+        self.XDrive = ReplayDrive(xy_units_per_um, self.get_next_move_seconds)
+        self.YDrive = ReplayDrive(xy_units_per_um, self.get_next_move_seconds)
+        self.ZDrive = ReplayDrive(z_units_per_um, self.get_next_move_seconds)
+
+    def get_next_move_seconds(self):
+        if not self.capture_trace.moves:
+            return 0.0
+        move_seconds = self.capture_trace.get_move_seconds(self.move_number)
+        self.move_number += 1
+        return move_seconds / self.speed
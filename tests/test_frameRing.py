@@ -0,0 +1,117 @@
+"""
+    This file contains the frame ring tests
+    These tests check that well frames are picked by when their exposure started rather than by when they arrived
+"""
+
+__author__ = "Corwin Perren"
+__copyright__ = "None"
+__credits__ = [""]
+__license__ = "GPL (GNU General Public License)"
+__version__ = "1.0.0"
+__maintainer__ = "Corwin Perren"
+__email__ = "perrenc@onid.oregonstate.edu"
+__status__ = "Development"
+
+# This file is part of Auto Imager.
+#
+# Auto Imager is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Auto Imager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Auto Imager.  If not, see <http://www.gnu.org/licenses/>.
+
+#####################################
+# Imports
+#####################################
+# Python native imports
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Custom imports
+import cameraBackends
+import frameRing
+
+
+#####################################
+# Helper Functions
+#####################################
+def make_completed_frame(ring, frame_id, exposure_start_time):
+    captured_frame = frameRing.CapturedFrame(ring, None)
+    captured_frame.frame_id = frame_id
+    captured_frame.exposure_start_time = exposure_start_time
+    captured_frame.reference_count = 1  # Held by the completed queue, as on_frame_complete_callback leaves it
+    ring.completed_frames.put(captured_frame)
+    return captured_frame
+
+
+#####################################
+# FrameExposedAfter Test Case Definition
+#####################################
+class FrameExposedAfterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.ring = frameRing.FrameRing(None, 2)  # Never started, so released frames aren't handed back to a camera
+
+    def test_stale_frames_are_released_and_skipped(self):
+        stale_frame = make_completed_frame(self.ring, 1, 10.0)
+        fresh_frame = make_completed_frame(self.ring, 2, 20.0)
+
+        frame = self.ring.get_frame_exposed_after(15.0, 100)
+
+        self.assertIs(frame, fresh_frame)
+        self.assertEqual(stale_frame.reference_count, 0)
+        self.assertEqual(fresh_frame.reference_count, 1)
+
+    def test_frame_exposed_exactly_at_the_limit_is_fresh(self):
+        fresh_frame = make_completed_frame(self.ring, 1, 15.0)
+
+        self.assertIs(self.ring.get_frame_exposed_after(15.0, 100), fresh_frame)
+
+    def test_timeout_returns_none(self):
+        stale_frame = make_completed_frame(self.ring, 1, 10.0)
+
+        start_time = time.time()
+        frame = self.ring.get_frame_exposed_after(15.0, 100)
+
+        self.assertIsNone(frame)
+        self.assertEqual(stale_frame.reference_count, 0)
+        self.assertLess(time.time() - start_time, 1.0)
+
+
+#####################################
+# SimulatedStream Test Case Definition
+#####################################
+class SimulatedStreamTestCase(unittest.TestCase):
+    def setUp(self):
+        self.camera = cameraBackends.SimulatedCamera("Test", seed=1)
+        self.camera.openCamera()
+        self.ring = frameRing.FrameRing(self.camera, 4)
+        self.ring.start()
+
+    def tearDown(self):
+        self.ring.stop()
+        self.camera.closeCamera()
+
+    def test_frame_exposed_after_starts_exposing_after_the_limit(self):
+        time.sleep(0.5)  # Let the ring fill up with frames exposed before the limit
+        not_before_time = time.time()
+
+        frame = self.ring.get_frame_exposed_after(not_before_time, 1000)
+
+        self.assertIsNotNone(frame)
+        self.assertGreaterEqual(self.camera.exposure_start_times[frame.frame_id], not_before_time)
+        frame.release()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+"""
+    This file contains the image processor tests
+    These tests check that the capture thread survives a camera that can't start streaming
+"""
+
+__author__ = "Corwin Perren"
+__copyright__ = "None"
+__credits__ = [""]
+__license__ = "GPL (GNU General Public License)"
+__version__ = "1.0.0"
+__maintainer__ = "Corwin Perren"
+__email__ = "perrenc@onid.oregonstate.edu"
+__status__ = "Development"
+
+# This file is part of Auto Imager.
+#
+# Auto Imager is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Auto Imager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Auto Imager.  If not, see <http://www.gnu.org/licenses/>.
+
+#####################################
+# Imports
+#####################################
+# Python native imports
+from PyQt4 import QtCore
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Custom imports
+import settings
+import cameraBackends
+import imageProcessor
+
+
+#####################################
+# FailingCamera Class Definition
+#####################################
+class FailingCamera(cameraBackends.SimulatedCamera):
+    """ Opens fine but errors as soon as the ring tries to start capturing. """
+
+    def startCapture(self):
+        raise cameraBackends.SimulatedCameraError("Camera " + self.camera_id + " could not start capture")
+
+
+#####################################
+# Helper Functions
+#####################################
+def make_capturing_image_processor(camera):
+    # Only what the frame paths use, the real constructor connects to the gui and starts the pipeline threads
+    image_processor = imageProcessor.ImageProcessor.__new__(imageProcessor.ImageProcessor)
+    QtCore.QThread.__init__(image_processor)
+
+    image_processor.settings = settings.program_settings
+    image_processor.camera_backend = cameraBackends.SimulatedCameraBackend()
+    image_processor.camera = camera
+    image_processor.frame_ring = None
+    image_processor.frame_callbacks = []
+    image_processor.camera_reconnect_count = 0
+
+    image_processor.camera_connected = True
+    image_processor.wait_for_run_display_flag = False
+    image_processor.cycle_run_display_flag = True
+    image_processor.not_abort = True
+    return image_processor
+
+
+#####################################
+# MissingFrameRing Test Case Definition
+#####################################
+class MissingFrameRingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.camera = FailingCamera("Test", seed=1)
+        self.camera.openCamera()
+        self.image_processor = make_capturing_image_processor(self.camera)
+
+    def tearDown(self):
+        self.camera.closeCamera()
+
+    def test_failed_ring_start_leaves_no_ring(self):
+        self.image_processor.start_frame_ring()
+
+        self.assertIsNone(self.image_processor.frame_ring)
+
+    def test_get_frame_reconnects_without_a_ring(self):
+        self.image_processor.start_frame_ring()
+
+        frame = self.image_processor.get_frame()
+
+        self.assertIsNone(frame)
+        self.assertIsNone(self.image_processor.frame_ring)
+        self.assertEqual(self.image_processor.camera_reconnect_count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+"""
+    This file contains the thread event class
+    This class lets one thread sleep until another hands it work, instead of polling flags on a timer
+"""
+
+__author__ = "Corwin Perren"
+__copyright__ = "None"
+__credits__ = [""]
+__license__ = "GPL (GNU General Public License)"
+__version__ = "1.0.0"
+__maintainer__ = "Corwin Perren"
+__email__ = "perrenc@onid.oregonstate.edu"
+__status__ = "Development"
+
+# This file is part of Auto Imager.
+#
+# Auto Imager is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Auto Imager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Auto Imager.  If not, see <http://www.gnu.org/licenses/>.
+
+#####################################
+# Imports
+#####################################
+# Python native imports
+from PyQt4 import QtCore
+import time
+
+#####################################
+# Global Variables
+#####################################
+
+
+#####################################
+# ThreadEvent Class Definition
+#####################################
+class ThreadEvent(object):
+    """ Auto-resetting event built on a QMutex and QWaitCondition.
+
+    set() wakes anything blocked in wait() straight away. A successful wait() clears the event again, so each set()
+    is consumed once. The time between set() and the waiter waking is recorded as handoff latency, and waits that
+    end on a timeout are counted separately so idle wakeups can be seen.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+        self.mutex = QtCore.QMutex()
+        self.condition = QtCore.QWaitCondition()
+
+        self.is_set = False
+        self.set_time = 0
+
+        # Statistics
+        self.signalled_wakeups = 0
+        self.timed_out_wakeups = 0
+        self.handoff_latency_total = 0.0
+        self.handoff_latency_max = 0.0
+
+    def set(self):
+        self.mutex.lock()
+        if not self.is_set:
+            self.is_set = True
+            self.set_time = time.time()
+        self.condition.wakeAll()
+        self.mutex.unlock()
+
+    def clear(self):
+        self.mutex.lock()
+        self.is_set = False
+        self.mutex.unlock()
+
+    def wait(self, timeout_ms=None):
+        """ Blocks until set() or until timeout_ms runs out. Returns True if the event was set. """
+        self.mutex.lock()
+        try:
+            if timeout_ms is not None:
+                deadline = time.time() + (timeout_ms / 1000.0)
+
+            while not self.is_set:
+                if timeout_ms is None:
+                    self.condition.wait(self.mutex)
+                else:
+                    remaining_ms = int((deadline - time.time()) * 1000)
+                    if remaining_ms <= 0:
+                        break
+                    self.condition.wait(self.mutex, remaining_ms)
+
+            if not self.is_set:
+                self.timed_out_wakeups += 1
+                return False
+
+            handoff_latency = time.time() - self.set_time
+            self.signalled_wakeups += 1
+            self.handoff_latency_total += handoff_latency
+            self.handoff_latency_max = max(self.handoff_latency_max, handoff_latency)
+
+            self.is_set = False
+            return True
+        finally:
+            self.mutex.unlock()
+
+    def get_statistics_string(self):
+        if self.signalled_wakeups:
+            average_ms = (self.handoff_latency_total / self.signalled_wakeups) * 1000
+        else:
+            average_ms = 0
+        return "%s: %d handoffs (avg %.2f ms, max %.2f ms), %d timed out wakeups" % \
+               (self.name, self.signalled_wakeups, average_ms, self.handoff_latency_max * 1000,
+                self.timed_out_wakeups)
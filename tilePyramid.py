@@ -0,0 +1,198 @@
+"""
+    This file contains the tile pyramid writer class
+    This class writes a composite out as fixed size tiles at several zoom levels as wells are added to it
+"""
+
+__author__ = "Corwin Perren"
+__copyright__ = "None"
+__credits__ = [""]
+__license__ = "GPL (GNU General Public License)"
+__version__ = "1.0.0"
+__maintainer__ = "Corwin Perren"
+__email__ = "perrenc@onid.oregonstate.edu"
+__status__ = "Development"
+
+# This file is part of Auto Imager.
+#
+# Auto Imager is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Auto Imager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Auto Imager.  If not, see <http://www.gnu.org/licenses/>.
+
+#####################################
+# Imports
+#####################################
+# Python native imports
+import os
+import json
+import cv2
+
+# Custom imports
+import wellImageWriter
+
+#####################################
+# Global Variables
+#####################################
+pyramid_description_filename = "pyramid.json"
+
+lossless_tile_extensions = (".png", ".tif", ".tiff", ".bmp")
+
+
+#####################################
+# TilePyramidWriter Class Definition
+#####################################
+class TilePyramidWriter(object):
+    """ Keeps a tiled image pyramid on disk in step with a CompositeCanvas.
+
+    Level 0 is full resolution and every level after it is half the size of the one before, down to the level where
+    the whole composite fits in a single tile. Tiles are stored as <level>/<row>_<column><extension> under root_path
+    next to a pyramid.json describing the layout, and tiles on the right and bottom edges are cut short rather than
+    padded.
+
+    update_region() marks the tiles that overlap a changed region of the canvas dirty on every level. A tile is only
+    written once every one of the expected_regions overlapping it has been updated, so with the plate's well regions
+    each tile is encoded once per plate rather than once for every well that touches it. finish() writes whatever is
+    still dirty, which is everything when there are no expected regions. The file written callback only ever hears
+    about tiles that are done.
+    """
+
+    def __init__(self, root_path, canvas, tile_size, tile_extension, file_written_callback=None, expected_regions=()):
+        self.root_path = root_path
+        self.canvas = canvas
+        self.tile_size = tile_size
+        self.tile_extension = tile_extension
+        self.file_written_callback = file_written_callback  # Called as callback(path, size_in_bytes)
+
+        self.level_count = 1
+        while (max(canvas.x_size, canvas.y_size) >> (self.level_count - 1)) > tile_size:
+            self.level_count += 1
+
+        for level in range(self.level_count):
+            level_path = self.get_level_path(level)
+            if not os.path.isdir(level_path):
+                os.makedirs(level_path)
+
+        # Expected regions still to be updated over each tile, keyed by (level, row, column)
+        self.pending_region_counts = {}
+        for region in expected_regions:
+            for tile_key in self.get_overlapping_tiles(*region):
+                self.pending_region_counts[tile_key] = self.pending_region_counts.get(tile_key, 0) + 1
+        self.dirty_tiles = set()
+
+        self.write_description()
+
+    def get_level_path(self, level):
+        return self.root_path + "\\" + str(level)
+
+    def get_tile_path(self, level, row, column):
+        return self.get_level_path(level) + "\\" + str(row) + "_" + str(column) + self.tile_extension
+
+    def write_description(self):
+        description = {
+            "width": self.canvas.x_size,
+            "height": self.canvas.y_size,
+            "tile_size": self.tile_size,
+            "levels": self.level_count,
+            "tile_path": "<level>/<row>_<column>" + self.tile_extension,
+            "level_scale": "level n is 1/(2^n) of full resolution"
+        }
+
+        description_path = self.root_path + "\\" + pyramid_description_filename
+        with open(description_path + ".tmp", "w") as description_file:
+            json.dump(description, description_file, indent=4)
+        wellImageWriter.replace_file(description_path + ".tmp", description_path)
+
+    def get_overlapping_tiles(self, x, y, x_size, y_size):
+        tile_keys = []
+        for level in range(self.level_count):
+            level_tile_size = self.tile_size << level  # Full resolution pixels covered by one tile on this level
+
+            first_column = max(0, x) / level_tile_size
+            last_column = (min(x + x_size, self.canvas.x_size) - 1) / level_tile_size
+            first_row = max(0, y) / level_tile_size
+            last_row = (min(y + y_size, self.canvas.y_size) - 1) / level_tile_size
+
+            for row in range(first_row, last_row + 1):
+                for column in range(first_column, last_column + 1):
+                    tile_keys.append((level, row, column))
+        return tile_keys
+
+    def update_region(self, x, y, x_size, y_size):
+        for tile_key in self.get_overlapping_tiles(x, y, x_size, y_size):
+            self.dirty_tiles.add(tile_key)
+
+            pending_region_count = self.pending_region_counts.get(tile_key)
+            if pending_region_count is None:
+                continue  # Not covered by any expected region, it's written by finish()
+
+            pending_region_count -= 1
+            if pending_region_count > 0:
+                self.pending_region_counts[tile_key] = pending_region_count
+                continue
+
+            del self.pending_region_counts[tile_key]
+            self.dirty_tiles.discard(tile_key)
+            self.write_tile(*tile_key)
+
+    def finish(self):
+        """ Writes every tile still waiting on a region, for a plate that stopped short or had no expected regions. """
+        for tile_key in sorted(self.dirty_tiles):
+            self.write_tile(*tile_key)
+        self.dirty_tiles = set()
+        self.pending_region_counts = {}
+
+    def read_full_resolution_tiles(self):
+        """ Fills the canvas back in from the level 0 tiles on disk.
+
+        Returns False if the tiles are lossy or any of them is missing or the wrong size, as then they can't stand in
+        for the canvas they were cut from.
+        """
+        if self.tile_extension.lower() not in lossless_tile_extensions:
+            return False
+
+        for row in range(((self.canvas.y_size - 1) / self.tile_size) + 1):
+            for column in range(((self.canvas.x_size - 1) / self.tile_size) + 1):
+                region = self.canvas.read_region(column * self.tile_size, row * self.tile_size, self.tile_size,
+                                                 self.tile_size)
+                try:
+                    tile = wellImageWriter.load_well_image(self.get_tile_path(0, row, column))
+                except IOError:
+                    return False
+                if tile.shape[:2] != region.shape[:2]:
+                    return False
+                region[:] = tile[:, :, ::-1]
+        return True
+
+    def write_tile(self, level, row, column):
+        level_tile_size = self.tile_size << level
+        region = self.canvas.read_region(column * level_tile_size, row * level_tile_size,
+                                         level_tile_size, level_tile_size)
+
+        if level:
+            # Subsample to twice the tile size before averaging, so high levels don't read the whole region
+            step = max(1, (1 << level) / 2)
+            region_y_size, region_x_size = region.shape[:2]
+            tile_x_size = max(1, region_x_size >> level)
+            tile_y_size = max(1, region_y_size >> level)
+            tile = cv2.resize(region[::step, ::step], (tile_x_size, tile_y_size), interpolation=cv2.INTER_AREA)
+        else:
+            tile = region
+
+        ret, encoded = cv2.imencode(self.tile_extension, cv2.cvtColor(tile, cv2.COLOR_RGB2BGR))
+        encoded_data = encoded.tostring()
+
+        tile_path = self.get_tile_path(level, row, column)
+        with open(tile_path + ".tmp", "wb") as tile_file:
+            tile_file.write(encoded_data)
+        wellImageWriter.replace_file(tile_path + ".tmp", tile_path)  # Viewers never see half written tiles
+
+        if self.file_written_callback:
+            self.file_written_callback(tile_path, len(encoded_data))
@@ -0,0 +1,200 @@
+"""
+    This file contains the timeline tracer class
+    This class collects timed spans from every thread while a plate is captured and saves them as a Chrome trace
+"""
+
+
+__author__ = "Corwin Perren"
+__copyright__ = "None"
+__credits__ = [""]
+__license__ = "GPL (GNU General Public License)"
+__version__ = "1.0.0"
+__maintainer__ = "Corwin Perren"
+__email__ = "perrenc@onid.oregonstate.edu"
+__status__ = "Development"
+
+# This file is part of Auto Imager.
+#
+# Auto Imager is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Auto Imager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Auto Imager.  If not, see <http://www.gnu.org/licenses/>.
+
+
+#####################################
+# Imports
+#####################################
+# Python native imports
+import os
+import json
+import threading
+import time
+
+# Custom imports
+import settings
+
+#####################################
+# Global Variables
+#####################################
+timeline_filename = "timeline.json"
+timeline_process_id = 1
+
+summary_span_count = 12  # Span names listed in the statistics string, the ones with the most total time
+
+
+#####################################
+# Helper Functions
+#####################################
+def name_current_thread(name):
+    # QThreads show up in python as Dummy-N, this gives their spans a readable track name
+    threading.current_thread().name = name
+
+
+#####################################
+# TimelineSpan Class Definition
+#####################################
+class TimelineSpan(object):
+    """ Times the code in a with block and adds it to the timeline as a span on the current thread's track. """
+
+    def __init__(self, tracer, name, well_name, arguments):
+        self.tracer = tracer
+        self.name = name
+        self.well_name = well_name
+        self.arguments = arguments
+        self.start_time = 0
+
+    def __enter__(self):
+        self.start_time = time.time()
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        self.tracer.add_span(self.name, self.start_time, time.time(), self.well_name, **self.arguments)
+        return False
+
+
+#####################################
+# TimelineTracer Class Definition
+#####################################
+class TimelineTracer(object):
+    """ Timeline of a plate run, saved in the Chrome trace event format for chrome://tracing or ui.perfetto.dev.
+
+    Spans go on the track of the thread that recorded them unless they name a track of their own, like the camera's
+    exposures. Spans carry the well they belong to, which defaults to the well the stage was last sent to, so the
+    time for any one well can be picked out across every thread. Nothing is recorded between plates, but span
+    callbacks still hear about every span so live metrics keep going whether or not a plate is being traced.
+    """
+
+    def __init__(self):
+        self.settings = settings.program_settings
+
+        self.trace_lock = threading.Lock()
+        self.plate_id = None
+        self.start_time = None
+        self.current_well_name = None
+        self.events = []
+        self.track_ids = {}
+        self.span_totals = {}  # Span name: [count, total seconds]
+        self.span_callbacks = []
+
+    def is_tracing(self):
+        return self.start_time is not None
+
+    def start_plate(self, plate_id):
+        with self.trace_lock:
+            self.events = []
+            self.track_ids = {}
+            self.span_totals = {}
+            self.current_well_name = None
+            self.plate_id = plate_id
+            self.start_time = time.time() if self.settings.timeline_tracing else None
+
+    def finish_plate(self, path):
+        """ Saves the plate's timeline to path and stops tracing. Returns the size written, or None if not tracing. """
+        with self.trace_lock:
+            if self.start_time is None:
+                return None
+
+            trace_events = [{"name": "process_name", "ph": "M", "pid": timeline_process_id, "tid": 0,
+                             "args": {"name": "Plate " + str(self.plate_id)}}]
+            for track_name, track_id in self.track_ids.items():
+                trace_events.append({"name": "thread_name", "ph": "M", "pid": timeline_process_id, "tid": track_id,
+                                     "args": {"name": track_name}})
+            trace_events.extend(self.events)
+            self.events = []
+
+            timeline = {
+                "traceEvents": trace_events,
+                "displayTimeUnit": "ms",
+                "otherData": {
+                    "plate_id": str(self.plate_id),
+                    "start_time": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.start_time))
+                }
+            }
+            self.start_time = None
+
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as timeline_file:
+            json.dump(timeline, timeline_file, separators=(",", ":"))
+        return os.path.getsize(path)
+
+    def set_current_well(self, well_name):
+        self.current_well_name = well_name
+
+    def add_span_callback(self, callback):
+        # Called as callback(name, seconds) on the thread that recorded the span, keep it short
+        self.span_callbacks.append(callback)
+
+    def span(self, name, well_name=None, **arguments):
+        return TimelineSpan(self, name, well_name, arguments)
+
+    def add_span(self, name, start_time, end_time, well_name=None, track=None, **arguments):
+        """ Adds a span measured elsewhere. Times are host time.time() values.
+
+        well_name defaults to the current well, pass "" for spans that don't belong to any one well.
+        """
+        for callback in self.span_callbacks:
+            callback(name, end_time - start_time)
+
+        with self.trace_lock:
+            if self.start_time is None:
+                return
+
+            track = track or threading.current_thread().name
+            track_id = self.track_ids.setdefault(track, len(self.track_ids) + 1)
+
+            if well_name is None:
+                well_name = self.current_well_name
+            if well_name:
+                arguments["well"] = well_name
+            self.events.append({"name": name, "ph": "X", "pid": timeline_process_id, "tid": track_id,
+                                "ts": int((start_time - self.start_time) * 1000000),
+                                "dur": max(0, int((end_time - start_time) * 1000000)), "args": arguments})
+
+            span_total = self.span_totals.setdefault(name, [0, 0.0])
+            span_total[0] += 1
+            span_total[1] += end_time - start_time
+
+    def get_statistics_string(self):
+        with self.trace_lock:
+            span_totals = sorted(self.span_totals.items(), key=lambda item: item[1][1], reverse=True)
+
+        lines = ["Timeline of plate " + str(self.plate_id) + ":"]
+        for name, (count, total_seconds) in span_totals[:summary_span_count]:
+            lines.append("    %-24s %6d spans, %8.2f s total, %7.1f ms average" %
+                         (name, count, total_seconds, (total_seconds / count) * 1000))
+        return "\n".join(lines)
+
+
+#####################################
+# TimelineTracer Class Global Instantiation
+#####################################
+timeline = TimelineTracer()
@@ -0,0 +1,461 @@
+"""
+    This file contains the upload engine class
+    This class copies plate files to the remote server in the background as soon as they are written locally
+"""
+
+__author__ = "Corwin Perren"
+__copyright__ = "None"
+__credits__ = [""]
+__license__ = "GPL (GNU General Public License)"
+__version__ = "1.0.0"
+__maintainer__ = "Corwin Perren"
+__email__ = "perrenc@onid.oregonstate.edu"
+__status__ = "Development"
+
+# This file is part of Auto Imager.
+#
+# Auto Imager is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Auto Imager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Auto Imager.  If not, see <http://www.gnu.org/licenses/>.
+
+
+#####################################
+# Imports
+#####################################
+# Python native imports
+import os
+import time
+import heapq
+import threading
+
+# Custom imports
+import settings
+import threadEvents
+import pipelineWorkers
+import wellImageWriter
+import timelineTracer
+
+#####################################
+# Global Variables
+#####################################
+upload_chunk_size = 1 << 20
+upload_queue_size = 4096  # Large enough that queueing an upload never holds up the writer that finished the file
+
+upload_journal_filename = "upload_queue.journal"
+journal_add = "+"
+journal_remove = "-"
+journal_seal = "*"
+journal_unseal = "!"
+
+
+#####################################
+# BandwidthLimiter Class Definition
+#####################################
+class BandwidthLimiter(object):
+    """ Token bucket shared by all upload workers. A rate of 0 or less means no limit. """
+
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self.capacity = max(upload_chunk_size, bytes_per_second / 4)  # Allows bursts of a quarter second
+
+        self.lock = threading.Lock()
+        self.tokens = self.capacity
+        self.last_refill_time = time.time()
+
+        self.throttled_time = 0.0
+
+    def consume(self, byte_count):
+        if self.bytes_per_second <= 0:
+            return
+
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + ((now - self.last_refill_time) * self.bytes_per_second))
+            self.last_refill_time = now
+
+            # Take the tokens now, going into debt if needed, and sleep off the debt outside the lock
+            self.tokens -= byte_count
+            wait_time = -self.tokens / float(self.bytes_per_second) if self.tokens < 0 else 0
+            self.throttled_time += wait_time
+
+        if wait_time:
+            time.sleep(wait_time)
+
+
+#####################################
+# UploadEngine Class Definition
+#####################################
+class UploadEngine(object):
+    """ Mirrors files from local_output_path to the same relative place under remote_output_path.
+
+    enqueue() is meant to be called as soon as a file is complete, and a small pool of workers streams it to the
+    server. Each upload goes to a .partial file named after the size and modification time of the local file, and is
+    renamed into place once complete, so the server never shows a half copied file. If an upload is interrupted the
+    next attempt appends to the matching .partial instead of starting over. A file queued again while it is still
+    waiting is only uploaded once, in its newest version.
+
+    Everything not yet uploaded is kept in upload_queue.journal in the output folder, so uploads carry on after a
+    restart. Failed uploads are retried with exponential backoff, and when the server can't be reached at all every
+    upload waits out a shared backoff instead of trying it. Upload bandwidth is capped by a shared token bucket.
+
+    seal_plate() marks a plate as finished locally, the plate uploaded callbacks are called with its id once the last
+    of its files is up.
+    """
+
+    def __init__(self):
+        self.settings = settings.program_settings
+
+        self.local_root_path = self.settings.local_output_path
+        self.remote_root_path = self.settings.remote_output_path
+        self.journal_path = self.local_root_path + "\\" + upload_journal_filename
+
+        self.pending_lock = threading.Lock()
+        self.queued_paths = set()  # Everything not uploaded yet, this is what the journal records
+        self.queued_count_by_plate = {}
+        self.sealed_plate_ids = set()
+        self.finishing_plate_ids = set()  # Plates whose uploaded callbacks are running
+        self.held_plate_ids = set()  # Plates still being worked on after their upload, see hold_plate()
+        self.pending_paths = set()  # Queued and not started yet
+        self.active_paths = set()  # Being uploaded by a worker right now
+        self.requeue_paths = set()  # Written again while being uploaded, go around once more when done
+
+        self.retry_heap = []  # (due time, local path)
+        self.retry_attempts = {}
+        self.offline_until = 0
+        self.offline_backoff = 0
+
+        self.plate_uploaded_callbacks = []
+
+        self.journal_file = None
+        self.journal_line_count = 0
+
+        # Statistics
+        self.files_uploaded = 0
+        self.bytes_uploaded = 0
+        self.bytes_resumed = 0
+        self.upload_time = 0.0
+        self.failed_uploads = 0
+
+        self.bandwidth_limiter = BandwidthLimiter(self.settings.upload_max_bytes_per_second)
+
+        self.load_journal()
+
+        self.upload_stage = pipelineWorkers.PipelineStage("Upload", self.upload_file,
+                                                          self.settings.upload_worker_count, upload_queue_size)
+
+        self.not_abort = True
+        self.retry_event = threadEvents.ThreadEvent("Upload retry")
+        self.retry_thread = threading.Thread(target=self.retry_run, name="Upload retry")
+        self.retry_thread.daemon = True
+
+    def start(self):
+        # Restored uploads are fed in by the retry thread, so starting up never waits on the server. Called once the
+        # plate uploaded callbacks are in place so a plate finishing straight away isn't missed.
+        self.retry_thread.start()
+
+    def load_journal(self):
+        if os.path.isfile(self.journal_path):
+            with open(self.journal_path, "r") as journal_file:
+                for line in journal_file:
+                    operation, local_path = line[:1], line[2:].rstrip("\n")
+                    if operation == journal_add:
+                        self.queued_paths.add(local_path)
+                    elif operation == journal_remove:
+                        self.queued_paths.discard(local_path)
+                    elif operation == journal_seal:
+                        self.sealed_plate_ids.add(local_path)
+                    elif operation == journal_unseal:
+                        self.sealed_plate_ids.discard(local_path)
+
+        for local_path in self.queued_paths:
+            plate_id = self.get_plate_id(local_path)
+            self.queued_count_by_plate[plate_id] = self.queued_count_by_plate.get(plate_id, 0) + 1
+            self.retry_heap.append((0, local_path))
+        heapq.heapify(self.retry_heap)
+
+        if self.queued_paths:
+            print "Resuming " + str(len(self.queued_paths)) + " uploads from the last session"
+
+        self.compact_journal()
+
+    def compact_journal(self):
+        # Called with pending_lock held, or before the workers start
+        if self.journal_file:
+            self.journal_file.close()
+
+        if not os.path.isdir(self.local_root_path):
+            os.makedirs(self.local_root_path)
+
+        temp_path = self.journal_path + ".tmp"
+        with open(temp_path, "w") as journal_file:
+            for local_path in self.queued_paths:
+                journal_file.write(journal_add + " " + local_path + "\n")
+            for plate_id in self.sealed_plate_ids:
+                journal_file.write(journal_seal + " " + plate_id + "\n")
+        wellImageWriter.replace_file(temp_path, self.journal_path)
+
+        self.journal_line_count = len(self.queued_paths) + len(self.sealed_plate_ids)
+        self.journal_file = open(self.journal_path, "a")
+
+    def write_journal(self, operation, value):
+        # Called with pending_lock held
+        self.journal_file.write(operation + " " + value + "\n")
+        self.journal_file.flush()
+        self.journal_line_count += 1
+
+        if self.journal_line_count > (2 * (len(self.queued_paths) + len(self.sealed_plate_ids))) + 1024:
+            self.compact_journal()
+
+    def get_relative_path(self, local_path):
+        return os.path.relpath(local_path, self.local_root_path).replace("/", "\\")
+
+    def get_plate_id(self, local_path):
+        return self.get_relative_path(local_path).partition("\\")[0]
+
+    def get_remote_path(self, local_path):
+        return self.remote_root_path + "\\" + self.get_relative_path(local_path)
+
+    def add_plate_uploaded_callback(self, callback):
+        # Called as callback(plate_id) from an upload worker
+        self.plate_uploaded_callbacks.append(callback)
+
+    def enqueue(self, local_path):
+        with self.pending_lock:
+            if local_path not in self.queued_paths:
+                self.queued_paths.add(local_path)
+                plate_id = self.get_plate_id(local_path)
+                self.queued_count_by_plate[plate_id] = self.queued_count_by_plate.get(plate_id, 0) + 1
+                self.write_journal(journal_add, local_path)
+
+            if local_path in self.pending_paths:
+                return  # Already waiting, the worker will pick up whatever is on disk when it gets to it
+            self.pending_paths.add(local_path)
+
+        if not self.upload_stage.is_worker_thread():
+            self.upload_stage.submit(local_path)
+        elif not self.upload_stage.try_submit(local_path):
+            # Upload workers re-queue files and run the plate callbacks, if they all blocked on their own full queue
+            # nothing would ever empty it. The retry thread submits it instead, blocking is fine there.
+            with self.pending_lock:
+                self.pending_paths.discard(local_path)
+            self.schedule_retry(local_path, 0)
+
+    def seal_plate(self, plate_id):
+        with self.pending_lock:
+            self.sealed_plate_ids.add(plate_id)
+            self.write_journal(journal_seal, plate_id)
+        self.check_plate_uploaded(plate_id)
+
+    def check_plate_uploaded(self, plate_id):
+        with self.pending_lock:
+            if (plate_id not in self.sealed_plate_ids) or self.queued_count_by_plate.get(plate_id):
+                return
+            self.sealed_plate_ids.discard(plate_id)
+            self.write_journal(journal_unseal, plate_id)
+            self.finishing_plate_ids.add(plate_id)
+
+        try:
+            for callback in self.plate_uploaded_callbacks:
+                callback(plate_id)
+        finally:
+            with self.pending_lock:
+                self.finishing_plate_ids.discard(plate_id)
+
+    def schedule_retry(self, local_path, due_time):
+        with self.pending_lock:
+            heapq.heappush(self.retry_heap, (due_time, local_path))
+        self.retry_event.set()
+
+    def retry_run(self):
+        while self.not_abort:
+            due_paths = []
+            next_due_time = None
+            with self.pending_lock:
+                now = time.time()
+                while self.retry_heap and (self.retry_heap[0][0] <= now):
+                    due_time, local_path = heapq.heappop(self.retry_heap)
+                    if local_path in self.queued_paths:  # Otherwise it was uploaded since
+                        due_paths.append(local_path)
+                if self.retry_heap:
+                    next_due_time = self.retry_heap[0][0]
+
+            for local_path in due_paths:
+                if not self.not_abort:
+                    break
+                self.enqueue(local_path)
+
+            if next_due_time is None:
+                self.retry_event.wait()
+            else:
+                self.retry_event.wait(max(1, int((next_due_time - time.time()) * 1000)))
+
+    def flush(self):
+        """ Blocks until every upload queued so far has been tried once. Retries that are waiting aren't waited for. """
+        self.upload_stage.join()
+
+    def stop(self):
+        self.not_abort = False
+        self.retry_event.set()
+        self.retry_thread.join()
+        self.upload_stage.stop()
+        with self.pending_lock:
+            self.journal_file.close()
+
+    def get_queued_count(self):
+        with self.pending_lock:
+            return len(self.queued_paths)
+
+    def get_pending_count(self):
+        return self.upload_stage.get_pending_count()
+
+    def hold_plate(self, plate_id):
+        # For plate uploaded callbacks that hand the plate on to another thread, it stays busy until release_plate()
+        with self.pending_lock:
+            self.held_plate_ids.add(plate_id)
+
+    def release_plate(self, plate_id):
+        with self.pending_lock:
+            self.held_plate_ids.discard(plate_id)
+
+    def get_busy_plate_ids(self):
+        """ Plates the engine still has work for, whose local files must not be deleted yet.
+
+        That's any plate with files queued, uploading or waiting on a retry, sealed plates waiting on their last file,
+        plates whose uploaded callbacks are still running and plates held by them.
+        """
+        with self.pending_lock:
+            busy_plate_ids = set(plate_id for plate_id, queued_count in self.queued_count_by_plate.items()
+                                 if queued_count)
+            busy_plate_ids.update(self.sealed_plate_ids)
+            busy_plate_ids.update(self.finishing_plate_ids)
+            busy_plate_ids.update(self.held_plate_ids)
+            return busy_plate_ids
+
+    def is_server_reachable(self):
+        return os.path.isdir(self.remote_root_path[:3])
+
+    def upload_file(self, local_path):
+        with self.pending_lock:
+            self.pending_paths.discard(local_path)  # Anything written from here on needs another upload
+            if local_path in self.active_paths:
+                self.requeue_paths.add(local_path)  # Two workers must never share a .partial
+                return
+            if local_path not in self.queued_paths:
+                return  # A duplicate that was already uploaded
+            if time.time() < self.offline_until:
+                heapq.heappush(self.retry_heap, (self.offline_until, local_path))
+                return  # The retry thread is already due to wake by then for whatever failed first
+            self.active_paths.add(local_path)
+
+        start_time = time.time()
+        upload_succeeded = False
+        try:
+            if os.path.isfile(local_path):  # May have been deleted before its turn came
+                well_name = ""
+                if os.path.basename(os.path.dirname(local_path)) == self.settings.well_images_folder_name:
+                    well_name = os.path.splitext(os.path.basename(local_path))[0]
+                with timelineTracer.timeline.span("Upload", well_name, file=self.get_relative_path(local_path)):
+                    self.copy_to_server(local_path, self.get_remote_path(local_path))
+            upload_succeeded = True
+        except (IOError, OSError), e:
+            self.on_upload_failed(local_path, e)
+        finally:
+            with self.pending_lock:
+                self.upload_time += time.time() - start_time
+                self.active_paths.discard(local_path)
+                should_requeue = local_path in self.requeue_paths
+                self.requeue_paths.discard(local_path)
+
+        if should_requeue:
+            self.enqueue(local_path)
+        elif upload_succeeded:
+            self.on_upload_succeeded(local_path)
+
+    def on_upload_succeeded(self, local_path):
+        plate_id = self.get_plate_id(local_path)
+        with self.pending_lock:
+            self.offline_backoff = 0
+            self.retry_attempts.pop(local_path, None)
+            if local_path in self.queued_paths:
+                self.queued_paths.discard(local_path)
+                self.queued_count_by_plate[plate_id] -= 1
+                self.write_journal(journal_remove, local_path)
+
+        self.check_plate_uploaded(plate_id)
+
+    def on_upload_failed(self, local_path, error):
+        server_reachable = self.is_server_reachable()
+        initial_delay = self.settings.upload_retry_initial_delay_ms / 1000.0
+        max_delay = self.settings.upload_retry_max_delay_ms / 1000.0
+
+        with self.pending_lock:
+            self.failed_uploads += 1
+            attempts = self.retry_attempts.get(local_path, 0) + 1
+            self.retry_attempts[local_path] = attempts
+
+            if server_reachable:
+                due_time = time.time() + min(max_delay, initial_delay * (2 ** min(attempts - 1, 16)))
+            else:
+                # Everything would fail the same way, so back off the whole engine rather than each file
+                if time.time() >= self.offline_until:
+                    self.offline_backoff = min(max_delay, (self.offline_backoff * 2) or initial_delay)
+                    self.offline_until = time.time() + self.offline_backoff
+                    print "Remote server unreachable, retrying uploads in %.0f seconds" % self.offline_backoff
+                due_time = self.offline_until
+
+        if server_reachable:
+            print "Upload of " + local_path + " failed (attempt " + str(attempts) + "): " + str(error)
+        self.schedule_retry(local_path, due_time)
+
+    def copy_to_server(self, local_path, remote_path):
+        source_size = os.path.getsize(local_path)
+        source_mtime = os.path.getmtime(local_path)
+        partial_path = "%s.%d-%d.partial" % (remote_path, source_size, int(source_mtime * 1000))
+
+        remote_directory = os.path.dirname(remote_path)
+        if not os.path.isdir(remote_directory):
+            try:
+                os.makedirs(remote_directory)
+            except OSError:
+                pass  # Another upload worker made it first
+
+        # A partial with this name can only be from the same version of the file, so it is safe to carry on from it
+        resume_offset = 0
+        if os.path.isfile(partial_path):
+            resume_offset = os.path.getsize(partial_path)
+            if resume_offset > source_size:
+                resume_offset = 0
+
+        with open(local_path, "rb") as source_file:
+            source_file.seek(resume_offset)
+            with open(partial_path, "ab" if resume_offset else "wb") as partial_file:
+                while True:
+                    chunk = source_file.read(upload_chunk_size)
+                    if not chunk:
+                        break
+                    self.bandwidth_limiter.consume(len(chunk))
+                    partial_file.write(chunk)
+
+        wellImageWriter.replace_file(partial_path, remote_path)
+
+        with self.pending_lock:
+            self.files_uploaded += 1
+            self.bytes_uploaded += source_size - resume_offset
+            self.bytes_resumed += resume_offset
+
+    def get_statistics_string(self):
+        with self.pending_lock:
+            return "Upload: %d files, %.1f MB in %.2f s (%.2f s throttled), %.1f MB resumed, %d failed attempts, " \
+                   "%d still queued" % \
+                   (self.files_uploaded, self.bytes_uploaded / 1000000.0, self.upload_time,
+                    self.bandwidth_limiter.throttled_time, self.bytes_resumed / 1000000.0, self.failed_uploads,
+                    len(self.queued_paths))
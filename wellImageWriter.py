@@ -0,0 +1,181 @@
+"""
+    This file contains the well image writer class
+    This class encodes and writes well images to disk on a pool of background workers
+"""
+
+__author__ = "Corwin Perren"
+__copyright__ = "None"
+__credits__ = [""]
+__license__ = "GPL (GNU General Public License)"
+__version__ = "1.0.0"
+__maintainer__ = "Corwin Perren"
+__email__ = "perrenc@onid.oregonstate.edu"
+__status__ = "Development"
+
+# This file is part of Auto Imager.
+#
+# Auto Imager is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Auto Imager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Auto Imager.  If not, see <http://www.gnu.org/licenses/>.
+
+#####################################
+# Imports
+#####################################
+# Python native imports
+import os
+import io
+import cv2
+import numpy as np
+import Image
+
+# Custom imports
+import settings
+import pipelineWorkers
+import timelineTracer
+
+#####################################
+# Global Variables
+#####################################
+codec_extensions = {
+    "png": ".png",
+    "tiff": ".tif",
+    "npy": ".npy"
+}
+
+well_image_extensions = codec_extensions.values()
+
+
+#####################################
+# Helper Functions
+#####################################
+def replace_file(source_path, destination_path):
+    # os.rename won't overwrite an existing file on windows
+    if os.path.exists(destination_path):
+        os.remove(destination_path)
+    os.rename(source_path, destination_path)
+
+
+def is_well_image_file(path):
+    return os.path.splitext(path)[1].lower() in well_image_extensions
+
+
+def load_well_image(path):
+    """ Reads a well image written with any of the writer's codecs as a BGR array.
+
+    The file read and the OpenCV decode both release the GIL, so several of these can usefully run on a thread pool.
+    """
+    if os.path.splitext(path)[1].lower() == ".npy":
+        return np.load(path)
+
+    bgr_image = cv2.imdecode(np.fromfile(path, np.uint8), cv2.IMREAD_COLOR)
+    if bgr_image is None:
+        raise IOError("Could not decode well image " + path)
+    return bgr_image
+
+
+def read_well_image_size(path):
+    """ Returns the (width, height) of a well image from its header, without decoding it. """
+    if os.path.splitext(path)[1].lower() == ".npy":
+        y_size, x_size = np.load(path, mmap_mode="r").shape[:2]
+        return x_size, y_size
+
+    with open(path, "rb") as image_file:
+        return Image.open(image_file).size
+
+
+#####################################
+# WellImageWriter Class Definition
+#####################################
+class WellImageWriter(object):
+    """ Writes well images with the configured codec from a bounded queue of background workers.
+
+    Every file is written under a temporary name, optionally fsync'd, and only then renamed into place, so anything
+    that sees a well image file can rely on it being complete. flush() is the barrier for everything queued so far.
+    """
+
+    def __init__(self):
+        self.settings = settings.program_settings
+
+        self.codec = self.settings.well_image_codec
+        if self.codec not in codec_extensions:
+            print "Unknown well image codec " + str(self.codec) + ", falling back to png"
+            self.codec = "png"
+
+        self.file_written_callbacks = []
+
+        self.write_stage = pipelineWorkers.PipelineStage("Well image writer", self.write_image_to_disk,
+                                                         self.settings.well_writer_worker_count,
+                                                         self.settings.well_pipeline_queue_size)
+
+    def get_extension(self):
+        return codec_extensions[self.codec]
+
+    def add_file_written_callback(self, callback):
+        # Called as callback(path, size_in_bytes) from a writer worker once the file is in place
+        self.file_written_callbacks.append(callback)
+
+    def write(self, directory, base_name, bgr_image):
+        full_path_string = directory + "\\" + base_name + self.get_extension()
+        self.write_stage.submit(full_path_string, bgr_image)  # Blocks while the writers are backed up
+        return full_path_string
+
+    def flush(self):
+        self.write_stage.join()
+
+    def stop(self):
+        self.write_stage.stop()
+
+    def get_queue_depth(self):
+        return self.write_stage.get_queue_depth()
+
+    def get_pending_count(self):
+        return self.write_stage.get_pending_count()
+
+    def get_statistics_string(self):
+        return self.write_stage.get_statistics_string()
+
+    def encode_image(self, bgr_image):
+        if self.codec == "png":
+            ret, encoded = cv2.imencode(".png", bgr_image,
+                                        [cv2.IMWRITE_PNG_COMPRESSION, self.settings.well_image_png_compression])
+            return encoded.tostring()
+        elif self.codec == "tiff":
+            ret, encoded = cv2.imencode(".tif", bgr_image)
+            return encoded.tostring()
+        else:
+            output = io.BytesIO()
+            np.save(output, bgr_image)
+            return output.getvalue()
+
+    def write_image_to_disk(self, full_path_string, bgr_image):
+        well_name = os.path.splitext(os.path.basename(full_path_string))[0]
+        with timelineTracer.timeline.span("Encode well image", well_name, codec=self.codec):
+            encoded_data = self.encode_image(bgr_image)
+
+        root_path_string = os.path.dirname(full_path_string)
+        if not os.path.isdir(root_path_string):
+            try:
+                os.makedirs(root_path_string)
+            except OSError:
+                pass  # Another writer made it first
+
+        temp_path_string = full_path_string + ".tmp"
+        with timelineTracer.timeline.span("Write well image", well_name, size=len(encoded_data)):
+            with open(temp_path_string, "wb") as output_file:
+                output_file.write(encoded_data)
+                if self.settings.well_image_fsync:
+                    output_file.flush()
+                    os.fsync(output_file.fileno())
+            replace_file(temp_path_string, full_path_string)
+
+        for callback in self.file_written_callbacks:
+            callback(full_path_string, len(encoded_data))